@@ -1,10 +1,44 @@
-from django.contrib import admin
+from django import forms
+from django.contrib import admin, messages
 from .models import UserProfile
 
 
+class UserProfileAdminForm(forms.ModelForm):
+    token_adjustment = forms.IntegerField(
+        required=False,
+        help_text='Tokens to add to the balance (negative to remove them); recorded in the token ledger.',
+    )
+    adjustment_note = forms.CharField(required=False, max_length=200)
+
+    class Meta:
+        model = UserProfile
+        fields = ['user']
+
+
 @admin.register(UserProfile)
 class UserProfileAdmin(admin.ModelAdmin):
+    form = UserProfileAdminForm
     list_display = ['user', 'token_balance', 'total_tokens_purchased', 'total_images_generated', 'created_at']
+    list_select_related = ['user']
     list_filter = ['created_at']
     search_fields = ['user__username', 'user__email']
-    readonly_fields = ['created_at', 'updated_at', 'total_tokens_purchased', 'total_images_generated']
+    # The balance and counters are materialized from the token ledger; change them with an adjustment.
+    readonly_fields = ['token_balance', 'created_at', 'updated_at', 'total_tokens_purchased', 'total_images_generated']
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            super().save_model(request, obj, form, change)
+        elif 'user' in form.changed_data:
+            # Saving every field would write back the counters as they were when the form was loaded.
+            obj.save(update_fields=['user', 'updated_at'])
+
+        amount = form.cleaned_data.get('token_adjustment')
+        if not amount:
+            return
+        note = request.user.username
+        if form.cleaned_data.get('adjustment_note'):
+            note = f"{note}: {form.cleaned_data['adjustment_note']}"
+        if UserProfile.adjust_tokens(obj.user_id, amount, note=note):
+            obj.refresh_from_db(fields=['token_balance'])
+        else:
+            self.message_user(request, 'Tokens not adjusted: the balance cannot go below zero.', messages.ERROR)
@@ -0,0 +1,70 @@
+"""
+Per-user cache for what most pages show: the balance and usage counters, and
+the dashboard's recent panels. Every entry is keyed under the user's current
+cache version; invalidate_user_cache() replaces the version once the change
+commits, so entries written before it are never read again and simply expire.
+"""
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+KEY_PREFIX = 'user-cache'
+SUMMARY_FIELDS = ('token_balance', 'total_tokens_purchased', 'total_images_generated')
+
+
+def _version_key(user_id):
+    return f"{KEY_PREFIX}:{user_id}:version"
+
+
+def user_cache_version(user_id):
+    """The user's current cache version; template fragments vary on it. None when the cache is unreachable."""
+    key = _version_key(user_id)
+    try:
+        version = cache.get(key)
+        if version is None:
+            cache.add(key, uuid.uuid4().hex, timeout=None)
+            version = cache.get(key)
+    except Exception as e:
+        print(f"User cache version read failed: {e}")
+        return None
+    return version
+
+
+def invalidate_user_cache(user_id):
+    """Retire the user's cached fragments and figures once the current transaction commits."""
+    def bump():
+        try:
+            cache.set(_version_key(user_id), uuid.uuid4().hex, timeout=None)
+        except Exception as e:
+            print(f"Could not invalidate the cache of user {user_id}: {e}")
+    transaction.on_commit(bump)
+
+
+def profile_summary(user_id):
+    """The user's balance and usage counters, cached until they change."""
+    from .models import UserProfile
+
+    key, summary = None, None
+    version = user_cache_version(user_id)
+    if version is not None:
+        key = f"{KEY_PREFIX}:{user_id}:{version}:profile"
+        try:
+            summary = cache.get(key)
+        except Exception as e:
+            print(f"User cache read failed: {e}")
+            key = None
+    if summary is not None:
+        return summary
+
+    summary = (
+        UserProfile.objects.filter(user_id=user_id).values(*SUMMARY_FIELDS).first()
+        or dict.fromkeys(SUMMARY_FIELDS, 0)
+    )
+    if key:
+        try:
+            cache.set(key, summary, settings.USER_CACHE_TTL)
+        except Exception as e:
+            print(f"User cache write failed: {e}")
+    return summary
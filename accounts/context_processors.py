@@ -0,0 +1,18 @@
+from django.utils.functional import SimpleLazyObject
+
+from .cache import profile_summary, user_cache_version
+
+
+def user_cache(request):
+    """
+    ``profile_summary`` (balance and usage counters) and ``user_cache_version``
+    for cached fragments, both served from the per-user cache and only looked
+    up when a template uses them.
+    """
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        return {}
+    return {
+        'profile_summary': SimpleLazyObject(lambda: profile_summary(user.id)),
+        'user_cache_version': SimpleLazyObject(lambda: user_cache_version(user.id)),
+    }
@@ -1,7 +1,11 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+from django.utils import timezone
+from tokens.models import TokenTransaction
+from .cache import invalidate_user_cache
 
 
 class UserProfile(models.Model):
@@ -15,18 +19,96 @@ class UserProfile(models.Model):
     def __str__(self):
         return f"{self.user.username}'s Profile"
 
-    def add_tokens(self, amount):
-        self.token_balance += amount
-        self.total_tokens_purchased += amount
-        self.save()
+    def add_tokens(self, amount, purchase=None):
+        UserProfile.add_tokens_for_user(self.user_id, amount, purchase=purchase)
+        self.refresh_from_db(fields=['token_balance', 'total_tokens_purchased'])
 
     def deduct_tokens(self, amount):
-        if self.token_balance >= amount:
-            self.token_balance -= amount
-            self.save()
+        if UserProfile.reserve_tokens(self.user_id, amount):
+            self.refresh_from_db(fields=['token_balance'])
             return True
         return False
 
+    # Every balance change below appends a TokenTransaction and updates the
+    # materialized counters in the same database transaction, and retires the
+    # user's cached figures once it commits.
+
+    @classmethod
+    def add_tokens_for_user(cls, user_id, amount, purchase=None):
+        with transaction.atomic():
+            cls.objects.filter(user_id=user_id).update(
+                token_balance=F('token_balance') + amount,
+                total_tokens_purchased=F('total_tokens_purchased') + amount,
+                updated_at=timezone.now(),
+            )
+            TokenTransaction.objects.create(
+                user_id=user_id, kind='purchase', amount=amount, tokens=amount, purchase=purchase
+            )
+            invalidate_user_cache(user_id)
+
+    @classmethod
+    def reserve_tokens(cls, user_id, amount, job_id=None):
+        """
+        Take ``amount`` tokens in one conditional UPDATE, so concurrent requests
+        and workers can never overspend. Returns False if the balance is too low.
+        """
+        with transaction.atomic():
+            updated = cls.objects.filter(user_id=user_id, token_balance__gte=amount).update(
+                token_balance=F('token_balance') - amount,
+                updated_at=timezone.now(),
+            )
+            if updated:
+                TokenTransaction.objects.create(
+                    user_id=user_id, kind='reservation', amount=-amount, tokens=amount, job_id=job_id
+                )
+                invalidate_user_cache(user_id)
+        return bool(updated)
+
+    @classmethod
+    def release_tokens(cls, user_id, amount, job_id=None):
+        """Give back reserved tokens that were not used, e.g. for a failed line."""
+        with transaction.atomic():
+            cls.objects.filter(user_id=user_id).update(
+                token_balance=F('token_balance') + amount,
+                updated_at=timezone.now(),
+            )
+            TokenTransaction.objects.create(
+                user_id=user_id, kind='refund', amount=amount, tokens=amount, job_id=job_id
+            )
+            invalidate_user_cache(user_id)
+
+    @classmethod
+    def adjust_tokens(cls, user_id, amount, note=''):
+        """
+        Manual correction of a balance by ``amount`` (negative to take tokens
+        away), recorded in the ledger. Returns False if it would go below zero.
+        """
+        with transaction.atomic():
+            updated = cls.objects.filter(user_id=user_id, token_balance__gte=-amount).update(
+                token_balance=F('token_balance') + amount,
+                updated_at=timezone.now(),
+            )
+            if updated:
+                TokenTransaction.objects.create(
+                    user_id=user_id, kind='adjustment', amount=amount, tokens=abs(amount), note=note
+                )
+                invalidate_user_cache(user_id)
+        return bool(updated)
+
+    @classmethod
+    def record_images_generated(cls, user_id, count=1, job_id=None):
+        """Charge reserved tokens for finished panels; the balance already reflects them."""
+        with transaction.atomic():
+            cls.objects.filter(user_id=user_id).update(
+                total_images_generated=F('total_images_generated') + count,
+                updated_at=timezone.now(),
+            )
+            TokenTransaction.objects.create(
+                user_id=user_id, kind='charge', amount=0, tokens=count, job_id=job_id
+            )
+            # Also retires the dashboard's recent panels, which gained this one.
+            invalidate_user_cache(user_id)
+
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
@@ -37,4 +119,6 @@ def create_user_profile(sender, instance, created, **kwargs):
 @receiver(post_save, sender=User)
 def save_user_profile(sender, instance, **kwargs):
     if hasattr(instance, 'profile'):
-        instance.profile.save()
+        # Never write the counters back from a possibly stale instance; they
+        # only change through the ledger methods above.
+        instance.profile.save(update_fields=['updated_at'])
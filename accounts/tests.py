@@ -1,3 +1,148 @@
-from django.test import TestCase
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import OperationalError, connection
+from django.db.models import Sum
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from comic_generator.query_profiling import assert_query_budget
+from generator.models import GeneratedImage, Script
+from tokens.models import TokenPackage, TokenPurchase, TokenTransaction
+from .models import UserProfile
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+)
+class UserCacheTests(TestCase):
+    """Balance, counters and the dashboard come from the per-user cache until they change."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('artist', password='password')
+        self.client.force_login(self.user)
+
+    def test_dashboard_steady_state_only_loads_the_session_and_user(self):
+        self.client.get(reverse('generator:dashboard'))
+        with assert_query_budget(max_queries=2):
+            response = self.client.get(reverse('generator:dashboard'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_finished_panel_refreshes_the_dashboard(self):
+        self.client.get(reverse('generator:dashboard'))
+        with self.captureOnCommitCallbacks(execute=True):
+            GeneratedImage.objects.create(
+                user=self.user, script=Script.objects.for_content('c', ['A: hi']), target_line='A: hi',
+                image_url='https://example.com/fresh-panel.png',
+            )
+            UserProfile.record_images_generated(self.user.id)
+
+        response = self.client.get(reverse('generator:dashboard'))
+        self.assertContains(response, 'fresh-panel.png')
+
+    def test_completed_purchase_refreshes_the_balance(self):
+        self.client.get(reverse('accounts:profile'))
+        package = TokenPackage.objects.create(name='Starter', token_amount=10, price=5)
+        purchase = TokenPurchase.objects.create(user=self.user, package=package, token_amount=10, price_paid=5)
+        with self.captureOnCommitCallbacks(execute=True):
+            purchase.complete_purchase()
+
+        response = self.client.get(reverse('accounts:profile'))
+        self.assertContains(response, '10 Tokens')
+
+    def test_dashboard_renders_uncached_while_the_cache_is_down(self):
+        UserProfile.add_tokens_for_user(self.user.id, 7)
+        broken = mock.Mock(**{f"{name}.side_effect": ConnectionError('cache down') for name in ('get', 'add', 'set')})
+        with mock.patch('accounts.cache.cache', broken):
+            response = self.client.get(reverse('generator:dashboard'))
+        self.assertContains(response, '<h3>7</h3>', html=True)
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+)
+class UserProfileAdminTests(TestCase):
+    """Balances change in the admin only through adjustments recorded in the ledger."""
+
+    def setUp(self):
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(admin)
+        self.user = User.objects.create_user('artist', password='password')
+        UserProfile.add_tokens_for_user(self.user.id, 5)
+        self.url = reverse('admin:accounts_userprofile_change', args=[self.user.profile.pk])
+
+    def post(self, **data):
+        response = self.client.post(self.url, {'user': self.user.pk, **data})
+        self.assertEqual(response.status_code, 302)
+
+    def test_balance_is_not_editable(self):
+        self.post(token_balance=1000)
+        self.assertEqual(UserProfile.objects.get(user=self.user).token_balance, 5)
+
+    def test_adjustment_is_recorded_in_the_ledger(self):
+        self.post(token_adjustment=-2, adjustment_note='duplicate purchase')
+        self.assertEqual(UserProfile.objects.get(user=self.user).token_balance, 3)
+        self.assertEqual(
+            list(TokenTransaction.objects.filter(kind='adjustment').values_list('amount', 'note')),
+            [(-2, 'admin: duplicate purchase')],
+        )
+
+        # A balance never goes negative.
+        self.post(token_adjustment=-4)
+        self.assertEqual(UserProfile.objects.get(user=self.user).token_balance, 3)
+        self.assertEqual(TokenTransaction.objects.filter(kind='adjustment').count(), 1)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TokenReservationTests(TransactionTestCase):
+    """Concurrent reservations never overspend, and every movement is in the ledger."""
+
+    WORKERS = 8
+
+    def setUp(self):
+        self.user = User.objects.create_user('artist', password='password')
+        UserProfile.add_tokens_for_user(self.user.id, 5)
+
+    def run_concurrently(self, action):
+        start = threading.Barrier(self.WORKERS)
+        results = []
+
+        def worker():
+            start.wait()
+            try:
+                while True:
+                    try:
+                        results.append(action())
+                        break
+                    except OperationalError:
+                        # SQLite fails a locked write at once instead of waiting; it was rolled back.
+                        time.sleep(0.01)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(self.WORKERS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_reservations_never_go_negative(self):
+        results = self.run_concurrently(lambda: UserProfile.reserve_tokens(self.user.id, 2))
+        self.assertEqual(results.count(True), 2)
+        self.assertEqual(UserProfile.objects.get(user=self.user).token_balance, 1)
+
+        self.run_concurrently(lambda: UserProfile.release_tokens(self.user.id, 1))
+        self.assertEqual(UserProfile.objects.get(user=self.user).token_balance, 1 + self.WORKERS)
+        self.assertEqual(
+            sorted(TokenTransaction.objects.filter(user=self.user).values_list('kind', flat=True)),
+            ['purchase'] + ['refund'] * self.WORKERS + ['reservation'] * 2,
+        )
+        ledger = TokenTransaction.objects.filter(user=self.user).aggregate(balance=Sum('amount'))
+        self.assertEqual(ledger['balance'], 1 + self.WORKERS)
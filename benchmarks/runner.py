@@ -0,0 +1,474 @@
+"""
+End-to-end generation benchmark: N concurrent users buy tokens through
+Stripe Checkout and submit M-line scripts to generate_view, Celery runs the
+pipeline against stub providers, and the report gives throughput, per-stage
+latency percentiles and database query counts.
+"""
+import hashlib
+import hmac
+import io
+import json
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from celery.signals import task_postrun, task_prerun
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test import Client
+from django.test.utils import override_settings, setup_databases, teardown_databases
+from PIL import Image
+
+from .stubs import DashScopeStub, GeminiStub, StripeStub
+
+REPORT_VERSION = 1
+
+# Stages recorded outside the pipeline that are left out of the per-job query count.
+HARNESS_STAGE = 'benchmark'
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = (len(ordered) - 1) * q
+    low = int(index)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (index - low)
+
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'p50': round(percentile(values, 0.50), 4) if values else None,
+        'p95': round(percentile(values, 0.95), 4) if values else None,
+        'p99': round(percentile(values, 0.99), 4) if values else None,
+        'max': round(max(values), 4) if values else None,
+    }
+
+
+class Recorder:
+    """Collects stage durations and the database queries issued while each stage runs, across threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.durations = defaultdict(list)
+        self.queries = Counter()
+        self.query_seconds = Counter()
+        self.rejections = Counter()
+
+    @property
+    def current(self):
+        stack = getattr(self.local, 'stack', None)
+        return stack[-1] if stack else 'other'
+
+    def push(self, name):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        self.local.stack.append((name, time.perf_counter()))
+
+    def pop(self):
+        name, started = self.local.stack.pop()
+        self.record(name, time.perf_counter() - started)
+
+    @contextmanager
+    def stage(self, name):
+        self.push(name)
+        try:
+            yield
+        finally:
+            self.pop()
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.durations[name].append(seconds)
+
+    def reject(self, stage, reason):
+        with self.lock:
+            self.rejections[f"{stage}: {reason}"] += 1
+
+    def query_wrapper(self, execute, sql, params, many, context):
+        stack = getattr(self.local, 'stack', None)
+        stage = stack[-1][0] if stack else 'other'
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            with self.lock:
+                self.queries[stage] += 1
+                self.query_seconds[stage] += time.perf_counter() - started
+
+    def instrument(self, connection):
+        if self.query_wrapper not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self.query_wrapper)
+
+    # Celery signal receivers: tasks run in worker threads of this process.
+    def on_task_prerun(self, task=None, **kwargs):
+        for connection in connections.all():
+            self.instrument(connection)
+        self.push(task.name.rsplit('.', 1)[-1])
+
+    def on_task_postrun(self, task=None, **kwargs):
+        self.pop()
+
+    def on_connection_created(self, connection=None, **kwargs):
+        self.instrument(connection)
+
+
+def _png(color, size=(512, 512)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def _stripe_signature(payload, secret):
+    timestamp = int(time.time())
+    signed = hmac.new(secret.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signed}"
+
+
+class Scenario:
+    def __init__(
+        self,
+        users=4,
+        lines=5,
+        jobs_per_user=1,
+        worker_concurrency=8,
+        engine='celery',
+        eager=False,
+        gemini_latency='lognormal:0.5,0.3',
+        dashscope_latency='lognormal:2,0.3',
+        stripe_latency='fixed:0.05',
+        gemini_error_rate=0.0,
+        dashscope_error_rate=0.0,
+        stripe_error_rate=0.0,
+        provider_rpm=60000,
+        seed=1,
+        timeout=600,
+    ):
+        self.users = users
+        self.lines = lines
+        self.jobs_per_user = jobs_per_user
+        self.worker_concurrency = worker_concurrency
+        self.engine = engine
+        self.eager = eager
+        self.gemini_latency = gemini_latency
+        self.dashscope_latency = dashscope_latency
+        self.stripe_latency = stripe_latency
+        self.gemini_error_rate = gemini_error_rate
+        self.dashscope_error_rate = dashscope_error_rate
+        self.stripe_error_rate = stripe_error_rate
+        self.provider_rpm = provider_rpm
+        self.seed = seed
+        self.timeout = timeout
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+class Benchmark:
+    def __init__(self, scenario, stdout=None):
+        self.scenario = scenario
+        self.stdout = stdout
+        self.recorder = Recorder()
+        self.run_id = uuid.uuid4().hex[:8]
+
+    def log(self, message):
+        if self.stdout:
+            self.stdout.write(message)
+
+    def run(self):
+        scenario = self.scenario
+        stubs = {
+            'gemini': GeminiStub(scenario.gemini_latency, scenario.gemini_error_rate, seed=scenario.seed),
+            'dashscope': DashScopeStub(scenario.dashscope_latency, scenario.dashscope_error_rate, seed=scenario.seed),
+            'stripe': StripeStub(scenario.stripe_latency, scenario.stripe_error_rate, seed=scenario.seed),
+        }
+        for stub in stubs.values():
+            stub.start()
+        media_root = tempfile.mkdtemp(prefix='benchmark-media-')
+        old_db_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            with self._configured(stubs, media_root), self._instrumented(), self._worker():
+                report = self._drive()
+        finally:
+            teardown_databases(old_db_config, verbosity=0)
+            for stub in stubs.values():
+                stub.stop()
+            shutil.rmtree(media_root, ignore_errors=True)
+        report['stubs'] = {name: stub.stats() for name, stub in stubs.items()}
+        return report
+
+    @contextmanager
+    def _configured(self, stubs, media_root):
+        import dashscope
+        import stripe
+        from generator.clients import provider_clients
+
+        scenario = self.scenario
+        overrides = override_settings(
+            DASHSCOPE_BASE_URL=f"{stubs['dashscope'].url}/api/v1",
+            GEMINI_BASE_URL=stubs['gemini'].url,
+            GEMINI_API_KEY='stub-gemini-key',
+            IMG_API_KEY='stub-dashscope-key',
+            STRIPE_SECRET_KEY='sk_test_stub',
+            STRIPE_WEBHOOK_SECRET='whsec_stub',
+            MEDIA_ROOT=media_root,
+            GENERATION_ENGINE=scenario.engine,
+            PROVIDER_RATE_LIMITS={
+                'gemini': {'default': scenario.provider_rpm},
+                'dashscope': {'default': scenario.provider_rpm},
+            },
+            ALLOWED_HOSTS=['testserver', 'localhost'],
+        )
+        saved = (dashscope.base_http_api_url, stripe.api_key, stripe.api_base)
+        with overrides:
+            dashscope.base_http_api_url = f"{stubs['dashscope'].url}/api/v1"
+            stripe.api_key = 'sk_test_stub'
+            stripe.api_base = stubs['stripe'].url
+            provider_clients.reset()
+            try:
+                yield
+            finally:
+                dashscope.base_http_api_url, stripe.api_key, stripe.api_base = saved
+                provider_clients.reset()
+
+    @contextmanager
+    def _instrumented(self):
+        recorder = self.recorder
+        task_prerun.connect(recorder.on_task_prerun, weak=False)
+        task_postrun.connect(recorder.on_task_postrun, weak=False)
+        connection_created.connect(recorder.on_connection_created, weak=False)
+        try:
+            yield
+        finally:
+            task_prerun.disconnect(recorder.on_task_prerun)
+            task_postrun.disconnect(recorder.on_task_postrun)
+            connection_created.disconnect(recorder.on_connection_created)
+
+    @contextmanager
+    def _worker(self):
+        from comic_generator.celery import app
+
+        if self.scenario.eager:
+            saved = app.conf.task_always_eager
+            app.conf.task_always_eager = True
+            try:
+                yield
+            finally:
+                app.conf.task_always_eager = saved
+            return
+
+        from celery.contrib.testing.worker import start_worker
+
+        queues = ['celery'] + sorted({route['queue'] for route in (app.conf.task_routes or {}).values()})
+        with start_worker(
+            app,
+            pool='threads',
+            concurrency=self.scenario.worker_concurrency,
+            perform_ping_check=False,
+            queues=queues,
+            loglevel='WARNING',
+            shutdown_timeout=30,
+        ):
+            yield
+
+    def _setup_users(self):
+        from django.contrib.auth.models import User
+        from tokens.models import TokenPackage
+
+        scenario = self.scenario
+        package = TokenPackage.objects.create(
+            name='Benchmark', token_amount=scenario.lines * scenario.jobs_per_user, price=1,
+        )
+        users = [
+            User.objects.create_user(f"bench-{self.run_id}-{i}", password='benchmark')
+            for i in range(scenario.users)
+        ]
+        return package, users
+
+    def _buy_tokens(self, client, package):
+        from django.conf import settings
+
+        recorder = self.recorder
+        with recorder.stage('web:create_checkout_session'):
+            response = client.post(
+                '/tokens/create-checkout-session/',
+                json.dumps({'package_id': package.id}),
+                content_type='application/json',
+            )
+        session_id = response.json().get('sessionId')
+        if not session_id:
+            recorder.reject('web:create_checkout_session', response.json().get('error'))
+            return False
+
+        payload = json.dumps({
+            'id': f"evt_{uuid.uuid4().hex}",
+            'object': 'event',
+            'type': 'checkout.session.completed',
+            'data': {'object': {'id': session_id, 'object': 'checkout.session', 'payment_status': 'paid'}},
+        })
+        webhook_sent = time.perf_counter()
+        with recorder.stage('web:stripe_webhook'):
+            client.post(
+                '/tokens/webhook/', payload, content_type='application/json',
+                HTTP_STRIPE_SIGNATURE=_stripe_signature(payload, settings.STRIPE_WEBHOOK_SECRET),
+            )
+        with recorder.stage('web:purchase_success'):
+            client.get('/tokens/success/', {'session_id': session_id})
+        return self._wait_for_purchase(session_id, webhook_sent)
+
+    def _wait_for_purchase(self, session_id, webhook_sent):
+        """Webhooks are applied by a worker; scripts can only be submitted once the tokens are credited."""
+        from tokens.models import TokenPurchase
+
+        deadline = time.monotonic() + self.scenario.timeout
+        with self.recorder.stage(HARNESS_STAGE):
+            while time.monotonic() < deadline:
+                if TokenPurchase.objects.filter(stripe_session_id=session_id, status='completed').exists():
+                    self.recorder.record('purchase_credited', time.perf_counter() - webhook_sent)
+                    return True
+                time.sleep(0.05)
+        self.recorder.reject('purchase', 'tokens not credited before the timeout')
+        return False
+
+    def _submit_scripts(self, client, index):
+        from django.contrib.messages import get_messages
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from django.urls import reverse
+
+        scenario = self.scenario
+        hero, sidekick, background = _png((index % 256, 40, 90)), _png((90, index % 256, 40)), _png((40, 90, index % 256))
+        for job_number in range(scenario.jobs_per_user):
+            dialogue = '\n'.join(
+                f"{'Hero' if line % 2 == 0 else 'Sidekick'}: line {line} of job {job_number}"
+                for line in range(scenario.lines)
+            )
+            with self.recorder.stage('web:generate'):
+                response = client.post('/generator/generate/', {
+                    # Unique per run and job so the description cache starts cold.
+                    'context': f"Benchmark {self.run_id}, user {index}, job {job_number}",
+                    'dialogue': dialogue,
+                    'character_name_1': 'Hero',
+                    'character_image_1': SimpleUploadedFile('hero.png', hero, 'image/png'),
+                    'character_name_2': 'Sidekick',
+                    'character_image_2': SimpleUploadedFile('sidekick.png', sidekick, 'image/png'),
+                    'background_name': 'street',
+                    'background': SimpleUploadedFile('street.png', background, 'image/png'),
+                })
+            if response.status_code != 302 or response.url != reverse('generator:gallery'):
+                errors = [str(m) for m in get_messages(response.wsgi_request)]
+                self.recorder.reject('web:generate', '; '.join(errors) or response.status_code)
+
+    def _user_session(self, user, index, package):
+        client = Client()
+        client.force_login(user)
+        if self._buy_tokens(client, package):
+            self._submit_scripts(client, index)
+        connections.close_all()
+
+    def _wait_for_jobs(self, started):
+        from generator.models import GeneratedImage, GenerationJob
+
+        deadline = started + self.scenario.timeout
+        with self.recorder.stage(HARNESS_STAGE):
+            while time.monotonic() < deadline:
+                pending_jobs = GenerationJob.objects.filter(finished_at__isnull=True).count()
+                unpersisted = GeneratedImage.objects.filter(image='').count()
+                if not pending_jobs and not unpersisted:
+                    return True
+                time.sleep(0.2)
+        return False
+
+    def _drive(self):
+        from generator.models import GenerationJob, GenerationLine
+
+        scenario = self.scenario
+        with self.recorder.stage(HARNESS_STAGE):
+            package, users = self._setup_users()
+
+        self.log(f"Running {scenario.users} users x {scenario.jobs_per_user} jobs x {scenario.lines} lines...")
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=scenario.users) as pool:
+            list(pool.map(self._user_session, users, range(len(users)), [package] * len(users)))
+        completed_in_time = self._wait_for_jobs(started)
+        elapsed = time.monotonic() - started
+
+        with self.recorder.stage(HARNESS_STAGE):
+            jobs = list(GenerationJob.objects.values('status', 'created_at', 'finished_at'))
+            line_statuses = Counter(GenerationLine.objects.values_list('status', flat=True))
+        return self._report(jobs, line_statuses, elapsed, completed_in_time)
+
+    def _report(self, jobs, line_statuses, elapsed, completed_in_time):
+        recorder = self.recorder
+        finished = [job for job in jobs if job['finished_at']]
+        stages = {name: summarize(values) for name, values in sorted(recorder.durations.items()) if name != HARNESS_STAGE}
+        stages['job'] = summarize([(job['finished_at'] - job['created_at']).total_seconds() for job in finished])
+
+        pipeline_queries = {name: count for name, count in recorder.queries.items() if name != HARNESS_STAGE}
+        total_queries = sum(pipeline_queries.values())
+        return {
+            'version': REPORT_VERSION,
+            'scenario': self.scenario.as_dict(),
+            'completed_in_time': completed_in_time,
+            'elapsed_seconds': round(elapsed, 3),
+            'throughput': {
+                'jobs_submitted': len(jobs),
+                'jobs_finished': len(finished),
+                'jobs_completed': sum(1 for job in finished if job['status'] == 'completed'),
+                'jobs_per_minute': round(len(finished) / elapsed * 60, 3) if elapsed else None,
+                'lines_per_minute': round(line_statuses.get('done', 0) / elapsed * 60, 3) if elapsed else None,
+                'lines': dict(line_statuses),
+            },
+            'rejected': dict(recorder.rejections),
+            'stages': stages,
+            'queries': {
+                'total': total_queries,
+                'per_job': round(total_queries / len(jobs), 2) if jobs else None,
+                'by_stage': {
+                    name: {'count': count, 'seconds': round(recorder.query_seconds[name], 4)}
+                    for name, count in sorted(pipeline_queries.items())
+                },
+            },
+        }
+
+
+def compare_to_baseline(report, baseline, tolerance=0.2, query_tolerance=0.0, slack_seconds=0.1):
+    """
+    Lists regressions of ``report`` against ``baseline``: lower throughput,
+    slower stage p95 or more queries, each beyond its relative tolerance.
+    Stage p95s also get ``slack_seconds`` of absolute headroom so jitter in
+    fast stages does not count as a regression.
+    """
+    regressions = []
+    if report['scenario'] != baseline['scenario']:
+        regressions.append("scenario differs from the baseline; results are not comparable")
+
+    current = report['throughput']['jobs_per_minute'] or 0
+    expected = baseline['throughput']['jobs_per_minute'] or 0
+    if current < expected * (1 - tolerance):
+        regressions.append(f"jobs_per_minute {current} < baseline {expected}")
+
+    for name, base_stage in baseline['stages'].items():
+        stage = report['stages'].get(name)
+        if not stage or base_stage['p95'] is None or stage['p95'] is None:
+            continue
+        limit = base_stage['p95'] * (1 + tolerance) + slack_seconds
+        if stage['p95'] > limit:
+            regressions.append(f"{name} p95 {stage['p95']}s > baseline {base_stage['p95']}s")
+
+    current = report['queries']['per_job'] or 0
+    expected = baseline['queries']['per_job'] or 0
+    if current > expected * (1 + query_tolerance):
+        regressions.append(f"queries per job {current} > baseline {expected}")
+    for name, base_stage in baseline['queries']['by_stage'].items():
+        stage = report['queries']['by_stage'].get(name, {'count': 0})
+        if stage['count'] > base_stage['count'] * (1 + query_tolerance):
+            regressions.append(f"{name} queries {stage['count']} > baseline {base_stage['count']}")
+    return regressions
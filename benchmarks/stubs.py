@@ -0,0 +1,286 @@
+"""
+Local stand-ins for Gemini, DashScope and Stripe. Each stub answers the
+endpoints the application calls with well-formed responses after a sampled
+latency, and fails a configurable fraction of requests the way the real
+service does when overloaded.
+"""
+import io
+import itertools
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from PIL import Image
+
+
+class Latency:
+    """
+    A latency distribution parsed from a spec string:
+    ``fixed:S``, ``uniform:LOW,HIGH``, ``normal:MEAN,SD`` or ``lognormal:MEDIAN,SIGMA``
+    (all in seconds).
+    """
+
+    def __init__(self, spec, seed=None):
+        self.spec = spec
+        kind, _, params = spec.partition(':')
+        self.kind = kind
+        self.params = [float(p) for p in params.split(',')] if params else []
+        if kind not in ('fixed', 'uniform', 'normal', 'lognormal'):
+            raise ValueError(f"Unknown latency distribution: {spec}")
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def sample(self):
+        with self.lock:
+            if self.kind == 'fixed':
+                return self.params[0]
+            if self.kind == 'uniform':
+                return self.random.uniform(*self.params)
+            if self.kind == 'normal':
+                return max(0.0, self.random.gauss(*self.params))
+            median, sigma = self.params
+            return self.random.lognormvariate(mu=math.log(median), sigma=sigma)
+
+    def __str__(self):
+        return self.spec
+
+
+class StubServer(ThreadingHTTPServer):
+    """Base class: runs in a daemon thread and counts requests, injected errors and simulated wait."""
+
+    daemon_threads = True
+    # Status the real service answers with when it sheds load.
+    ERROR_STATUS = 500
+
+    def __init__(self, latency='fixed:0', error_rate=0.0, seed=None):
+        super().__init__(('127.0.0.1', 0), self.Handler)
+        self.latency = Latency(latency, seed=seed)
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name=self.__class__.__name__, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def should_fail(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, latency=str(self.latency), error_rate=self.error_rate)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def read_json(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+            try:
+                return json.loads(body) if body else {}
+            except ValueError:
+                return {}
+
+        def send_json(self, status, payload):
+            self.send_bytes(status, json.dumps(payload).encode(), 'application/json')
+
+        def send_bytes(self, status, body, content_type):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def simulate(self, endpoint):
+            """Sleep for the sampled latency; returns True when this request should fail."""
+            server = self.server
+            delay = server.latency.sample()
+            server.count(f"{endpoint}:requests")
+            server.count('simulated_seconds', delay)
+            time.sleep(delay)
+            if server.should_fail():
+                server.count(f"{endpoint}:errors")
+                self.send_json(server.ERROR_STATUS, self.error_body())
+                return True
+            return False
+
+        def error_body(self):
+            return {'message': 'stub overloaded'}
+
+
+DESCRIPTION_FIELDS = (
+    'subject_description',
+    'setting_and_scene',
+    'action_or_expression',
+    'camera_and_style',
+    'full_image_prompt',
+)
+
+
+class GeminiStub(StubServer):
+    """Answers generateContent with a schema-shaped JSON description (one per requested line for batches)."""
+
+    ERROR_STATUS = 429
+
+    class Handler(StubServer.Handler):
+        def error_body(self):
+            return {'error': {'code': 429, 'message': 'Resource has been exhausted', 'status': 'RESOURCE_EXHAUSTED'}}
+
+        def do_POST(self):
+            body = self.read_json()
+            if not self.path.endswith(':generateContent'):
+                self.send_json(404, {'error': {'code': 404, 'message': 'not found', 'status': 'NOT_FOUND'}})
+                return
+            if self.simulate('generate_content'):
+                return
+            prompt = ''.join(
+                part.get('text', '') for content in body.get('contents', []) for part in content.get('parts', [])
+            )
+            description = {field: f"stub {field}" for field in DESCRIPTION_FIELDS}
+            batch = re.search(r'LINES TO VISUALIZE: ([\d, ]+)', prompt)
+            if batch:
+                indices = [int(i) for i in batch.group(1).split(',') if i.strip()]
+                text = json.dumps({'panels': [dict(description, line_index=i) for i in indices]})
+            else:
+                text = json.dumps(description)
+            self.send_json(200, {
+                'candidates': [{'content': {'parts': [{'text': text}], 'role': 'model'}, 'finishReason': 'STOP'}],
+                'usageMetadata': {'promptTokenCount': len(prompt) // 4, 'candidatesTokenCount': len(text) // 4},
+            })
+
+
+class DashScopeStub(StubServer):
+    """
+    Answers multimodal generation with a URL on this stub, serves the panel
+    image behind it, and implements the upload-policy + OSS upload pair used
+    to stage reference images.
+    """
+
+    ERROR_STATUS = 500
+
+    def __init__(self, *args, panel_size=(1024, 1024), **kwargs):
+        super().__init__(*args, **kwargs)
+        buffer = io.BytesIO()
+        Image.new('RGB', panel_size, (200, 180, 120)).save(buffer, 'PNG')
+        self.panel = buffer.getvalue()
+        self.ids = itertools.count(1)
+
+    class Handler(StubServer.Handler):
+        def error_body(self):
+            return {'code': 'InternalError', 'message': 'stub overloaded', 'request_id': 'stub'}
+
+        def do_GET(self):
+            parsed = urlparse(self.path)
+            if parsed.path.endswith('/uploads') and parse_qs(parsed.query).get('action') == ['getPolicy']:
+                self.server.count('upload_policy:requests')
+                policy = {
+                    'policy': 'stub', 'signature': 'stub', 'upload_dir': 'stub-uploads',
+                    'upload_host': f"{self.server.url}/oss", 'expire_in_seconds': 172800,
+                    'max_file_size_mb': 100, 'capacity_limit_mb': 999999,
+                    'oss_access_key_id': 'stub', 'x_oss_object_acl': 'private', 'x_oss_forbid_overwrite': 'true',
+                }
+                self.send_json(200, {'request_id': 'stub', 'data': policy, 'output': policy})
+            elif parsed.path.startswith('/panels/'):
+                self.server.count('panel_download:requests')
+                self.send_bytes(200, self.server.panel, 'image/png')
+            else:
+                self.send_json(404, {'code': 'NotFound', 'message': self.path})
+
+        def do_POST(self):
+            if self.path == '/oss':
+                length = int(self.headers.get('Content-Length') or 0)
+                self.rfile.read(length)
+                self.server.count('oss_upload:requests')
+                self.send_bytes(200, b'', 'text/plain')
+                return
+            body = self.read_json()
+            if not self.path.endswith('/multimodal-generation/generation'):
+                self.send_json(404, {'code': 'NotFound', 'message': self.path})
+                return
+            if self.simulate('multimodal_generation'):
+                return
+            panel_url = f"{self.server.url}/panels/{next(self.server.ids)}.png"
+            self.send_json(200, {
+                'request_id': 'stub',
+                'output': {'choices': [{
+                    'finish_reason': 'stop',
+                    'message': {'role': 'assistant', 'content': [{'image': panel_url}]},
+                }]},
+                'usage': {'image_count': 1, 'model': body.get('model')},
+            })
+
+
+class StripeStub(StubServer):
+    """Creates and retrieves Checkout Sessions; every retrieved session reports as paid."""
+
+    ERROR_STATUS = 500
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ids = itertools.count(1)
+        self.sessions = {}
+
+    class Handler(StubServer.Handler):
+        def error_body(self):
+            return {'error': {'type': 'api_error', 'message': 'stub overloaded'}}
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            form = parse_qs(self.rfile.read(length).decode())
+            if self.path != '/v1/checkout/sessions':
+                self.send_json(404, {'error': {'type': 'invalid_request_error', 'message': self.path}})
+                return
+            if self.simulate('create_session'):
+                return
+            session_id = f"cs_stub_{next(self.server.ids)}"
+            session = {
+                'id': session_id,
+                'object': 'checkout.session',
+                'payment_status': 'unpaid',
+                'status': 'open',
+                'client_reference_id': form.get('client_reference_id', [None])[0],
+                'payment_intent': f"pi_stub_{session_id}",
+                'url': f"{self.server.url}/pay/{session_id}",
+            }
+            with self.server.lock:
+                self.server.sessions[session_id] = session
+            self.send_json(200, session)
+
+        def do_GET(self):
+            match = re.match(r'^/v1/checkout/sessions/([^/?]+)', self.path)
+            if not match:
+                self.send_json(404, {'error': {'type': 'invalid_request_error', 'message': self.path}})
+                return
+            if self.simulate('retrieve_session'):
+                return
+            with self.server.lock:
+                session = self.server.sessions.get(match.group(1))
+            if session is None:
+                self.send_json(404, {'error': {'type': 'invalid_request_error', 'message': 'No such session'}})
+                return
+            self.send_json(200, dict(session, payment_status='paid', status='complete'))
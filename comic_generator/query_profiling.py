@@ -0,0 +1,158 @@
+"""
+Per-request database profiling: query count, repeated query shapes (the
+signature of an N+1), time spent in the database and an estimate of the bytes
+fetched. QueryProfilingMiddleware reports requests over QUERY_BUDGETS when
+QUERY_PROFILING is on; assert_query_budget() enforces budgets in tests.
+"""
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+# "IN (%s, %s, %s)" and multi-row "VALUES (..), (..)" differ only in length.
+_PLACEHOLDER_LIST = re.compile(r'\(%s(?:, %s)+\)')
+_ROW_LIST = re.compile(r'(\([^()]*\))(?:, \1)+')
+
+FETCH_METHODS = ('fetchone', 'fetchmany', 'fetchall')
+
+
+def query_shape(sql):
+    sql = _PLACEHOLDER_LIST.sub('(%s, ...)', sql)
+    return _ROW_LIST.sub(r'\1, ...', sql)
+
+
+def _value_size(value):
+    if value is None:
+        return 0
+    if isinstance(value, (str, bytes, bytearray, memoryview)):
+        return len(value)
+    if isinstance(value, (bool, int, float)):
+        return 8
+    return len(str(value))
+
+
+def _rows_size(rows):
+    if rows is None:
+        return 0
+    if isinstance(rows, tuple):
+        rows = [rows]
+    return sum(_value_size(value) for row in rows for value in row)
+
+
+class QueryProfile:
+    """An execute wrapper that accumulates statistics for the queries it sees."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.shapes = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        self.shapes[query_shape(sql)] += 1
+        self._measure_fetches(context['cursor'])
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - started
+
+    def _measure_fetches(self, cursor):
+        # Django's cursor wrapper resolves fetch methods through __getattr__,
+        # so instance attributes shadow them for this cursor only.
+        if getattr(cursor, '_query_profile', None) is self:
+            return
+        cursor._query_profile = self
+        for name in FETCH_METHODS:
+            fetch = getattr(cursor, name)
+
+            def measured(*args, _fetch=fetch, **kwargs):
+                started = time.perf_counter()
+                rows = _fetch(*args, **kwargs)
+                self.seconds += time.perf_counter() - started
+                self.bytes += _rows_size(rows)
+                return rows
+
+            setattr(cursor, name, measured)
+
+    @property
+    def duplicates(self):
+        """Query shapes that ran more than once, with how often they ran."""
+        return {shape: count for shape, count in self.shapes.most_common() if count > 1}
+
+    def over_budget(self, max_queries=None, max_duplicates=None, max_seconds=None, max_bytes=None):
+        """Human-readable descriptions of every budget this profile exceeds."""
+        problems = []
+        if max_queries is not None and self.count > max_queries:
+            problems.append(f"{self.count} queries (budget {max_queries})")
+        if max_duplicates is not None:
+            for shape, count in self.duplicates.items():
+                if count > max_duplicates:
+                    problems.append(f"{count}x the same query (budget {max_duplicates}): {shape[:300]}")
+        if max_seconds is not None and self.seconds > max_seconds:
+            problems.append(f"{self.seconds * 1000:.1f}ms in the database (budget {max_seconds * 1000:.0f}ms)")
+        if max_bytes is not None and self.bytes > max_bytes:
+            problems.append(f"~{self.bytes} bytes fetched (budget {max_bytes})")
+        return problems
+
+    def summary(self):
+        return (
+            f"{self.count} queries, {len(self.duplicates)} repeated shapes, "
+            f"{self.seconds * 1000:.1f}ms, ~{self.bytes} bytes"
+        )
+
+
+@contextmanager
+def profile_queries():
+    """Profile the queries the current thread runs on every database inside the block."""
+    profile = QueryProfile()
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(profile))
+        yield profile
+
+
+@contextmanager
+def assert_query_budget(max_queries=None, max_duplicates=None, max_seconds=None, max_bytes=None):
+    """
+    Fail with AssertionError when the block goes over any of the budgets.
+    ``max_duplicates`` is how often one query shape may repeat; an N+1 shows
+    up as a shape repeated once per row.
+    """
+    with profile_queries() as profile:
+        yield profile
+    problems = profile.over_budget(max_queries, max_duplicates, max_seconds, max_bytes)
+    if problems:
+        raise AssertionError('Query budget exceeded:\n  ' + '\n  '.join(problems))
+
+
+class QueryProfilingMiddleware:
+    """
+    Profiles each request's queries when QUERY_PROFILING is on, reports any
+    request over QUERY_BUDGETS and adds a Server-Timing header with the totals.
+    Queries run while a streaming response is consumed are not counted.
+    """
+
+    def __init__(self, get_response):
+        if not settings.QUERY_PROFILING:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with profile_queries() as profile:
+            response = self.get_response(request)
+
+        problems = profile.over_budget(**settings.QUERY_BUDGETS)
+        if problems:
+            print(f"Query budget exceeded by {request.method} {request.path} ({profile.summary()}):")
+            for problem in problems:
+                print(f"  {problem}")
+        response['Server-Timing'] = (
+            f'db;dur={profile.seconds * 1000:.1f};desc="{profile.count} queries, ~{profile.bytes} bytes"'
+        )
+        return response
@@ -33,6 +33,8 @@ INSTALLED_APPS = [
 
 
 MIDDLEWARE = [
+    # Outermost, so it also sees the queries of the middleware below it.
+    'comic_generator.query_profiling.QueryProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -43,6 +45,15 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Opt-in per-request query profiling; requests over any of the budgets are reported.
+QUERY_PROFILING = os.getenv('QUERY_PROFILING', '0') == '1'
+QUERY_BUDGETS = {
+    'max_queries': int(os.getenv('QUERY_BUDGET_COUNT', 25)),
+    'max_duplicates': int(os.getenv('QUERY_BUDGET_DUPLICATES', 3)),
+    'max_seconds': float(os.getenv('QUERY_BUDGET_SECONDS', 0.2)),
+    'max_bytes': int(os.getenv('QUERY_BUDGET_BYTES', 1024 * 1024)),
+}
+
 ROOT_URLCONF = 'comic_generator.urls'
 
 TEMPLATES = [
@@ -56,6 +67,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'accounts.context_processors.user_cache',
             ],
         },
     },
@@ -124,6 +136,29 @@ STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
 MEDIA_URL = 'media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Hash uploads while they stream in so identical files are stored only once.
+FILE_UPLOAD_HANDLERS = [
+    'generator.uploads.HashingMemoryFileUploadHandler',
+    'generator.uploads.HashingTemporaryFileUploadHandler',
+]
+
+# Reference images are downscaled to this many pixels on the long side and
+# re-encoded as WebP before they are sent to the image model.
+REFERENCE_IMAGE_MAX_SIZE = int(os.getenv('REFERENCE_IMAGE_MAX_SIZE', 1536))
+REFERENCE_IMAGE_QUALITY = int(os.getenv('REFERENCE_IMAGE_QUALITY', 90))
+
+# Finished panels are copied into MEDIA storage with WebP thumbnails at these widths.
+PANEL_THUMBNAIL_WIDTHS = [320, 640, 960]
+PANEL_THUMBNAIL_QUALITY = int(os.getenv('PANEL_THUMBNAIL_QUALITY', 80))
+
+GALLERY_PAGE_SIZE = int(os.getenv('GALLERY_PAGE_SIZE', 24))
+
+# Idle job progress streams get a comment line this often to keep proxies from closing them.
+SSE_KEEPALIVE_SECONDS = int(os.getenv('SSE_KEEPALIVE_SECONDS', 15))
+
+# Unreferenced uploads are kept this long before the cleanup task deletes them.
+UPLOAD_CLEANUP_GRACE_SECONDS = int(os.getenv('UPLOAD_CLEANUP_GRACE_SECONDS', 24 * 60 * 60))
+
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 LOGIN_URL = 'accounts:login'
@@ -135,11 +170,137 @@ IMG_API_KEY = os.getenv('IMG_API_KEY')
 STRIPE_SECRET_KEY = os.getenv('STRIPE_SECRET_KEY')
 STRIPE_PUBLISHABLE_KEY = os.getenv('STRIPE_PUBLISHABLE_KEY')
 STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET')
+# Webhook events still unprocessed after this long are handed to a worker again.
+STRIPE_EVENT_REQUEUE_SECONDS = int(os.getenv('STRIPE_EVENT_REQUEUE_SECONDS', 15 * 60))
+
+DASHSCOPE_BASE_URL = os.getenv('DASHSCOPE_BASE_URL', 'https://dashscope-intl.aliyuncs.com/api/v1')
+# Unset uses the SDK's default endpoint; the benchmark points it at a local stub.
+GEMINI_BASE_URL = os.getenv('GEMINI_BASE_URL')
+
+# DashScope keeps uploaded reference images for 48 hours; reuse a staged upload
+# only while at least PROVIDER_UPLOAD_MIN_REMAINING seconds of that are left.
+PROVIDER_UPLOAD_TTL = int(os.getenv('PROVIDER_UPLOAD_TTL', 48 * 60 * 60))
+PROVIDER_UPLOAD_MIN_REMAINING = int(os.getenv('PROVIDER_UPLOAD_MIN_REMAINING', 6 * 60 * 60))
+
+# Dialogue lines described per Gemini call; 0 describes every line separately.
+SCENE_DESCRIPTION_BATCH_SIZE = int(os.getenv('SCENE_DESCRIPTION_BATCH_SIZE', 10))
+# An admitted line that another batch is still describing is checked again after
+# SCENE_DESCRIPTION_WAIT_SECONDS, doubling each time; after SCENE_DESCRIPTION_MAX_WAITS
+# checks that batch is presumed dead and the line is described again.
+SCENE_DESCRIPTION_WAIT_SECONDS = int(os.getenv('SCENE_DESCRIPTION_WAIT_SECONDS', 2))
+SCENE_DESCRIPTION_MAX_WAITS = int(os.getenv('SCENE_DESCRIPTION_MAX_WAITS', 5))
+
+# 'celery' runs each line as a chain of Celery tasks; 'async' runs the lines of a job
+# on a per-process event loop (generate_lines_async), with at most
+# ASYNC_PROVIDER_CONCURRENCY lines in flight per worker process.
+GENERATION_ENGINE = os.getenv('GENERATION_ENGINE', 'celery')
+ASYNC_PROVIDER_CONCURRENCY = int(os.getenv('ASYNC_PROVIDER_CONCURRENCY', 200))
+# Line tasks carry only job and line ids; each worker process keeps the shared data
+# (script, characters, staged images) of this many recent jobs in memory.
+JOB_CACHE_SIZE = int(os.getenv('JOB_CACHE_SIZE', 256))
+
+# Composed panels are recorded in bulk, one flush per job for every line finished
+# within PANEL_FLUSH_SECONDS, instead of one set of writes per panel.
+PANEL_FLUSH_SECONDS = int(os.getenv('PANEL_FLUSH_SECONDS', 1))
+
+# 'fair' starts lines through generator/scheduler.py: round-robin across users and
+# their jobs, at most SCHEDULER_USER_MAX_IN_FLIGHT lines per user (the priority value
+# for buyers of a priority package) and SCHEDULER_MAX_IN_FLIGHT in the cluster (0 = no
+# cluster cap; keep it near the compose workers' total concurrency so the Celery
+# queues stay short). 'fifo' enqueues every line as soon as the job is dispatched.
+# The priority lane gets the first pick on SCHEDULER_PRIORITY_WEIGHT of every
+# SCHEDULER_PRIORITY_WEIGHT + 1 admissions; 0 turns the lane off.
+GENERATION_SCHEDULER = os.getenv('GENERATION_SCHEDULER', 'fair')
+SCHEDULER_USER_MAX_IN_FLIGHT = int(os.getenv('SCHEDULER_USER_MAX_IN_FLIGHT', 4))
+SCHEDULER_PRIORITY_USER_MAX_IN_FLIGHT = int(os.getenv('SCHEDULER_PRIORITY_USER_MAX_IN_FLIGHT', 8))
+SCHEDULER_MAX_IN_FLIGHT = int(os.getenv('SCHEDULER_MAX_IN_FLIGHT', 32))
+SCHEDULER_PRIORITY_WEIGHT = int(os.getenv('SCHEDULER_PRIORITY_WEIGHT', 3))
+# A slot whose line never reported back (e.g. the worker was killed) is freed after this.
+SCHEDULER_LEASE_SECONDS = int(os.getenv('SCHEDULER_LEASE_SECONDS', 30 * 60))
+
+# Provider HTTP clients are built once per worker process and keep their connections alive.
+PROVIDER_HTTP_TIMEOUT = int(os.getenv('PROVIDER_HTTP_TIMEOUT', 300))
+PROVIDER_HTTP_MAX_CONNECTIONS = int(os.getenv('PROVIDER_HTTP_MAX_CONNECTIONS', 256))
+PROVIDER_HTTP_KEEPALIVE_SECONDS = int(os.getenv('PROVIDER_HTTP_KEEPALIVE_SECONDS', 60))
+PROVIDER_CLIENT_STATS_INTERVAL = int(os.getenv('PROVIDER_CLIENT_STATS_INTERVAL', 30))
+
+# Cluster-wide provider quotas in requests per minute, per model ('default' applies to
+# models without their own entry). A 429/5xx halves the shared rate and blocks every
+# worker for PROVIDER_THROTTLE_BLOCK_SECONDS; the rate then recovers by
+# PROVIDER_RATE_RECOVERY of the quota per second. A request that gets no slot within
+# PROVIDER_RATE_LIMIT_TIMEOUT seconds fails with a retryable error instead of being sent.
+PROVIDER_RATE_LIMITS = {
+    'gemini': {'default': int(os.getenv('GEMINI_REQUESTS_PER_MINUTE', 60))},
+    'dashscope': {'default': int(os.getenv('DASHSCOPE_REQUESTS_PER_MINUTE', 30))},
+}
+PROVIDER_RATE_LIMIT_TIMEOUT = int(os.getenv('PROVIDER_RATE_LIMIT_TIMEOUT', 300))
+PROVIDER_RATE_RECOVERY = float(os.getenv('PROVIDER_RATE_RECOVERY', 0.02))
+PROVIDER_THROTTLE_BLOCK_SECONDS = float(os.getenv('PROVIDER_THROTTLE_BLOCK_SECONDS', 2))
+# Attempts per provider call, i.e. per stage: Gemini describes, DashScope composes. This
+# is the only retry layer for provider errors; the line stages do not retry them again.
+PROVIDER_MAX_ATTEMPTS = {
+    'gemini': int(os.getenv('GEMINI_MAX_ATTEMPTS', 4)),
+    'dashscope': int(os.getenv('DASHSCOPE_MAX_ATTEMPTS', 4)),
+}
+PROVIDER_BACKOFF_MAX_SECONDS = int(os.getenv('PROVIDER_BACKOFF_MAX_SECONDS', 30))
+
+# Prometheus: the web process serves /metrics to holders of METRICS_TOKEN (as a bearer
+# token), and without a token only when DEBUG is on; a Celery worker serves its metrics
+# on WORKER_METRICS_PORT when that is set.
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+WORKER_METRICS_PORT = int(os.getenv('WORKER_METRICS_PORT', 0))
 
-DASHSCOPE_BASE_URL = 'https://dashscope-intl.aliyuncs.com/api/v1'
 
 
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
 
-CELERY_BROKER_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+CELERY_BROKER_URL = REDIS_URL
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
+# Each generation stage has its own queue so workers can be sized per stage
+# (see "Running the workers" in replit.md); everything else uses the default queue.
+CELERY_TASK_ROUTES = {
+    'generator.tasks.describe_dialogue_lines': {'queue': 'describe'},
+    'generator.tasks.describe_line': {'queue': 'describe'},
+    'generator.tasks.compose_line': {'queue': 'compose'},
+    'generator.tasks.persist_line': {'queue': 'persist'},
+    'generator.tasks.persist_finished_lines': {'queue': 'persist'},
+    'generator.tasks.generate_lines_async': {'queue': 'engine'},
+    'generator.tasks.persist_generated_image': {'queue': 'persist'},
+}
+# Stages acknowledge late, so a worker only reserves the task it is running.
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+CELERY_BEAT_SCHEDULE = {
+    'cleanup-unreferenced-uploads': {
+        'task': 'generator.tasks.cleanup_unreferenced_uploads',
+        'schedule': 60 * 60,
+    },
+    'requeue-stripe-events': {
+        'task': 'tokens.tasks.requeue_stripe_events',
+        'schedule': 5 * 60,
+    },
+    'admit-scheduled-lines': {
+        'task': 'generator.tasks.admit_scheduled_lines',
+        'schedule': 30,
+    },
+}
+
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('CACHE_REDIS_URL', os.getenv('REDIS_URL', 'redis://localhost:6379/1')),
+    }
+}
+
+# Per-user cached figures and page fragments (accounts/cache.py). Changes invalidate
+# them immediately; the TTL only bounds how long retired entries occupy the cache.
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 15 * 60))
+
+# Scene description cache: Redis entries expire after DESCRIPTION_CACHE_TTL seconds,
+# the per-process LRU keeps at most DESCRIPTION_CACHE_LOCAL_SIZE entries. Each process
+# adds its hit/miss counts to the cluster totals every DESCRIPTION_CACHE_STATS_INTERVAL seconds.
+DESCRIPTION_CACHE_TTL = int(os.getenv('DESCRIPTION_CACHE_TTL', 7 * 24 * 60 * 60))
+DESCRIPTION_CACHE_LOCAL_SIZE = int(os.getenv('DESCRIPTION_CACHE_LOCAL_SIZE', 1024))
+DESCRIPTION_CACHE_LOCAL_TTL = int(os.getenv('DESCRIPTION_CACHE_LOCAL_TTL', 60 * 60))
+DESCRIPTION_CACHE_STATS_INTERVAL = int(os.getenv('DESCRIPTION_CACHE_STATS_INTERVAL', 30))
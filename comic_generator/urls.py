@@ -3,6 +3,7 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 from django.shortcuts import redirect
+from generator.views import metrics
 
 
 
@@ -13,6 +14,7 @@ urlpatterns = [
     path('accounts/', include('accounts.urls')),
     path('tokens/', include('tokens.urls')),
     path('generator/', include('generator.urls')),
+    path('metrics', metrics, name='metrics'),
     path('', lambda request: redirect('accounts:login')),
 ]
 
@@ -1,10 +1,47 @@
 from django.contrib import admin
-from .models import GeneratedImage
+from .models import GeneratedImage, GenerationJob, GenerationLine, Script, UploadedAsset
 
 
 @admin.register(GeneratedImage)
 class GeneratedImageAdmin(admin.ModelAdmin):
     list_display = ['user', 'speaker', 'target_line', 'tokens_used', 'created_at']
+    list_select_related = ['user']
     list_filter = ['created_at', 'tokens_used']
     search_fields = ['user__username', 'speaker', 'target_line']
     readonly_fields = ['created_at']
+    raw_id_fields = ['script']
+
+
+@admin.register(Script)
+class ScriptAdmin(admin.ModelAdmin):
+    list_display = ['content_hash', 'created_at']
+    search_fields = ['content_hash']
+    readonly_fields = ['content_hash', 'context', 'dialogue', 'created_at']
+
+
+@admin.register(UploadedAsset)
+class UploadedAssetAdmin(admin.ModelAdmin):
+    list_display = ['sha256', 'size', 'ref_count', 'created_at', 'last_used_at']
+    search_fields = ['sha256']
+    readonly_fields = ['sha256', 'file', 'size', 'created_at', 'last_used_at']
+
+
+class GenerationLineInline(admin.TabularInline):
+    model = GenerationLine
+    extra = 0
+    fields = ['index', 'text', 'status', 'error', 'generated_image']
+    readonly_fields = fields
+
+    def get_queryset(self, request):
+        # The image's __str__ shows its owner's username.
+        return super().get_queryset(request).select_related('generated_image__user')
+
+
+@admin.register(GenerationJob)
+class GenerationJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'user', 'status', 'total_lines', 'completed_lines', 'failed_lines', 'created_at']
+    list_select_related = ['user']
+    list_filter = ['status', 'created_at']
+    search_fields = ['user__username']
+    readonly_fields = ['created_at', 'updated_at', 'finished_at', 'completed_lines', 'failed_lines']
+    inlines = [GenerationLineInline]
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import threading
+import time
+from collections import Counter
+
+from cachetools import TTLCache
+from django.conf import settings
+from django.core.cache import caches
+
+
+class DescriptionCache:
+    """
+    Two-level cache for scene descriptions: a bounded in-process LRU in front
+    of the shared Redis cache. Descriptions are pure in their inputs, so the
+    key is a hash of the inputs plus the prompt version. Hit/miss counters are
+    added to the shared cache at most every DESCRIPTION_CACHE_STATS_INTERVAL
+    seconds rather than on every lookup.
+    """
+
+    KEY_PREFIX = 'scene-desc'
+    STATS_KEYS = ('local_hits', 'redis_hits', 'misses')
+
+    def __init__(self, alias='default', ttl=None, local_size=None, local_ttl=None):
+        self.alias = alias
+        self.ttl = ttl if ttl is not None else settings.DESCRIPTION_CACHE_TTL
+        self.local = TTLCache(
+            maxsize=local_size if local_size is not None else settings.DESCRIPTION_CACHE_LOCAL_SIZE,
+            ttl=local_ttl if local_ttl is not None else settings.DESCRIPTION_CACHE_LOCAL_TTL,
+        )
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(self.STATS_KEYS, 0)
+        self.pending = Counter()
+        self.flushed_at = time.monotonic()
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    @classmethod
+    def make_key(cls, context, dialogue, target_line, model_name, prompt_version):
+        payload = json.dumps(
+            [prompt_version, model_name, context, list(dialogue), target_line],
+            ensure_ascii=False,
+        )
+        digest = hashlib.sha256(payload.encode('utf-8')).hexdigest()
+        return f"{cls.KEY_PREFIX}:{prompt_version}:{digest}"
+
+    def get(self, key):
+        with self.lock:
+            value = self.local.get(key)
+        if value is not None:
+            self._count('local_hits')
+            return value
+
+        try:
+            value = self.shared.get(key)
+        except Exception as e:
+            print(f"Description cache read failed: {e}")
+            value = None
+
+        if value is None:
+            self._count('misses')
+            return None
+
+        with self.lock:
+            self.local[key] = value
+        self._count('redis_hits')
+        return value
+
+    def set(self, key, value):
+        if not value:
+            # Never cache failed (empty) descriptions.
+            return
+        with self.lock:
+            self.local[key] = value
+        try:
+            self.shared.set(key, value, timeout=self.ttl)
+        except Exception as e:
+            print(f"Description cache write failed: {e}")
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+            self.pending[name] += 1
+            due = time.monotonic() - self.flushed_at >= settings.DESCRIPTION_CACHE_STATS_INTERVAL
+        if due:
+            self.flush_stats()
+
+    def flush_stats(self):
+        """Add the counts since the last flush to the cluster-wide counters."""
+        with self.lock:
+            pending, self.pending = self.pending, Counter()
+            self.flushed_at = time.monotonic()
+        for name, count in pending.items():
+            stat_key = f"{self.KEY_PREFIX}:stats:{name}"
+            try:
+                try:
+                    self.shared.incr(stat_key, count)
+                except ValueError:
+                    # First count of this counter; someone else may have just created it.
+                    if not self.shared.add(stat_key, count, timeout=None):
+                        self.shared.incr(stat_key, count)
+            except Exception:
+                pass
+
+    def stats(self):
+        """Hit/miss counters for this process and, when reachable, the whole cluster."""
+        self.flush_stats()
+        with self.lock:
+            local = dict(self.counters, local_entries=len(self.local), local_max_entries=self.local.maxsize)
+        try:
+            shared = {
+                name: self.shared.get(f"{self.KEY_PREFIX}:stats:{name}", 0)
+                for name in self.STATS_KEYS
+            }
+        except Exception:
+            shared = None
+        return {'process': local, 'cluster': shared}
+
+    def clear_stats(self):
+        with self.lock:
+            self.counters = dict.fromkeys(self.STATS_KEYS, 0)
+            self.pending = Counter()
+        self.shared.delete_many([f"{self.KEY_PREFIX}:stats:{name}" for name in self.STATS_KEYS])
+
+
+description_cache = DescriptionCache()
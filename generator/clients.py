@@ -0,0 +1,268 @@
+import asyncio
+import os
+import socket
+import threading
+import time
+from collections import Counter
+
+import httpx
+import redis
+from django.conf import settings
+from dashscope.utils.oss_utils import preprocess_message_element
+from google import genai
+from google.genai import types
+
+
+class ConnectionStats:
+    """
+    Counts requests and newly opened connections per provider from httpx's
+    trace hooks; every request that did not open a connection reused a pooled
+    one. Counters are published to Redis per process at most every
+    PROVIDER_CLIENT_STATS_INTERVAL seconds.
+    """
+
+    KEY_PREFIX = 'provider-clients:stats'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self.published_at = 0.0
+        self.client = None
+
+    def reset(self):
+        with self.lock:
+            self.counters = Counter()
+            self.published_at = 0.0
+            self.client = None
+
+    def request(self, provider):
+        """Count a request. Returns True for the one caller that should publish the counters now."""
+        with self.lock:
+            self.counters[(provider, 'requests')] += 1
+            now = time.monotonic()
+            due = now - self.published_at >= settings.PROVIDER_CLIENT_STATS_INTERVAL
+            if due:
+                self.published_at = now
+        return due
+
+    def connection(self, provider):
+        with self.lock:
+            self.counters[(provider, 'connections')] += 1
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+        stats = {}
+        for (provider, name), value in counters.items():
+            stats.setdefault(provider, {'requests': 0, 'connections': 0})[name] = value
+        for provider_stats in stats.values():
+            provider_stats['reused'] = max(0, provider_stats['requests'] - provider_stats['connections'])
+        return stats
+
+    def publish(self):
+        """Write this process's counters to Redis, where they expire unless refreshed. Blocks on Redis."""
+        key = f"{self.KEY_PREFIX}:{socket.gethostname()}:{os.getpid()}"
+        try:
+            if self.client is None:
+                self.client = redis.Redis.from_url(settings.REDIS_URL)
+            pipe = self.client.pipeline()
+            pipe.delete(key)
+            for provider, provider_stats in self.snapshot().items():
+                for name, value in provider_stats.items():
+                    pipe.hset(key, f"{provider}:{name}", value)
+            pipe.expire(key, settings.PROVIDER_CLIENT_STATS_INTERVAL * 10)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"Could not publish provider client stats: {e}")
+
+    @classmethod
+    def cluster(cls):
+        """Counters published by every live worker process, summed per provider."""
+        client = redis.Redis.from_url(settings.REDIS_URL)
+        totals = {}
+        processes = 0
+        for key in client.scan_iter(match=f"{cls.KEY_PREFIX}:*"):
+            processes += 1
+            for field, value in client.hgetall(key).items():
+                provider, name = field.decode().rsplit(':', 1)
+                provider_stats = totals.setdefault(provider, {'requests': 0, 'connections': 0, 'reused': 0})
+                provider_stats[name] += int(value)
+        for provider_stats in totals.values():
+            requests = provider_stats['requests']
+            provider_stats['reuse_rate'] = round(provider_stats['reused'] / requests, 4) if requests else None
+        return {'processes': processes, 'providers': totals}
+
+
+connection_stats = ConnectionStats()
+
+
+def _sync_hooks(provider):
+    def trace(event, info):
+        if event == 'connection.connect_tcp.complete':
+            connection_stats.connection(provider)
+
+    def on_request(request):
+        if connection_stats.request(provider):
+            connection_stats.publish()
+        request.extensions['trace'] = trace
+
+    return {'request': [on_request]}
+
+
+def _async_hooks(provider):
+    async def trace(event, info):
+        if event == 'connection.connect_tcp.complete':
+            connection_stats.connection(provider)
+
+    async def on_request(request):
+        if connection_stats.request(provider):
+            # Publishing is a blocking Redis round trip; keep it off the event loop and don't wait for it.
+            asyncio.get_running_loop().run_in_executor(None, connection_stats.publish)
+        request.extensions['trace'] = trace
+
+    return {'request': [on_request]}
+
+
+def _limits():
+    return httpx.Limits(
+        max_connections=settings.PROVIDER_HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.PROVIDER_HTTP_MAX_CONNECTIONS,
+        keepalive_expiry=settings.PROVIDER_HTTP_KEEPALIVE_SECONDS,
+    )
+
+
+class DashScopeResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.output = body.get('output') or {}
+        self.code = body.get('code', '')
+        self.message = body.get('message', '')
+        self.request_id = body.get('request_id', '')
+
+
+class DashScopeClient:
+    """
+    Calls DashScope's multimodal generation endpoint over pooled keep-alive
+    connections. The SDK opens a new session for every call, so only uploads
+    of local files still go through it.
+    """
+
+    PATH = 'services/aigc/multimodal-generation/generation'
+
+    def __init__(self, api_key, base_url):
+        self.api_key = api_key
+        self.url = f"{base_url.rstrip('/')}/{self.PATH}"
+        self.http = httpx.Client(
+            timeout=settings.PROVIDER_HTTP_TIMEOUT, limits=_limits(), event_hooks=_sync_hooks('dashscope')
+        )
+        self._ahttp = None
+
+    @property
+    def ahttp(self):
+        # Created on first async use so the pool belongs to the event loop that uses it.
+        if self._ahttp is None:
+            self._ahttp = httpx.AsyncClient(
+                timeout=settings.PROVIDER_HTTP_TIMEOUT, limits=_limits(), event_hooks=_async_hooks('dashscope')
+            )
+        return self._ahttp
+
+    @staticmethod
+    def _has_local_files(messages):
+        return any(
+            isinstance(value, str) and not value.startswith(('http', 'oss://'))
+            for message in messages
+            for elem in message['content'] if 'image' in elem
+            for value in [elem['image']]
+        )
+
+    def _upload_local_files(self, model, messages):
+        for message in messages:
+            for elem in message['content']:
+                if 'image' in elem:
+                    preprocess_message_element(model, elem, self.api_key)
+
+    def _request(self, model, messages, parameters):
+        headers = {'Authorization': f"Bearer {self.api_key}"}
+        if any(str(elem.get('image', '')).startswith('oss://') for message in messages for elem in message['content']):
+            headers['X-DashScope-OssResourceResolve'] = 'enable'
+        payload = {'model': model, 'input': {'messages': messages}, 'parameters': parameters}
+        return headers, payload
+
+    @staticmethod
+    def _response(response):
+        try:
+            body = response.json()
+        except ValueError:
+            body = {'message': response.text}
+        return DashScopeResponse(response.status_code, body)
+
+    def multimodal_generation(self, model, messages, **parameters):
+        if self._has_local_files(messages):
+            self._upload_local_files(model, messages)
+        headers, payload = self._request(model, messages, parameters)
+        return self._response(self.http.post(self.url, json=payload, headers=headers))
+
+    async def amultimodal_generation(self, model, messages, **parameters):
+        if self._has_local_files(messages):
+            await asyncio.to_thread(self._upload_local_files, model, messages)
+        headers, payload = self._request(model, messages, parameters)
+        return self._response(await self.ahttp.post(self.url, json=payload, headers=headers))
+
+
+class ProviderClients:
+    """
+    Per-process registry of provider clients. Clients are built once and keep
+    their connection pools for the life of the process; a forked child drops
+    the inherited clients (their sockets belong to the parent) and builds its own.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self._gemini = None
+        self._dashscope = None
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self._gemini = None
+        self._dashscope = None
+        connection_stats.reset()
+
+    def _check_pid(self):
+        if self.pid != os.getpid():
+            self.reset()
+
+    def gemini(self):
+        self._check_pid()
+        with self.lock:
+            if self._gemini is None:
+                self._gemini = genai.Client(api_key=settings.GEMINI_API_KEY, http_options=types.HttpOptions(
+                    base_url=settings.GEMINI_BASE_URL,
+                    client_args={'limits': _limits(), 'event_hooks': _sync_hooks('gemini')},
+                    # Passing a transport makes genai use httpx rather than a new aiohttp session per call.
+                    async_client_args={
+                        'transport': httpx.AsyncHTTPTransport(limits=_limits()),
+                        'event_hooks': _async_hooks('gemini'),
+                    },
+                ))
+            return self._gemini
+
+    def dashscope(self):
+        self._check_pid()
+        with self.lock:
+            if self._dashscope is None:
+                self._dashscope = DashScopeClient(settings.IMG_API_KEY, settings.DASHSCOPE_BASE_URL)
+            return self._dashscope
+
+    def warm_up(self):
+        for build in (self.gemini, self.dashscope):
+            try:
+                build()
+            except Exception as e:
+                print(f"Could not build provider client: {e}")
+
+
+provider_clients = ProviderClients()
+
+os.register_at_fork(after_in_child=provider_clients.reset)
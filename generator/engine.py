@@ -0,0 +1,122 @@
+import asyncio
+import threading
+
+from django.conf import settings
+from django.db import OperationalError, close_old_connections
+
+from .exceptions import ProviderError
+from .providers import (
+    acompose_comic_panel,
+    acreate_image_description_from_dialogue,
+    acreate_image_descriptions_for_dialogue,
+)
+from .models import GenerationLine
+from .tasks import _fail_line, _set_line_status, line_composed
+
+
+class ProviderEngine:
+    """
+    A per-process event loop for provider calls. Worker threads hand it
+    coroutines and wait for the result; the loop keeps up to ``concurrency``
+    lines in flight at once, however many tasks submitted them.
+    """
+
+    def __init__(self, concurrency=None):
+        self.concurrency = concurrency
+        self.lock = threading.Lock()
+        self.loop = None
+        self.thread = None
+        self.semaphore = None
+
+    def _ensure_running(self):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.loop = asyncio.new_event_loop()
+            self.semaphore = asyncio.Semaphore(self.concurrency or settings.ASYNC_PROVIDER_CONCURRENCY)
+            self.thread = threading.Thread(target=self.loop.run_forever, name='provider-engine', daemon=True)
+            self.thread.start()
+
+    def run(self, coro):
+        """Run a coroutine on the engine loop and block the calling thread until it finishes."""
+        self._ensure_running()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+
+provider_engine = ProviderEngine()
+
+
+def _db(func, *args, **kwargs):
+    """Run ORM work off the event loop; executor threads drop stale connections first."""
+    def call():
+        close_old_connections()
+        return func(*args, **kwargs)
+    return asyncio.to_thread(call)
+
+
+async def run_lines(job, line_ids):
+    """
+    Describe, compose and persist the given lines concurrently. Returns
+    {line_id: error} for lines that hit a database error and are worth retrying;
+    provider calls retry on their own, so a line whose provider call raised is
+    already marked failed and refunded.
+    """
+    lines = await _db(lambda: list(
+        GenerationLine.objects.filter(pk__in=line_ids)
+        .exclude(status__in=GenerationLine.TERMINAL_STATUSES)
+        .values('id', 'index', 'description', 'result_url')
+    ))
+
+    undescribed = [line for line in lines if not line['description']]
+    if undescribed and settings.SCENE_DESCRIPTION_BATCH_SIZE > 0:
+        await _db(_set_line_status, job.id, [line['id'] for line in undescribed], 'describing')
+        descriptions = await acreate_image_descriptions_for_dialogue(
+            context=job.context,
+            dialogue=job.dialogue,
+            line_indices=[line['index'] for line in undescribed],
+        )
+        for line in undescribed:
+            line['description'] = descriptions.get(line['index'])
+            if line['description']:
+                await _db(GenerationLine.objects.filter(pk=line['id']).update, description=line['description'])
+
+    results = await asyncio.gather(*(
+        _run_line(job, line) for line in lines
+    ))
+    return {line['id']: error for line, error in zip(lines, results) if error}
+
+
+async def _run_line(job, line):
+    async with provider_engine.semaphore:
+        line_id = line['id']
+        target_line = job.dialogue[line['index']]
+        try:
+            description = line['description']
+            if not description:
+                await _db(_set_line_status, job.id, line_id, 'describing')
+                description = await acreate_image_description_from_dialogue(
+                    context=job.context,
+                    dialogue=job.dialogue,
+                    target_line=target_line,
+                )
+                if not description:
+                    raise ProviderError("Failed to get image description")
+                await _db(GenerationLine.objects.filter(pk=line_id).update, description=description)
+
+            if not line['result_url']:
+                await _db(_set_line_status, job.id, line_id, 'composing')
+                result_url = await acompose_comic_panel(
+                    characters=job.characters,
+                    background_image_path=job.background_image_path,
+                    image_data=description,
+                    target_line=target_line,
+                    staged_images=job.staged_images,
+                )
+                await _db(GenerationLine.objects.filter(pk=line_id).update, result_url=result_url)
+
+            await _db(line_composed, job.id, line_id, job.user_id)
+        except OperationalError as e:
+            return str(e)
+        except Exception as e:
+            await _db(_fail_line, job.id, line_id, job.user_id, str(e) or e.__class__.__name__)
+        return None
@@ -0,0 +1,102 @@
+import asyncio
+import json
+from collections import defaultdict
+
+import redis
+import redis.asyncio
+from django.conf import settings
+
+CHANNEL_PREFIX = 'generation-job:'
+
+_publisher = None
+
+
+def _get_publisher():
+    global _publisher
+    if _publisher is None:
+        _publisher = redis.Redis.from_url(settings.REDIS_URL)
+    return _publisher
+
+
+def publish_job_event(job_id, event, data):
+    """Publish a progress event for a job. Progress is best-effort and never fails the caller."""
+    message = json.dumps({'event': event, 'data': data})
+    try:
+        _get_publisher().publish(f"{CHANNEL_PREFIX}{job_id}", message)
+    except redis.RedisError as e:
+        print(f"Could not publish {event} event for job {job_id}: {e}")
+
+
+class JobEventHub:
+    """
+    Fans job events out to the SSE connections of one ASGI worker. The worker
+    holds a single pattern subscription to Redis however many clients are
+    connected; each client only gets a small in-memory queue.
+    """
+
+    QUEUE_SIZE = 100
+
+    def __init__(self):
+        self.subscribers = defaultdict(set)
+        self.loop = None
+        self.task = None
+        self.ready = None
+
+    async def subscribe(self, job_id):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop or self.task is None or self.task.done():
+            self.loop = loop
+            self.ready = asyncio.Event()
+            self.task = loop.create_task(self._listen())
+        queue = asyncio.Queue(maxsize=self.QUEUE_SIZE)
+        self.subscribers[job_id].add(queue)
+        try:
+            # Wait for the Redis subscription so events published from now on are not missed.
+            await asyncio.wait_for(self.ready.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            pass
+        return queue
+
+    def unsubscribe(self, job_id, queue):
+        queues = self.subscribers.get(job_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self.subscribers[job_id]
+
+    async def _listen(self):
+        while True:
+            client = redis.asyncio.Redis.from_url(settings.REDIS_URL)
+            pubsub = client.pubsub()
+            try:
+                await pubsub.psubscribe(f"{CHANNEL_PREFIX}*")
+                self.ready.set()
+                async for message in pubsub.listen():
+                    if message['type'] == 'pmessage':
+                        self._dispatch(message['channel'], message['data'])
+            except asyncio.CancelledError:
+                raise
+            except redis.RedisError as e:
+                print(f"Job event subscription lost, reconnecting: {e}")
+                self.ready.clear()
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+                await client.aclose()
+
+    def _dispatch(self, channel, data):
+        job_id = int(channel.decode().removeprefix(CHANNEL_PREFIX))
+        for queue in self.subscribers.get(job_id, ()):
+            try:
+                queue.put_nowait(data)
+            except asyncio.QueueFull:
+                # A stalled client misses intermediate events; the next job event carries the totals.
+                pass
+
+
+job_event_hub = JobEventHub()
+
+
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
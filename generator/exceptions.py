@@ -0,0 +1,10 @@
+class ProviderError(Exception):
+    """A provider call failed in a way that retrying will not fix."""
+
+
+class RetryableProviderError(ProviderError):
+    """A provider call failed transiently (throttling, server error, network)."""
+
+
+class ProviderThrottled(RetryableProviderError):
+    """The provider answered 429 or 5xx: slow the whole cluster down, then retry."""
@@ -0,0 +1,101 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from benchmarks.runner import Benchmark, Scenario, compare_to_baseline
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the generation path end to end against local Gemini, DashScope and Stripe stubs: '
+        'concurrent users buy tokens and submit scripts, Celery runs the pipeline in-process'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=4, help='Concurrent users')
+        parser.add_argument('--lines', type=int, default=5, help='Dialogue lines per script')
+        parser.add_argument('--jobs-per-user', type=int, default=1, help='Scripts each user submits')
+        parser.add_argument('--concurrency', type=int, default=8, help='Worker threads')
+        parser.add_argument('--engine', choices=['celery', 'async'], default='celery', help='GENERATION_ENGINE to run')
+        parser.add_argument('--eager', action='store_true', help='Run tasks inline in the request instead of on a worker')
+        parser.add_argument('--gemini-latency', default='lognormal:0.5,0.3',
+                            help='fixed:S, uniform:LOW,HIGH, normal:MEAN,SD or lognormal:MEDIAN,SIGMA (seconds)')
+        parser.add_argument('--dashscope-latency', default='lognormal:2,0.3')
+        parser.add_argument('--stripe-latency', default='fixed:0.05')
+        parser.add_argument('--gemini-error-rate', type=float, default=0.0)
+        parser.add_argument('--dashscope-error-rate', type=float, default=0.0)
+        parser.add_argument('--stripe-error-rate', type=float, default=0.0)
+        parser.add_argument('--provider-rpm', type=int, default=60000,
+                            help='Rate limit applied to each provider during the run')
+        parser.add_argument('--seed', type=int, default=1, help='Seed for stub latencies and errors')
+        parser.add_argument('--timeout', type=int, default=600, help='Seconds to wait for the jobs to finish')
+        parser.add_argument('--output', help='Write the report to this JSON file')
+        parser.add_argument('--save-baseline', help='Write the report as a baseline to this JSON file')
+        parser.add_argument('--baseline', help='Compare against this baseline; exits non-zero on regression')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Allowed relative drop in throughput or rise in stage p95')
+        parser.add_argument('--query-tolerance', type=float, default=0.0,
+                            help='Allowed relative rise in database queries')
+
+    def handle(self, *args, **options):
+        scenario = Scenario(
+            users=options['users'],
+            lines=options['lines'],
+            jobs_per_user=options['jobs_per_user'],
+            worker_concurrency=options['concurrency'],
+            engine=options['engine'],
+            eager=options['eager'],
+            gemini_latency=options['gemini_latency'],
+            dashscope_latency=options['dashscope_latency'],
+            stripe_latency=options['stripe_latency'],
+            gemini_error_rate=options['gemini_error_rate'],
+            dashscope_error_rate=options['dashscope_error_rate'],
+            stripe_error_rate=options['stripe_error_rate'],
+            provider_rpm=options['provider_rpm'],
+            seed=options['seed'],
+            timeout=options['timeout'],
+        )
+        report = Benchmark(scenario, stdout=self.stdout).run()
+        self._print_summary(report)
+
+        for path in (options['output'], options['save_baseline']):
+            if path:
+                with open(path, 'w') as f:
+                    json.dump(report, f, indent=2, sort_keys=True)
+                self.stdout.write(f"Report written to {path}")
+
+        if not report['completed_in_time']:
+            raise CommandError(f"Jobs did not finish within {scenario.timeout}s")
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            regressions = compare_to_baseline(
+                report, baseline, tolerance=options['tolerance'], query_tolerance=options['query_tolerance'],
+            )
+            if regressions:
+                raise CommandError('Regressions against baseline:\n  ' + '\n  '.join(regressions))
+            self.stdout.write(self.style.SUCCESS('No regressions against baseline.'))
+
+    def _print_summary(self, report):
+        throughput = report['throughput']
+        self.stdout.write(
+            f"{throughput['jobs_finished']}/{throughput['jobs_submitted']} jobs in {report['elapsed_seconds']}s: "
+            f"{throughput['jobs_per_minute']} jobs/min, {throughput['lines_per_minute']} lines/min, "
+            f"lines {throughput['lines']}"
+        )
+        for reason, count in report['rejected'].items():
+            self.stdout.write(self.style.WARNING(f"Rejected x{count}: {reason}"))
+        self.stdout.write(f"{'stage':<32}{'count':>7}{'p50':>10}{'p95':>10}{'p99':>10}{'queries':>9}")
+        queries = report['queries']['by_stage']
+        for name, stage in report['stages'].items():
+            self.stdout.write(
+                f"{name:<32}{stage['count']:>7}{_seconds(stage['p50'])}{_seconds(stage['p95'])}"
+                f"{_seconds(stage['p99'])}{queries.get(name, {}).get('count', ''):>9}"
+            )
+        self.stdout.write(f"DB queries: {report['queries']['total']} total, {report['queries']['per_job']} per job")
+        self.stdout.write(f"Stubs: {json.dumps(report['stubs'])}")
+
+
+def _seconds(value):
+    return f"{value:>10.3f}" if value is not None else f"{'-':>10}"
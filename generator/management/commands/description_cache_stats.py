@@ -0,0 +1,25 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from generator.cache import description_cache
+
+
+class Command(BaseCommand):
+    help = 'Show scene description cache hit/miss counters'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset the counters after printing them')
+
+    def handle(self, *args, **options):
+        stats = description_cache.stats()
+        cluster = stats['cluster']
+        if cluster:
+            lookups = sum(cluster.values())
+            hits = cluster['local_hits'] + cluster['redis_hits']
+            cluster['hit_rate'] = round(hits / lookups, 4) if lookups else None
+        self.stdout.write(json.dumps(stats, indent=2))
+
+        if options['reset']:
+            description_cache.clear_stats()
+            self.stdout.write(self.style.SUCCESS('Counters reset.'))
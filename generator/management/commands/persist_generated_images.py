@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from generator.models import GeneratedImage
+from generator.tasks import persist_generated_image
+
+
+class Command(BaseCommand):
+    help = 'Queue panels that still point at the provider URL for download into local storage'
+
+    def handle(self, *args, **options):
+        image_ids = GeneratedImage.objects.filter(image='').values_list('id', flat=True)
+        count = 0
+        for image_id in image_ids.iterator():
+            persist_generated_image.delay(image_id)
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f'Queued {count} panels.'))
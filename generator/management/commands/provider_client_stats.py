@@ -0,0 +1,12 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from generator.clients import ConnectionStats
+
+
+class Command(BaseCommand):
+    help = 'Show provider HTTP connection reuse across live worker processes'
+
+    def handle(self, *args, **options):
+        self.stdout.write(json.dumps(ConnectionStats.cluster(), indent=2))
@@ -0,0 +1,23 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from generator.ratelimit import clear_cluster_limiter_stats, cluster_limiter_stats
+
+
+class Command(BaseCommand):
+    help = 'Show provider rate limiter counters, including time spent waiting for the limiter'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset the counters after printing them')
+
+    def handle(self, *args, **options):
+        stats = cluster_limiter_stats()
+        for counters in stats.values():
+            requests = counters['acquired'] + counters['timed_out']
+            counters['mean_wait_seconds'] = round(counters['wait_seconds'] / requests, 4) if requests else None
+        self.stdout.write(json.dumps(stats, indent=2))
+
+        if options['reset']:
+            clear_cluster_limiter_stats()
+            self.stdout.write(self.style.SUCCESS('Counters reset.'))
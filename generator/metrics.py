@@ -0,0 +1,101 @@
+"""
+Prometheus metrics for the generation pipeline, served on /metrics by the web
+process and on WORKER_METRICS_PORT by Celery workers. With several processes
+per host (gunicorn workers, prefork children) set PROMETHEUS_MULTIPROC_DIR to
+an empty directory shared by them so every scrape sees all of their samples.
+"""
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from celery.signals import before_task_publish, task_prerun
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Histogram, multiprocess
+
+from .exceptions import ProviderThrottled
+
+# Stage timed around each provider's calls, rate limiter waits and retries included.
+PROVIDER_STAGES = {
+    'gemini': 'description',
+    'dashscope': 'compose',
+}
+
+STAGE_SECONDS = Histogram(
+    'comic_stage_duration_seconds',
+    'Time spent in a generation stage',
+    ['stage', 'model', 'outcome'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300),
+)
+PROVIDER_ATTEMPTS = Counter(
+    'comic_provider_attempts_total',
+    'Provider requests, counting every retried attempt',
+    ['provider', 'model', 'outcome'],
+)
+LINES_FINISHED = Counter(
+    'comic_lines_finished_total',
+    'Dialogue lines that reached a terminal status',
+    ['outcome'],
+)
+LIMITER_WAIT_SECONDS = Histogram(
+    'comic_rate_limiter_wait_seconds',
+    'Time a provider request waited for the cluster-wide rate limiter',
+    ['provider', 'model', 'outcome'],
+    buckets=(0, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+QUEUE_WAIT_SECONDS = Histogram(
+    'comic_task_queue_wait_seconds',
+    'Time from publishing a task (or its ETA) to a worker starting it',
+    ['task', 'queue'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+
+
+def outcome_of(exc):
+    if exc is None:
+        return 'ok'
+    if isinstance(exc, ProviderThrottled):
+        return 'throttled'
+    return 'error'
+
+
+@contextmanager
+def observe_stage(stage, model=''):
+    """Time the block into STAGE_SECONDS, labelled with how it ended."""
+    started = time.perf_counter()
+    exc = None
+    try:
+        yield
+    except Exception as e:
+        exc = e
+        raise
+    finally:
+        STAGE_SECONDS.labels(stage, model, outcome_of(exc)).observe(time.perf_counter() - started)
+
+
+def registry():
+    """The registry to expose: every process's samples in multiprocess mode, this process's otherwise."""
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return REGISTRY
+    collector_registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collector_registry)
+    return collector_registry
+
+
+@before_task_publish.connect
+def _stamp_published_at(headers=None, **kwargs):
+    # Overwritten on every publish, so a retry measures from its own enqueue.
+    headers['published_at'] = time.time()
+
+
+@task_prerun.connect
+def _observe_queue_wait(task=None, **kwargs):
+    request = task.request
+    published_at = getattr(request, 'published_at', None)
+    if published_at is None:
+        return
+    ready_at = published_at
+    if request.eta:
+        eta = datetime.fromisoformat(request.eta) if isinstance(request.eta, str) else request.eta
+        ready_at = max(ready_at, eta.timestamp())
+    queue = (request.delivery_info or {}).get('routing_key') or ''
+    QUEUE_WAIT_SECONDS.labels(task.name.rsplit('.', 1)[-1], queue).observe(max(0.0, time.time() - ready_at))
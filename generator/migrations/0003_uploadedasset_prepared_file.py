@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 01:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('generator', '0002_uploadedasset'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadedasset',
+            name='prepared_file',
+            field=models.FileField(blank=True, max_length=255, upload_to=''),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2 on 2026-10-18 01:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('generator', '0003_uploadedasset_prepared_file'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='generatedimage',
+            name='image',
+            field=models.FileField(blank=True, max_length=255, upload_to=''),
+        ),
+        migrations.AddField(
+            model_name='generatedimage',
+            name='thumbnails',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2026-10-18 01:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('generator', '0004_generatedimage_image_thumbnails'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='generatedimage',
+            index=models.Index(fields=['user', '-created_at', '-id'], name='generator_image_user_created'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 01:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('generator', '0006_generationjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='generationjob',
+            name='tokens_reserved',
+            field=models.IntegerField(default=0),
+        ),
+    ]
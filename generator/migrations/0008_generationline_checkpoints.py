@@ -0,0 +1,23 @@
+# Generated by Django 4.2 on 2026-10-18 01:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('generator', '0007_generationjob_tokens_reserved'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='generationline',
+            name='description',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='generationline',
+            name='result_url',
+            field=models.URLField(blank=True, max_length=1000),
+        ),
+    ]
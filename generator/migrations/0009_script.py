@@ -0,0 +1,41 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('generator', '0008_generationline_checkpoints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Script',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_hash', models.CharField(max_length=64, unique=True)),
+                ('context', models.TextField()),
+                ('dialogue', models.JSONField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='generatedimage',
+            name='script',
+            field=models.ForeignKey(
+                null=True, on_delete=django.db.models.deletion.PROTECT,
+                related_name='panels', to='generator.script',
+            ),
+        ),
+        # Defaults let the columns be added back to existing rows when migrating backwards.
+        migrations.AlterField(
+            model_name='generatedimage',
+            name='context',
+            field=models.TextField(default=''),
+        ),
+        migrations.AlterField(
+            model_name='generatedimage',
+            name='dialogue',
+            field=models.JSONField(default=list),
+        ),
+    ]
@@ -0,0 +1,50 @@
+import hashlib
+import json
+
+from django.db import migrations
+
+
+def _content_hash(context, dialogue):
+    # Same as generator.models.script_content_hash, frozen for this migration.
+    content = json.dumps([context, dialogue], ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def move_scripts_out_of_panels(apps, schema_editor):
+    """Give every panel the Script row of its context and dialogue, one row per distinct content."""
+    GeneratedImage = apps.get_model('generator', 'GeneratedImage')
+    Script = apps.get_model('generator', 'Script')
+
+    script_ids = dict(Script.objects.values_list('content_hash', 'id'))
+    batch = []
+    panels = GeneratedImage.objects.order_by('id').values_list('id', 'context', 'dialogue')
+    for panel_id, context, dialogue in panels.iterator(chunk_size=1000):
+        content_hash = _content_hash(context, dialogue)
+        if content_hash not in script_ids:
+            script_ids[content_hash] = Script.objects.create(
+                content_hash=content_hash, context=context, dialogue=dialogue,
+            ).id
+        batch.append(GeneratedImage(id=panel_id, script_id=script_ids[content_hash]))
+        if len(batch) >= 1000:
+            GeneratedImage.objects.bulk_update(batch, ['script'])
+            batch = []
+    GeneratedImage.objects.bulk_update(batch, ['script'])
+
+
+def copy_scripts_into_panels(apps, schema_editor):
+    GeneratedImage = apps.get_model('generator', 'GeneratedImage')
+    Script = apps.get_model('generator', 'Script')
+
+    for script_id, context, dialogue in Script.objects.values_list('id', 'context', 'dialogue').iterator():
+        GeneratedImage.objects.filter(script_id=script_id).update(context=context, dialogue=dialogue)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('generator', '0009_script'),
+    ]
+
+    operations = [
+        migrations.RunPython(move_scripts_out_of_panels, copy_scripts_into_panels),
+    ]
@@ -0,0 +1,27 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('generator', '0010_move_scripts_out_of_panels'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='generatedimage',
+            name='context',
+        ),
+        migrations.RemoveField(
+            model_name='generatedimage',
+            name='dialogue',
+        ),
+        migrations.AlterField(
+            model_name='generatedimage',
+            name='script',
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.PROTECT, related_name='panels', to='generator.script',
+            ),
+        ),
+    ]
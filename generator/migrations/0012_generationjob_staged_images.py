@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 02:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('generator', '0011_generatedimage_drop_script_copies'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='generationjob',
+            name='staged_images',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -1,14 +1,55 @@
-from django.db import models
+import hashlib
+import json
+import os
+from collections import Counter
+from django.db import models, transaction, IntegrityError
 from django.contrib.auth.models import User
+from django.core.files.storage import default_storage
+from django.utils import timezone
 
 
-class GeneratedImage(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='generated_images')
+def script_content_hash(context, dialogue):
+    content = json.dumps([context, dialogue], ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class ScriptManager(models.Manager):
+    def for_content(self, context, dialogue):
+        """The Script with this context and dialogue, created on first use."""
+        content_hash = script_content_hash(context, dialogue)
+        script = self.filter(content_hash=content_hash).first()
+        if script:
+            return script
+        try:
+            with transaction.atomic():
+                return self.create(content_hash=content_hash, context=context, dialogue=dialogue)
+        except IntegrityError:
+            # Another worker stored the same script first.
+            return self.get(content_hash=content_hash)
+
+
+class Script(models.Model):
+    """A scene context and its dialogue, stored once and shared by every panel drawn from it."""
+
+    content_hash = models.CharField(max_length=64, unique=True)
     context = models.TextField()
     dialogue = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = ScriptManager()
+
+    def __str__(self):
+        return f"{self.content_hash[:12]} ({len(self.dialogue)} lines)"
+
+
+class GeneratedImage(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='generated_images')
+    script = models.ForeignKey(Script, on_delete=models.PROTECT, related_name='panels')
     target_line = models.CharField(max_length=500)
     speaker = models.CharField(max_length=100)
     image_url = models.URLField(max_length=1000)
+    image = models.FileField(max_length=255, blank=True)
+    thumbnails = models.JSONField(default=dict, blank=True)
     tokens_used = models.IntegerField(default=1)
     subject_description = models.TextField(blank=True)
     setting_and_scene = models.TextField(blank=True)
@@ -17,8 +58,261 @@ class GeneratedImage(models.Model):
     full_image_prompt = models.TextField(blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    # Columns the gallery and dashboard cards render.
+    CARD_FIELDS = ['id', 'speaker', 'target_line', 'tokens_used', 'image', 'image_url', 'thumbnails', 'created_at']
+
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', '-created_at', '-id'], name='generator_image_user_created'),
+        ]
 
     def __str__(self):
         return f"{self.user.username} - {self.speaker} - {self.created_at.strftime('%Y-%m-%d %H:%M')}"
+
+    @property
+    def display_url(self):
+        """The stored panel once persisted, the provider's temporary URL until then."""
+        if self.image:
+            return self.image.url
+        return self.image_url
+
+    @property
+    def thumbnail_url(self):
+        """The smallest thumbnail, for places that show a single small image."""
+        if not self.thumbnails:
+            return self.display_url
+        width = min(self.thumbnails, key=int)
+        return default_storage.url(self.thumbnails[width])
+
+    @property
+    def srcset(self):
+        return ", ".join(
+            f"{default_storage.url(name)} {width}w"
+            for width, name in sorted(self.thumbnails.items(), key=lambda item: int(item[0]))
+        )
+
+
+def uploaded_asset_path(sha256, extension):
+    return f"uploads/{sha256[:2]}/{sha256}{extension}"
+
+
+class UploadedAssetManager(models.Manager):
+    def store(self, upload, refs=1):
+        """
+        Store an uploaded file under its SHA-256 and take ``refs`` references
+        to it. Identical uploads share one blob; only the first one is written.
+        """
+        sha256 = getattr(upload, 'sha256', None)
+        if sha256 is None:
+            digest = hashlib.sha256()
+            for chunk in upload.chunks():
+                digest.update(chunk)
+            sha256 = digest.hexdigest()
+
+        while True:
+            updated = self.filter(sha256=sha256).update(
+                ref_count=models.F('ref_count') + refs,
+                last_used_at=timezone.now(),
+            )
+            if updated:
+                return self.get(sha256=sha256)
+
+            extension = os.path.splitext(upload.name)[1].lower()[:10]
+            name = uploaded_asset_path(sha256, extension)
+            try:
+                with transaction.atomic():
+                    asset = self.create(
+                        sha256=sha256,
+                        file=name,
+                        size=upload.size,
+                        ref_count=refs,
+                    )
+                    if not default_storage.exists(name):
+                        upload.seek(0)
+                        saved_name = default_storage.save(name, upload)
+                        if saved_name != name:
+                            asset.file.name = saved_name
+                            asset.save(update_fields=['file'])
+                return asset
+            except IntegrityError:
+                # Another request stored the same content first; take a reference to it instead.
+                continue
+
+    def release(self, asset_ids, refs=1):
+        # The same asset can appear more than once, e.g. one image used for two characters.
+        for asset_id, count in Counter(asset_ids).items():
+            self.filter(id=asset_id).update(ref_count=models.F('ref_count') - refs * count)
+
+
+class UploadedAsset(models.Model):
+    """A user-uploaded reference image, stored once per distinct content."""
+
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.FileField(max_length=255)
+    prepared_file = models.FileField(max_length=255, blank=True)
+    size = models.BigIntegerField(default=0)
+    ref_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(default=timezone.now)
+
+    objects = UploadedAssetManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['ref_count', 'last_used_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.sha256[:12]} ({self.ref_count} refs)"
+
+    @property
+    def path(self):
+        return self.file.path
+
+    @property
+    def reference_path(self):
+        """The file to send to the image model: the preprocessed copy when there is one."""
+        if self.prepared_file:
+            return self.prepared_file.path
+        return self.file.path
+
+
+class GenerationJob(models.Model):
+    """One submitted script: owns its dialogue lines and tracks their progress."""
+
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='generation_jobs')
+    context = models.TextField()
+    dialogue = models.JSONField()
+    characters = models.JSONField(default=list)
+    background_image_path = models.CharField(max_length=500)
+    asset_ids = models.JSONField(default=list)
+    # Reference image path -> provider handle, filled in by dispatch_generation.
+    staged_images = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    total_lines = models.IntegerField(default=0)
+    tokens_reserved = models.IntegerField(default=0)
+    completed_lines = models.IntegerField(default=0)
+    failed_lines = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', '-created_at'], name='generator_job_user_created'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} - job {self.id} - {self.status}"
+
+    @property
+    def progress(self):
+        if not self.total_lines:
+            return 0
+        return round(100 * (self.completed_lines + self.failed_lines) / self.total_lines)
+
+    def progress_snapshot(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'total_lines': self.total_lines,
+            'completed_lines': self.completed_lines,
+            'failed_lines': self.failed_lines,
+            'progress': self.progress,
+            'finished': self.finished_at is not None,
+        }
+
+    @classmethod
+    def record_line_result(cls, job_id, succeeded):
+        return cls.record_line_results(job_id, completed=1 if succeeded else 0, failed=0 if succeeded else 1)
+
+    @classmethod
+    def record_line_results(cls, job_id, completed=0, failed=0):
+        """
+        Count finished lines with a single UPDATE. Returns True for the one
+        caller whose lines complete the job; that caller releases the job's uploads.
+        """
+        now = timezone.now()
+        cls.objects.filter(pk=job_id).update(
+            completed_lines=models.F('completed_lines') + completed,
+            failed_lines=models.F('failed_lines') + failed,
+            updated_at=now,
+        )
+
+        finished = cls.objects.filter(
+            pk=job_id,
+            finished_at__isnull=True,
+            total_lines__lte=models.F('completed_lines') + models.F('failed_lines'),
+        ).update(
+            status=models.Case(
+                models.When(completed_lines=0, then=models.Value('failed')),
+                default=models.Value('completed'),
+            ),
+            finished_at=now,
+            updated_at=now,
+        )
+        if finished:
+            asset_ids = cls.objects.filter(pk=job_id).values_list('asset_ids', flat=True).first()
+            UploadedAsset.objects.release(asset_ids or [])
+        return bool(finished)
+
+
+class GenerationLine(models.Model):
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('describing', 'Describing'),
+        ('composing', 'Composing'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+    TERMINAL_STATUSES = ('done', 'failed')
+
+    job = models.ForeignKey(GenerationJob, on_delete=models.CASCADE, related_name='lines')
+    index = models.IntegerField()
+    text = models.CharField(max_length=500)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    error = models.TextField(blank=True)
+    # Stage checkpoints: a retried or redelivered stage resumes from these instead of calling the provider again.
+    description = models.JSONField(null=True, blank=True)
+    result_url = models.URLField(max_length=1000, blank=True)
+    generated_image = models.OneToOneField(
+        GeneratedImage, on_delete=models.SET_NULL, null=True, blank=True, related_name='generation_line'
+    )
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['index']
+        constraints = [
+            models.UniqueConstraint(fields=['job', 'index'], name='generator_line_job_index'),
+        ]
+
+    def __str__(self):
+        return f"job {self.job_id} line {self.index} - {self.status}"
+
+    @classmethod
+    def set_status(cls, line_ids, status, **fields):
+        if not isinstance(line_ids, (list, tuple)):
+            line_ids = [line_ids]
+        cls.objects.filter(pk__in=line_ids).update(status=status, updated_at=timezone.now(), **fields)
+
+    @classmethod
+    def finish(cls, line_id, status, **fields):
+        """
+        Move a line to a terminal status unless it already is in one. Returns
+        True for the single caller that finished it, so a redelivered task
+        never refunds or counts the same line twice.
+        """
+        return bool(
+            cls.objects.filter(pk=line_id)
+            .exclude(status__in=cls.TERMINAL_STATUSES)
+            .update(status=status, updated_at=timezone.now(), **fields)
+        )
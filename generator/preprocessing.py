@@ -0,0 +1,78 @@
+import io
+import os
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+
+def prepared_image_name(original_name, max_size):
+    base, _ = os.path.splitext(original_name)
+    return f"{base}.w{max_size}.webp"
+
+
+def prepare_reference_image(asset):
+    """
+    Right-size an uploaded reference image before it is sent to the image model:
+    apply the EXIF orientation, downscale to REFERENCE_IMAGE_MAX_SIZE, drop all
+    metadata and re-encode as WebP. The result is stored next to the original
+    and recorded on the asset, so each distinct upload is processed only once.
+    """
+    max_size = settings.REFERENCE_IMAGE_MAX_SIZE
+    name = prepared_image_name(asset.file.name, max_size)
+    if asset.prepared_file.name == name and default_storage.exists(name):
+        return asset
+
+    if not default_storage.exists(name):
+        try:
+            with default_storage.open(asset.file.name, 'rb') as original:
+                image = Image.open(original)
+                image = ImageOps.exif_transpose(image)
+                image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+                has_alpha = image.mode in ('RGBA', 'LA') or 'transparency' in image.info
+                image = image.convert('RGBA' if has_alpha else 'RGB')
+
+                buffer = io.BytesIO()
+                # A fresh save without exif/icc_profile arguments writes no metadata, so the
+                # copy is used even when it is not smaller than the original (EXIF may hold GPS).
+                image.save(buffer, 'WEBP', quality=settings.REFERENCE_IMAGE_QUALITY, method=4)
+        except Exception as e:
+            print(f"Could not preprocess {asset.file.name}, using the original: {e}")
+            return asset
+
+        saved_name = default_storage.save(name, ContentFile(buffer.getvalue()))
+        if saved_name != name:
+            # Another request prepared the same image concurrently; keep the canonical copy.
+            default_storage.delete(saved_name)
+
+    asset.prepared_file.name = name
+    asset.save(update_fields=['prepared_file'])
+    return asset
+
+
+def create_thumbnails(image_bytes, base_name, widths=None):
+    """
+    Write WebP thumbnails of a generated panel at each of ``widths`` and
+    return them as {str(width): storage name}. Widths larger than the panel
+    itself are skipped, except that at least one thumbnail is always written.
+    """
+    widths = sorted(widths or settings.PANEL_THUMBNAIL_WIDTHS)
+    image = Image.open(io.BytesIO(image_bytes))
+    has_alpha = image.mode in ('RGBA', 'LA') or 'transparency' in image.info
+    image = image.convert('RGBA' if has_alpha else 'RGB')
+
+    thumbnails = {}
+    for width in widths:
+        if width > image.width and thumbnails:
+            break
+        width = min(width, image.width)
+        height = max(1, round(image.height * width / image.width))
+        buffer = io.BytesIO()
+        image.resize((width, height), Image.Resampling.LANCZOS).save(
+            buffer, 'WEBP', quality=settings.PANEL_THUMBNAIL_QUALITY, method=4
+        )
+        name = f"{base_name}.w{width}.webp"
+        default_storage.delete(name)
+        thumbnails[str(width)] = default_storage.save(name, ContentFile(buffer.getvalue()))
+    return thumbnails
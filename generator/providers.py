@@ -0,0 +1,488 @@
+import json
+import time
+import dashscope
+import httpx
+from dashscope.utils.oss_utils import OssUtils
+from google.genai import errors as genai_errors
+from google.genai import types
+from django.conf import settings
+from django.core.cache import cache
+from pydantic import BaseModel, Field
+from tenacity import (
+    AsyncRetrying,
+    Retrying,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+from .cache import description_cache
+from .exceptions import ProviderError, ProviderThrottled, RetryableProviderError
+from .clients import provider_clients
+from .metrics import PROVIDER_ATTEMPTS, PROVIDER_STAGES, observe_stage, outcome_of
+from .ratelimit import get_rate_limiter
+
+dashscope.base_http_api_url = settings.DASHSCOPE_BASE_URL
+
+# Bump whenever the prompts or schemas change so cached descriptions are not reused.
+PROMPT_VERSION = 1
+
+# A powerful model for the complex reasoning of scene descriptions.
+DESCRIPTION_MODEL = 'gemini-2.5-flash'
+IMAGE_EDIT_MODEL = 'qwen-image-edit'
+
+
+def _provider_retrying(retrying_class, provider):
+    return retrying_class(
+        retry=retry_if_exception_type(RetryableProviderError),
+        wait=wait_random_exponential(multiplier=1, max=settings.PROVIDER_BACKOFF_MAX_SECONDS),
+        stop=stop_after_attempt(settings.PROVIDER_MAX_ATTEMPTS[provider]),
+        reraise=True,
+    )
+
+
+def call_provider(provider, model_name, call):
+    """
+    Run ``call`` under the cluster-wide rate limiter for ``provider``/``model_name``.
+    Throttling responses shrink the shared rate; retryable failures are retried
+    here with jittered exponential backoff before being raised to the caller.
+    The whole call is timed as the provider's stage and each attempt counted.
+    """
+    limiter = get_rate_limiter(provider, model_name)
+    with observe_stage(PROVIDER_STAGES[provider], model_name):
+        for attempt in _provider_retrying(Retrying, provider):
+            with attempt:
+                limiter.acquire()
+                try:
+                    result = call()
+                except Exception as e:
+                    PROVIDER_ATTEMPTS.labels(provider, model_name, outcome_of(e)).inc()
+                    if isinstance(e, ProviderThrottled):
+                        limiter.throttled()
+                    raise
+                PROVIDER_ATTEMPTS.labels(provider, model_name, 'ok').inc()
+                return result
+
+
+async def acall_provider(provider, model_name, call):
+    """call_provider() for coroutines: ``call`` returns an awaitable."""
+    limiter = get_rate_limiter(provider, model_name)
+    with observe_stage(PROVIDER_STAGES[provider], model_name):
+        async for attempt in _provider_retrying(AsyncRetrying, provider):
+            with attempt:
+                await limiter.aacquire()
+                try:
+                    result = await call()
+                except Exception as e:
+                    PROVIDER_ATTEMPTS.labels(provider, model_name, outcome_of(e)).inc()
+                    if isinstance(e, ProviderThrottled):
+                        await limiter.athrottled()
+                    raise
+                PROVIDER_ATTEMPTS.labels(provider, model_name, 'ok').inc()
+                return result
+
+
+def _raise_for_gemini_error(e):
+    if e.code == 429 or e.code >= 500:
+        raise ProviderThrottled(f"Gemini returned {e.code}: {e.message}") from e
+    raise e
+
+
+def _generate_content(client, model_name, contents, config):
+    def call():
+        try:
+            return client.models.generate_content(model=model_name, contents=contents, config=config)
+        except genai_errors.APIError as e:
+            _raise_for_gemini_error(e)
+    return call_provider('gemini', model_name, call)
+
+
+async def _agenerate_content(client, model_name, contents, config):
+    async def call():
+        try:
+            return await client.aio.models.generate_content(model=model_name, contents=contents, config=config)
+        except genai_errors.APIError as e:
+            _raise_for_gemini_error(e)
+    return await acall_provider('gemini', model_name, call)
+
+
+class ImagePrompt(BaseModel):
+    subject_description: str = Field(
+        ...,
+        description="Detailed description of the character speaking the line, including mood, attire, and physical posture."
+    )
+    setting_and_scene: str = Field(
+        ...,
+        description="The environment, lighting, time of day, and general atmosphere surrounding the character and the dialogue."
+    )
+    action_or_expression: str = Field(
+        ...,
+        description="The specific action, facial expression, or emotional intensity captured in the moment the line is delivered."
+    )
+    camera_and_style: str = Field(
+        ...,
+        description="Recommended artistic style (e.g., cinematic, watercolor), camera angle (e.g., close-up, wide shot), and general visual mood."
+    )
+    full_image_prompt: str = Field(
+        ...,
+        description="A single, cohesive, highly detailed prompt combining all elements, optimized for image generation."
+    )
+
+
+class LineImagePrompt(ImagePrompt):
+    line_index: int = Field(
+        ...,
+        description="The number of the dialogue line this description visualizes, exactly as numbered in the request."
+    )
+
+
+class DialogueImagePrompts(BaseModel):
+    panels: list[LineImagePrompt] = Field(
+        ...,
+        description="One image description per requested dialogue line."
+    )
+
+
+SYSTEM_INSTRUCTION = (
+    "You are an expert visual storyteller and image prompt generator. Your task is to take a piece of dialogue "
+    "and its context, and produce a highly detailed, cinematic description suitable for a text-to-image AI. "
+    "Focus on the moment the target line is delivered. The main focus should be the speaking character, but "
+    "include other relevant characters if their presence enhances the visual storytelling. Depict the atmosphere, "
+    "lighting, and emotional tone naturally. Occasionally (about 40% of the time), widen the scene to include "
+    "both the speaker and other characters. Return a JSON object with these fields: subject_description, "
+    "setting_and_scene, action_or_expression, camera_and_style, full_image_prompt."
+)
+
+
+def _description_prompt(context, dialogue, target_line):
+    return f"""{SYSTEM_INSTRUCTION}
+
+    CONTEXT: {context}
+
+    FULL DIALOGUE:
+    {chr(10).join(dialogue)}
+
+    TARGET LINE TO VISUALIZE:
+    "{target_line}"
+
+    Analyze the target line and the full situation. Describe the moment the line is delivered,
+    including the speaker and any other characters visible or reacting in the same frame.
+    Capture emotional tension, lighting, and the spatial relationship between characters.
+    Generate the structured JSON response.
+    """
+
+
+def _dialogue_descriptions_prompt(context, dialogue, line_indices):
+    numbered_dialogue = "\n".join(f"{i}. {line}" for i, line in enumerate(dialogue))
+    target_numbers = ", ".join(str(i) for i in line_indices)
+
+    return f"""{SYSTEM_INSTRUCTION}
+
+    CONTEXT: {context}
+
+    FULL DIALOGUE (numbered):
+    {numbered_dialogue}
+
+    LINES TO VISUALIZE: {target_numbers}
+
+    For each listed line, describe the moment that line is delivered, including the speaker and
+    any other characters visible or reacting in the same frame. Capture emotional tension, lighting,
+    and the spatial relationship between characters, and keep characters and setting consistent
+    from one panel to the next. Return one entry in "panels" per listed line, with its line_index.
+    """
+
+
+def _description_config(schema):
+    return types.GenerateContentConfig(
+        system_instruction=SYSTEM_INSTRUCTION,
+        response_mime_type="application/json",
+        response_schema=schema,
+    )
+
+
+def _gemini_client():
+    """The process's Gemini client, or None when it cannot be built."""
+    try:
+        return provider_clients.gemini()
+    except Exception as e:
+        print(f"Error initializing client. Ensure GEMINI_API_KEY is set. Details: {e}")
+        return None
+
+
+def _cached_description(context, dialogue, target_line, model_name):
+    """The description cache key of one line, and its cached description if there is one."""
+    cache_key = description_cache.make_key(context, dialogue, target_line, model_name, PROMPT_VERSION)
+    return cache_key, description_cache.get(cache_key)
+
+
+def _description_request(context, dialogue, target_line):
+    return {
+        'contents': _description_prompt(context, dialogue, target_line),
+        'config': _description_config(ImagePrompt),
+    }
+
+
+def _parse_description(response, cache_key):
+    # The response.text is a strict JSON string due to response_mime_type
+    image_data = json.loads(response.text)
+    description_cache.set(cache_key, image_data)
+    return image_data
+
+
+def _cached_descriptions(context, dialogue, line_indices, model_name):
+    """Split the requested lines into cached descriptions and lines still to describe."""
+    descriptions = {}
+    cache_keys = {}
+    for index in line_indices:
+        cache_keys[index], cached = _cached_description(context, dialogue, dialogue[index], model_name)
+        if cached:
+            descriptions[index] = cached
+    missing = [index for index in line_indices if index not in descriptions]
+    return descriptions, cache_keys, missing
+
+
+def _descriptions_request(context, dialogue, line_indices):
+    return {
+        'contents': _dialogue_descriptions_prompt(context, dialogue, line_indices),
+        'config': _description_config(DialogueImagePrompts),
+    }
+
+
+def _collect_panels(response, missing, cache_keys, descriptions):
+    wanted = set(missing)
+    for panel in json.loads(response.text).get('panels', []):
+        index = panel.pop('line_index', None)
+        if index in wanted:
+            descriptions[index] = panel
+            description_cache.set(cache_keys[index], panel)
+    return descriptions
+
+
+def create_image_description_from_dialogue(
+    context: str,
+    dialogue: list[str],
+    target_line: str,
+    model_name: str = DESCRIPTION_MODEL
+) -> dict:
+    """
+    Generates a structured image description based on a specific line of dialogue,
+    using the surrounding context and full conversation.
+    """
+    cache_key, cached = _cached_description(context, dialogue, target_line, model_name)
+    if cached:
+        return cached
+    client = _gemini_client()
+    if client is None:
+        return {}
+
+    try:
+        response = _generate_content(client, model_name, **_description_request(context, dialogue, target_line))
+        return _parse_description(response, cache_key)
+    except Exception as e:
+        print(f"An error occurred during the API call: {e}")
+        return {}
+
+
+async def acreate_image_description_from_dialogue(
+    context: str,
+    dialogue: list[str],
+    target_line: str,
+    model_name: str = DESCRIPTION_MODEL
+) -> dict:
+    """create_image_description_from_dialogue() on genai's async client."""
+    cache_key, cached = _cached_description(context, dialogue, target_line, model_name)
+    if cached:
+        return cached
+    client = _gemini_client()
+    if client is None:
+        return {}
+
+    try:
+        response = await _agenerate_content(client, model_name, **_description_request(context, dialogue, target_line))
+        return _parse_description(response, cache_key)
+    except Exception as e:
+        print(f"An error occurred during the API call: {e}")
+        return {}
+
+
+def create_image_descriptions_for_dialogue(
+    context: str,
+    dialogue: list[str],
+    line_indices: list[int] | None = None,
+    model_name: str = DESCRIPTION_MODEL
+) -> dict[int, dict]:
+    """
+    Generates structured image descriptions for several dialogue lines in a
+    single call, sending the context and full conversation only once.
+
+    Returns a mapping of line index to description. Lines the model skipped
+    are missing from the mapping so callers can fall back to the per-line call.
+    """
+    if line_indices is None:
+        line_indices = list(range(len(dialogue)))
+    descriptions, cache_keys, missing = _cached_descriptions(context, dialogue, line_indices, model_name)
+    if not missing:
+        return descriptions
+    client = _gemini_client()
+    if client is None:
+        return descriptions
+
+    try:
+        response = _generate_content(client, model_name, **_descriptions_request(context, dialogue, missing))
+        return _collect_panels(response, missing, cache_keys, descriptions)
+    except Exception as e:
+        print(f"An error occurred during the API call: {e}")
+        return descriptions
+
+
+async def acreate_image_descriptions_for_dialogue(
+    context: str,
+    dialogue: list[str],
+    line_indices: list[int] | None = None,
+    model_name: str = DESCRIPTION_MODEL
+) -> dict[int, dict]:
+    """create_image_descriptions_for_dialogue() on genai's async client."""
+    if line_indices is None:
+        line_indices = list(range(len(dialogue)))
+    descriptions, cache_keys, missing = _cached_descriptions(context, dialogue, line_indices, model_name)
+    if not missing:
+        return descriptions
+    client = _gemini_client()
+    if client is None:
+        return descriptions
+
+    try:
+        response = await _agenerate_content(client, model_name, **_descriptions_request(context, dialogue, missing))
+        return _collect_panels(response, missing, cache_keys, descriptions)
+    except Exception as e:
+        print(f"An error occurred during the API call: {e}")
+        return descriptions
+
+
+def stage_reference_image(
+    path: str,
+    content_key: str,
+    model_name: str = IMAGE_EDIT_MODEL
+) -> dict | None:
+    """
+    Uploads a local reference image to the provider's temporary storage once
+    and returns its handle ({'url': 'oss://...', 'expires_at': epoch seconds}).
+    Handles are cached by ``content_key`` (derived from the content hash), so
+    every line of every job using the same image reuses one upload until it expires.
+    """
+    cache_key = f"provider-upload:{model_name}:{content_key}"
+    try:
+        handle = cache.get(cache_key)
+    except Exception as e:
+        print(f"Provider upload cache read failed: {e}")
+        handle = None
+    if handle and handle['expires_at'] > time.time() + settings.PROVIDER_UPLOAD_MIN_REMAINING:
+        return handle
+
+    try:
+        url = OssUtils.upload(model=model_name, file_path=path, api_key=settings.IMG_API_KEY)
+    except Exception as e:
+        print(f"Failed to stage {path} with the image provider: {e}")
+        return None
+
+    handle = {'url': url, 'expires_at': time.time() + settings.PROVIDER_UPLOAD_TTL}
+    try:
+        cache.set(cache_key, handle, timeout=settings.PROVIDER_UPLOAD_TTL - settings.PROVIDER_UPLOAD_MIN_REMAINING)
+    except Exception as e:
+        print(f"Provider upload cache write failed: {e}")
+    return handle
+
+
+def resolve_reference_image(path: str, staged_images: dict | None) -> str:
+    """Returns the staged remote URL for a local image while it is still valid, else the path itself."""
+    handle = (staged_images or {}).get(path)
+    if handle and handle['expires_at'] > time.time() + settings.PROVIDER_UPLOAD_MIN_REMAINING:
+        return handle['url']
+    return path
+
+
+def _compose_messages(characters, background_image_path, image_data, target_line, staged_images):
+    speaker = target_line.split(":")[0].strip() if ":" in target_line else "Unknown"
+
+    images_desc = ", ".join([f'{c["name"]}' for c in characters])
+    pr1 = f"You are given several images: {images_desc}, and one background image showing scene."
+    pr2 = f"Create a comic-style scene showing the moment when {speaker} says his line."
+    pr3 = f"Add an empty speech bubble above {speaker} (no text)."
+    pr4 = "Ensure characters appear natural in the scene and maintain their visual style."
+    scene_text = pr1 + "\n" + json.dumps(image_data, indent=2) + "\n" + pr2 + "\n" + pr3 + "\n" + pr4
+
+    message_content = []
+    for char in characters:
+        message_content.append({"image": resolve_reference_image(char["path"], staged_images)})
+    message_content.append({"image": resolve_reference_image(background_image_path, staged_images)})
+    message_content.append({"text": scene_text})
+    return [{"role": "user", "content": message_content}]
+
+
+def _compose_result(response):
+    if response.status_code == 429 or response.status_code >= 500:
+        raise ProviderThrottled(f"API failed with status {response.status_code}")
+    if response.status_code != 200:
+        raise ProviderError(f"API failed with status {response.status_code}")
+    return response.output['choices'][0]['message']['content'][0]['image']
+
+
+COMPOSE_OPTIONS = {
+    'watermark': False,
+    'negative_prompt': "low quality, distorted face, messy text",
+}
+
+
+def _compose_request(characters, background_image_path, image_data, target_line, staged_images, model_name):
+    return {
+        'model': model_name,
+        'messages': _compose_messages(characters, background_image_path, image_data, target_line, staged_images),
+        **COMPOSE_OPTIONS,
+    }
+
+
+def compose_comic_panel(
+    characters: list[dict],
+    background_image_path: str,
+    image_data: dict,
+    target_line: str,
+    staged_images: dict | None = None,
+    model_name: str = IMAGE_EDIT_MODEL
+) -> str:
+    """
+    Composes the comic panel for one line from the reference images and its
+    scene description. Returns the provider's (temporary) result URL.
+    """
+    request = _compose_request(characters, background_image_path, image_data, target_line, staged_images, model_name)
+
+    def call():
+        try:
+            response = provider_clients.dashscope().multimodal_generation(**request)
+        except httpx.TransportError as e:
+            raise RetryableProviderError(f"Image API call failed: {e}") from e
+        return _compose_result(response)
+
+    return call_provider('dashscope', model_name, call)
+
+
+async def acompose_comic_panel(
+    characters: list[dict],
+    background_image_path: str,
+    image_data: dict,
+    target_line: str,
+    staged_images: dict | None = None,
+    model_name: str = IMAGE_EDIT_MODEL
+) -> str:
+    """
+    compose_comic_panel() on the pooled async HTTP client. Reference images
+    should already be staged: unstaged local files are uploaded in a thread.
+    """
+    request = _compose_request(characters, background_image_path, image_data, target_line, staged_images, model_name)
+
+    async def call():
+        try:
+            response = await provider_clients.dashscope().amultimodal_generation(**request)
+        except httpx.TransportError as e:
+            raise RetryableProviderError(f"Image API call failed: {e}") from e
+        return _compose_result(response)
+
+    return await acall_provider('dashscope', model_name, call)
@@ -0,0 +1,261 @@
+import asyncio
+import threading
+import time
+import weakref
+
+import redis
+import redis.asyncio
+from django.conf import settings
+
+from .exceptions import RetryableProviderError
+from .metrics import LIMITER_WAIT_SECONDS
+
+# Token bucket with an adaptive rate, evaluated atomically in Redis so every
+# worker draws from the same bucket. Times come from the Redis server clock.
+#
+# The bucket refills at rate * factor tokens per second. A throttling response
+# halves factor (down to MIN_FACTOR) and blocks the bucket for a while; factor
+# then recovers linearly, so the cluster settles just under the provider's quota.
+#
+# Returns the number of seconds to wait, as a string (0 means a token was taken).
+ACQUIRE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local recovery = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'factor', 'blocked_until')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+local factor = tonumber(state[3]) or 1
+local blocked_until = tonumber(state[4]) or 0
+local elapsed = math.max(0, now - ts)
+factor = math.min(1, factor + elapsed * recovery)
+tokens = math.min(burst, tokens + elapsed * rate * factor)
+local wait = 0
+if blocked_until > now then
+    wait = blocked_until - now
+elseif tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / (rate * factor)
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now, 'factor', factor)
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(wait)
+"""
+
+THROTTLE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local min_factor = tonumber(ARGV[1])
+local block = tonumber(ARGV[2])
+local state = redis.call('HMGET', KEYS[1], 'factor', 'blocked_until')
+local factor = math.max(min_factor, (tonumber(state[1]) or 1) / 2)
+local blocked_until = math.max(tonumber(state[2]) or 0, now + block)
+redis.call('HSET', KEYS[1], 'factor', factor, 'blocked_until', blocked_until, 'tokens', 0, 'ts', now)
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(factor)
+"""
+
+
+class ProviderRateLimiter:
+    """
+    Cluster-wide request limiter for one provider model. Every worker calls
+    acquire() before a request and throttled() when the provider answers 429
+    or 5xx. Wait time is counted per process and in Redis.
+    """
+
+    KEY_PREFIX = 'ratelimit'
+    STATS_FIELDS = ('acquired', 'timed_out', 'waited', 'wait_seconds', 'throttled')
+    MIN_FACTOR = 0.1
+
+    def __init__(self, provider, model, requests_per_minute, burst=None):
+        self.provider = provider
+        self.model = model
+        self.rate = requests_per_minute / 60
+        self.burst = burst or max(1, round(self.rate))
+        self.key = f"{self.KEY_PREFIX}:{provider}:{model}"
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(self.STATS_FIELDS, 0)
+
+    def acquire(self, timeout=None):
+        """
+        Block until a request may be sent. Returns the seconds spent waiting;
+        raises RetryableProviderError if no token came up within ``timeout``.
+        """
+        timeout = timeout if timeout is not None else settings.PROVIDER_RATE_LIMIT_TIMEOUT
+        waited = 0.0
+        while True:
+            try:
+                wait = float(_get_client().eval(
+                    ACQUIRE_SCRIPT, 1, self.key,
+                    self.rate, self.burst, settings.PROVIDER_RATE_RECOVERY,
+                ))
+            except redis.RedisError as e:
+                # Without Redis there is no shared bucket; let the request through.
+                print(f"Rate limiter for {self.key} unavailable: {e}")
+                wait = 0.0
+            if wait <= 0:
+                break
+            if waited >= timeout:
+                self._record(waited, 'timeout')
+                raise self._timed_out(waited)
+            wait = min(wait, timeout - waited)
+            time.sleep(wait)
+            waited += wait
+        self._record(waited)
+        return waited
+
+    async def aacquire(self, timeout=None):
+        """acquire() for event loops: waits with asyncio.sleep instead of blocking the thread."""
+        timeout = timeout if timeout is not None else settings.PROVIDER_RATE_LIMIT_TIMEOUT
+        waited = 0.0
+        while True:
+            try:
+                wait = float(await _get_async_client().eval(
+                    ACQUIRE_SCRIPT, 1, self.key,
+                    self.rate, self.burst, settings.PROVIDER_RATE_RECOVERY,
+                ))
+            except redis.RedisError as e:
+                print(f"Rate limiter for {self.key} unavailable: {e}")
+                wait = 0.0
+            if wait <= 0:
+                break
+            if waited >= timeout:
+                await self._arecord(waited, 'timeout')
+                raise self._timed_out(waited)
+            wait = min(wait, timeout - waited)
+            await asyncio.sleep(wait)
+            waited += wait
+        await self._arecord(waited)
+        return waited
+
+    def throttled(self, retry_after=None):
+        """Shrink the shared rate after a 429/5xx and hold every worker off for a moment."""
+        block = retry_after if retry_after is not None else settings.PROVIDER_THROTTLE_BLOCK_SECONDS
+        with self.lock:
+            self.counters['throttled'] += 1
+        try:
+            client = _get_client()
+            client.eval(THROTTLE_SCRIPT, 1, self.key, self.MIN_FACTOR, block)
+            client.hincrby(f"{self.KEY_PREFIX}:stats:{self.provider}:{self.model}", 'throttled', 1)
+        except redis.RedisError as e:
+            print(f"Could not record throttling for {self.key}: {e}")
+
+    async def athrottled(self, retry_after=None):
+        block = retry_after if retry_after is not None else settings.PROVIDER_THROTTLE_BLOCK_SECONDS
+        with self.lock:
+            self.counters['throttled'] += 1
+        try:
+            client = _get_async_client()
+            await client.eval(THROTTLE_SCRIPT, 1, self.key, self.MIN_FACTOR, block)
+            await client.hincrby(f"{self.KEY_PREFIX}:stats:{self.provider}:{self.model}", 'throttled', 1)
+        except redis.RedisError as e:
+            print(f"Could not record throttling for {self.key}: {e}")
+
+    def _timed_out(self, waited):
+        return RetryableProviderError(f"Rate limiter for {self.key} gave no token within {waited:.1f}s")
+
+    def _count(self, waited, outcome):
+        LIMITER_WAIT_SECONDS.labels(self.provider, self.model, outcome).observe(waited)
+        with self.lock:
+            self.counters['acquired' if outcome == 'ok' else 'timed_out'] += 1
+            if waited:
+                self.counters['waited'] += 1
+                self.counters['wait_seconds'] += waited
+
+    def _stats_pipeline(self, pipe, waited, outcome):
+        stats_key = f"{self.KEY_PREFIX}:stats:{self.provider}:{self.model}"
+        pipe.hincrby(stats_key, 'acquired' if outcome == 'ok' else 'timed_out', 1)
+        if waited:
+            pipe.hincrby(stats_key, 'waited', 1)
+            pipe.hincrbyfloat(stats_key, 'wait_seconds', waited)
+        return pipe
+
+    def _record(self, waited, outcome='ok'):
+        self._count(waited, outcome)
+        try:
+            self._stats_pipeline(_get_client().pipeline(), waited, outcome).execute()
+        except redis.RedisError:
+            pass
+
+    async def _arecord(self, waited, outcome='ok'):
+        self._count(waited, outcome)
+        try:
+            await self._stats_pipeline(_get_async_client().pipeline(), waited, outcome).execute()
+        except redis.RedisError:
+            pass
+
+    def stats(self):
+        """Limiter counters for this process and, when reachable, the whole cluster."""
+        with self.lock:
+            local = dict(self.counters)
+        try:
+            raw = _get_client().hgetall(f"{self.KEY_PREFIX}:stats:{self.provider}:{self.model}")
+            cluster = {name: float(raw.get(name.encode(), 0)) for name in self.STATS_FIELDS}
+        except redis.RedisError:
+            cluster = None
+        return {'process': local, 'cluster': cluster}
+
+    def clear_stats(self):
+        with self.lock:
+            self.counters = dict.fromkeys(self.STATS_FIELDS, 0)
+        _get_client().delete(f"{self.KEY_PREFIX}:stats:{self.provider}:{self.model}")
+
+
+_client = None
+# redis.asyncio connections belong to the loop that opened them.
+_async_clients = weakref.WeakKeyDictionary()
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def _get_client():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.REDIS_URL)
+    return _client
+
+
+def _get_async_client():
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = redis.asyncio.Redis.from_url(settings.REDIS_URL)
+    return client
+
+
+def get_rate_limiter(provider, model):
+    """The shared limiter for a provider model, configured from PROVIDER_RATE_LIMITS."""
+    with _limiters_lock:
+        limiter = _limiters.get((provider, model))
+        if limiter is None:
+            limits = settings.PROVIDER_RATE_LIMITS[provider]
+            limiter = ProviderRateLimiter(
+                provider, model,
+                requests_per_minute=limits.get(model, limits['default']),
+                burst=limits.get('burst'),
+            )
+            _limiters[(provider, model)] = limiter
+        return limiter
+
+
+def cluster_limiter_stats():
+    """Counters of every limiter that has been used anywhere in the cluster, keyed by provider:model."""
+    client = _get_client()
+    prefix = f"{ProviderRateLimiter.KEY_PREFIX}:stats:"
+    stats = {}
+    for key in client.scan_iter(match=f"{prefix}*"):
+        raw = client.hgetall(key)
+        stats[key.decode().removeprefix(prefix)] = {
+            name: float(raw.get(name.encode(), 0)) for name in ProviderRateLimiter.STATS_FIELDS
+        }
+    return stats
+
+
+def clear_cluster_limiter_stats():
+    client = _get_client()
+    keys = list(client.scan_iter(match=f"{ProviderRateLimiter.KEY_PREFIX}:stats:*"))
+    if keys:
+        client.delete(*keys)
@@ -0,0 +1,189 @@
+"""
+Fair admission of generation lines. Instead of pushing every line of a job
+onto the Celery queues at once (where a 200-line script sits in front of
+everyone else's single panel), jobs are registered here and their lines are
+started a few at a time: round-robin across users, and across each user's
+jobs, with a cap on how many lines a user, and the whole cluster, may have in
+flight. Users who bought a priority package are served from their own lane
+first on most turns.
+
+In-flight slots are leases in Redis sorted sets (member = line id, score =
+expiry), so a line whose worker died frees its slot after
+SCHEDULER_LEASE_SECONDS even if release() is never called.
+"""
+import redis
+from django.conf import settings
+
+# Register lines of a job and put the job in its user's rotation and the user in
+# their lane. ARGV: prefix, user, job, lane, other lane, user limit, then the line ids.
+SUBMIT_SCRIPT = """
+local prefix = ARGV[1]
+local user_key = prefix .. ':user:' .. ARGV[2]
+local job_key = prefix .. ':job:' .. ARGV[3]
+local lane = prefix .. ':lane:' .. ARGV[4]
+redis.call('RPUSH', job_key, unpack(ARGV, 7))
+redis.call('HSET', user_key, 'limit', ARGV[6])
+if not redis.call('LPOS', user_key .. ':jobs', ARGV[3]) then
+    redis.call('RPUSH', user_key .. ':jobs', ARGV[3])
+end
+redis.call('LREM', prefix .. ':lane:' .. ARGV[5], 0, ARGV[2])
+if not redis.call('LPOS', lane, ARGV[2]) then
+    redis.call('RPUSH', lane, ARGV[2])
+end
+return redis.call('LLEN', job_key)
+"""
+
+# Take up to ARGV[4] lines of one job for the next user in turn who has a free
+# slot, and lease the slots. Users and jobs are rotated to the back of their
+# list when visited, which makes the order round-robin. The priority lane is
+# tried first except on every (weight + 1)-th turn, so standard users are never
+# starved. ARGV: prefix, lease seconds, cluster limit (0 = none), max lines, weight.
+#
+# Returns {user, job, {line ids}} or nil when nothing may start.
+NEXT_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local prefix = ARGV[1]
+local deadline = now + tonumber(ARGV[2])
+local cluster_limit = tonumber(ARGV[3])
+local weight = tonumber(ARGV[5])
+local running = prefix .. ':running'
+redis.call('ZREMRANGEBYSCORE', running, '-inf', now)
+local free = tonumber(ARGV[4])
+if cluster_limit > 0 then
+    free = math.min(free, cluster_limit - redis.call('ZCARD', running))
+end
+if free <= 0 then
+    return nil
+end
+local lanes = {prefix .. ':lane:priority', prefix .. ':lane:standard'}
+if weight <= 0 or redis.call('INCR', prefix .. ':turn') % (weight + 1) == 0 then
+    lanes = {lanes[2], lanes[1]}
+end
+for _, lane in ipairs(lanes) do
+    for _ = 1, redis.call('LLEN', lane) do
+        local user = redis.call('LMOVE', lane, lane, 'LEFT', 'RIGHT')
+        if not user then
+            break
+        end
+        local user_key = prefix .. ':user:' .. user
+        local user_running = user_key .. ':running'
+        local jobs = user_key .. ':jobs'
+        redis.call('ZREMRANGEBYSCORE', user_running, '-inf', now)
+        local limit = tonumber(redis.call('HGET', user_key, 'limit')) or 1
+        local slots = math.min(free, limit - redis.call('ZCARD', user_running))
+        if slots > 0 then
+            for _ = 1, redis.call('LLEN', jobs) do
+                local job = redis.call('LMOVE', jobs, jobs, 'LEFT', 'RIGHT')
+                if not job then
+                    break
+                end
+                local job_key = prefix .. ':job:' .. job
+                local lines = redis.call('LPOP', job_key, slots)
+                if lines then
+                    for _, line in ipairs(lines) do
+                        redis.call('ZADD', user_running, deadline, line)
+                        redis.call('ZADD', running, deadline, line)
+                    end
+                    if redis.call('EXISTS', job_key) == 0 then
+                        redis.call('LREM', jobs, 0, job)
+                    end
+                    if redis.call('EXISTS', jobs) == 0 then
+                        redis.call('LREM', lane, 0, user)
+                    end
+                    return {user, job, lines}
+                end
+                redis.call('LREM', jobs, 0, job)
+            end
+        end
+        if redis.call('EXISTS', jobs) == 0 then
+            redis.call('LREM', lane, 0, user)
+        end
+    end
+end
+return nil
+"""
+
+RELEASE_SCRIPT = """
+redis.call('ZREM', KEYS[1], ARGV[1])
+return redis.call('ZREM', KEYS[2], ARGV[1])
+"""
+
+
+class FairScheduler:
+    """
+    Redis-backed round-robin queue of lines waiting to start. submit()
+    registers lines, next_batch() hands out the next lines that may start
+    and leases their slots, release() frees a line's slot once it finished.
+    """
+
+    KEY_PREFIX = 'scheduler'
+    LANES = ('priority', 'standard')
+    # Lua's unpack() is limited in how many values it can spread.
+    SUBMIT_CHUNK = 1000
+
+    def __init__(self, key_prefix=None):
+        self.prefix = key_prefix or self.KEY_PREFIX
+
+    def submit(self, job_id, user_id, line_ids, priority=False):
+        """Queue lines of a job. Returns how many lines of the job are waiting."""
+        priority = priority and settings.SCHEDULER_PRIORITY_WEIGHT > 0
+        lane, other = self.LANES if priority else reversed(self.LANES)
+        limit = settings.SCHEDULER_PRIORITY_USER_MAX_IN_FLIGHT if priority else settings.SCHEDULER_USER_MAX_IN_FLIGHT
+        waiting = 0
+        for start in range(0, len(line_ids), self.SUBMIT_CHUNK):
+            waiting = _get_client().eval(
+                SUBMIT_SCRIPT, 0, self.prefix, user_id, job_id, lane, other, limit,
+                *line_ids[start:start + self.SUBMIT_CHUNK],
+            )
+        return waiting
+
+    def next_batch(self, max_lines=1):
+        """
+        The next lines allowed to start, as (user_id, job_id, line_ids),
+        with their slots already taken; None when every user with waiting
+        lines is at their limit or the cluster is full.
+        """
+        result = _get_client().eval(
+            NEXT_SCRIPT, 0, self.prefix,
+            settings.SCHEDULER_LEASE_SECONDS, settings.SCHEDULER_MAX_IN_FLIGHT,
+            max_lines, settings.SCHEDULER_PRIORITY_WEIGHT,
+        )
+        if not result:
+            return None
+        user_id, job_id, line_ids = result
+        return int(user_id), int(job_id), [int(line_id) for line_id in line_ids]
+
+    def release(self, user_id, line_id):
+        """Free the slot a line held. Returns False if it held none (already released or expired)."""
+        return bool(_get_client().eval(
+            RELEASE_SCRIPT, 2, f"{self.prefix}:user:{user_id}:running", f"{self.prefix}:running", line_id,
+        ))
+
+    def in_flight(self, user_id=None):
+        """Leased slots of one user, or of the whole cluster; expired leases still count until the next admission."""
+        key = f"{self.prefix}:user:{user_id}:running" if user_id is not None else f"{self.prefix}:running"
+        return _get_client().zcard(key)
+
+    def waiting(self, job_id):
+        """Lines of a job that have not been started yet."""
+        return _get_client().llen(f"{self.prefix}:job:{job_id}")
+
+    def clear(self):
+        client = _get_client()
+        keys = list(client.scan_iter(match=f"{self.prefix}:*"))
+        if keys:
+            client.delete(*keys)
+
+
+_client = None
+
+
+def _get_client():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.REDIS_URL)
+    return _client
+
+
+scheduler = FairScheduler()
@@ -1,80 +1,594 @@
 # generator/tasks.py
-from celery import shared_task
-from django.contrib.auth import get_user_model
-from .models import GeneratedImage
+from celery import Task, chain, shared_task
+from celery.signals import worker_init, worker_process_init, worker_process_shutdown
+from django.core.cache import cache
+from django.db import OperationalError, transaction
+from django.utils import timezone
+from redis import RedisError
+from accounts.cache import invalidate_user_cache
+from accounts.models import UserProfile
+from tokens.models import TokenPurchase
+from .models import GeneratedImage, GenerationJob, GenerationLine, Script, UploadedAsset
 import os
-from .views import MultiModalConversation
-from .image_utils import create_image_description_from_dialogue
+import requests
+import threading
+from functools import lru_cache
+from urllib.parse import urlparse
+# The provider SDKs are only imported inside the tasks that call them, so the
+# web process can import this module to enqueue work without loading them.
+from .exceptions import ProviderError
+from .events import publish_job_event
+from .metrics import LINES_FINISHED, observe_stage
+from .scheduler import scheduler
 from django.conf import settings
 
+
+@worker_init.connect
+def _import_providers(**kwargs):
+    # Load the SDKs once in the worker's main process; forked pool processes share the pages.
+    from . import providers  # noqa: F401
+
+
+@worker_init.connect
+def _start_metrics_server(**kwargs):
+    # Served by the main process; in multiprocess mode it reports the pool processes too.
+    if settings.WORKER_METRICS_PORT:
+        from prometheus_client import start_http_server
+        from .metrics import registry
+        start_http_server(settings.WORKER_METRICS_PORT, registry=registry())
+
+
+@worker_process_init.connect
+def _build_provider_clients(**kwargs):
+    from .clients import provider_clients
+    provider_clients.warm_up()
+
+
+@worker_process_shutdown.connect
+def _mark_metrics_process_dead(pid=None, **kwargs):
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(pid or os.getpid())
+
+
+def _set_line_status(job_id, line_ids, status, image_url=None, **fields):
+    """Update line state in the database and announce it to progress listeners."""
+    if not isinstance(line_ids, (list, tuple)):
+        line_ids = [line_ids]
+    GenerationLine.set_status(line_ids, status, **fields)
+    for line_id in line_ids:
+        event = {'id': line_id, 'status': status, 'error': fields.get('error', '')}
+        if image_url:
+            event['image_url'] = image_url
+        publish_job_event(job_id, 'line', event)
+
+
+def _record_line_result(job_id, succeeded):
+    GenerationJob.record_line_result(job_id, succeeded)
+    job = GenerationJob.objects.get(id=job_id)
+    publish_job_event(job_id, 'job', job.progress_snapshot())
+
+
+@lru_cache(maxsize=settings.JOB_CACHE_SIZE)
+def load_job(job_id):
+    """
+    What the line tasks of a job share: its script, characters and staged
+    images. Tasks carry only ids; each worker process loads this once per job.
+    None of these fields change once the job is dispatched.
+    """
+    return GenerationJob.objects.only(
+        'user_id', 'context', 'dialogue', 'characters', 'background_image_path', 'staged_images',
+    ).get(pk=job_id)
+
+
+class LineStageTask(Task):
+    """
+    Base class for the tasks that run lines: the per-line pipeline stages and
+    the batch describe. Once a task has used up its retries its lines are
+    failed, their reserved tokens refunded and the job counted;
+    Line.finish() makes that happen at most once per line.
+    """
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        job_id = kwargs['job_id']
+        user_id = load_job(job_id).user_id
+        for line_id in kwargs.get('line_ids') or [kwargs['line_id']]:
+            _fail_line(job_id, line_id, user_id, str(exc) or exc.__class__.__name__)
+
+
+def _fail_line(job_id, line_id, user_id, error):
+    if not GenerationLine.finish(line_id, 'failed', error=error):
+        return
+    LINES_FINISHED.labels('failed').inc()
+    publish_job_event(job_id, 'line', {'id': line_id, 'status': 'failed', 'error': error})
+    with observe_stage('token_update'):
+        UserProfile.release_tokens(user_id, 1, job_id=job_id)
+    _record_line_result(job_id, False)
+    _release_lines(user_id, [line_id])
+
+
+def _line_is_finished(line_id):
+    return GenerationLine.objects.filter(pk=line_id, status__in=GenerationLine.TERMINAL_STATUSES).exists()
+
+
+def _line_pipeline(job_id, line_id):
+    """describe -> compose -> persist for one line; each stage runs on its own queue."""
+    ids = {'job_id': job_id, 'line_id': line_id}
+    return chain(describe_line.si(**ids), compose_line.si(**ids), persist_line.si(**ids))
+
+
+def _enqueue_lines(job_id, line_ids):
+    """Put lines on the Celery queues: a pipeline per line, or an engine task per chunk."""
+    if settings.GENERATION_ENGINE == 'async':
+        # --- One task per chunk; its lines run concurrently on the worker's event loop ---
+        chunk_size = settings.SCENE_DESCRIPTION_BATCH_SIZE or len(line_ids)
+        for start in range(0, len(line_ids), chunk_size):
+            generate_lines_async.delay(job_id=job_id, line_ids=line_ids[start:start + chunk_size])
+    else:
+        for line_id in line_ids:
+            _line_pipeline(job_id, line_id).delay()
+
+
+def _run_lines(job_id, line_ids):
+    """Enqueue lines that may start now, describing them in batches first when that is not done yet."""
+    batch_size = settings.SCENE_DESCRIPTION_BATCH_SIZE
+    # The async engine describes each chunk it runs, but the fair scheduler hands
+    # it only as many lines as the user has free slots, so describe ahead of it.
+    describe_first = batch_size > 0 and (
+        settings.GENERATION_ENGINE != 'async' or settings.GENERATION_SCHEDULER == 'fair'
+    )
+    if not describe_first or not GenerationLine.objects.filter(pk__in=line_ids, description__isnull=True).exists():
+        _enqueue_lines(job_id, line_ids)
+        return
+    # --- Describe lines in batches, one Gemini call per chunk ---
+    for start in range(0, len(line_ids), batch_size):
+        describe_dialogue_lines.delay(job_id=job_id, line_ids=line_ids[start:start + batch_size])
+
+
+def _start_lines(job, line_ids):
+    """Queue lines with the fair scheduler, or start them all at once when GENERATION_SCHEDULER is 'fifo'."""
+    if settings.GENERATION_SCHEDULER == 'fair':
+        try:
+            scheduler.submit(job.id, job.user_id, line_ids, priority=TokenPurchase.has_priority_lane(job.user_id))
+        except RedisError as e:
+            print(f"Scheduler unavailable, enqueueing the lines of job {job.id} directly: {e}")
+        else:
+            admit_lines()
+            return
+    _run_lines(job.id, line_ids)
+
+
+_admission = threading.local()
+
+
+def admit_lines():
+    """Enqueue waiting lines, in the scheduler's order, until every in-flight limit is reached."""
+    # With eager tasks a started line finishes, and releases its slot, inside this
+    # loop; the loop picks the freed slot up instead of recursing.
+    if getattr(_admission, 'active', False):
+        return 0
+    _admission.active = True
+    if settings.GENERATION_ENGINE == 'async':
+        max_lines = settings.SCENE_DESCRIPTION_BATCH_SIZE or settings.ASYNC_PROVIDER_CONCURRENCY
+    else:
+        max_lines = 1
+    admitted = 0
+    try:
+        while True:
+            batch = scheduler.next_batch(max_lines)
+            if batch is None:
+                break
+            user_id, job_id, line_ids = batch
+            startable = list(
+                GenerationLine.objects.filter(pk__in=line_ids)
+                .exclude(status__in=GenerationLine.TERMINAL_STATUSES)
+                .order_by('index')
+                .values_list('id', flat=True)
+            )
+            # Lines that finished while they waited give their slot straight back.
+            for line_id in set(line_ids) - set(startable):
+                scheduler.release(user_id, line_id)
+            if startable:
+                _run_lines(job_id, startable)
+                admitted += len(startable)
+    except RedisError as e:
+        print(f"Scheduler unavailable: {e}")
+    finally:
+        _admission.active = False
+    return admitted
+
+
+def _release_lines(user_id, line_ids):
+    """Give finished lines' slots back to the scheduler and start whatever may run next."""
+    if settings.GENERATION_SCHEDULER != 'fair':
+        return
+    try:
+        for line_id in line_ids:
+            scheduler.release(user_id, line_id)
+    except RedisError as e:
+        print(f"Could not release the slots of lines {line_ids}: {e}")
+        return
+    admit_lines()
+
+
 @shared_task
-def generate_image_for_line(
-    user_id,
-    context,
-    dialogue,
-    target_line,
-    characters,
-    background_image_path,
-):
-    User = get_user_model()
-    user = User.objects.get(id=user_id)
+def dispatch_generation(job_id):
+    """Stage the job's reference images with the provider once, then enqueue its lines."""
+    from .providers import stage_reference_image
+
+    job = GenerationJob.objects.get(id=job_id)
+    line_ids = list(job.lines.values_list('id', flat=True))
+
+    staged_images = {}
+    for asset in UploadedAsset.objects.filter(id__in=job.asset_ids):
+        path = asset.reference_path
+        handle = stage_reference_image(path, os.path.basename(path))
+        if handle:
+            staged_images[path] = handle
+
+    # Line tasks read the handles from the job rather than each carrying a copy.
+    GenerationJob.objects.filter(id=job_id).update(staged_images=staged_images)
+    GenerationJob.objects.filter(id=job_id, status='queued').update(status='running')
+    job.status = 'running'
+    publish_job_event(job.id, 'job', job.progress_snapshot())
+
+    # Describing is provider work too: under the fair scheduler it starts with the line's admission.
+    _start_lines(job, line_ids)
+    return f"Staged {len(staged_images)}/{len(set(job.asset_ids))} images for {len(line_ids)} lines"
+
 
+def _claim_lines_to_describe(job_id, line_ids, take_over=False):
+    """
+    Mark the undescribed lines among ``line_ids`` as describing and return them
+    as {index: id}. Under the fair scheduler only a user's free slots are
+    admitted at once, so the job's next queued lines are claimed along with
+    them up to a full batch; they are described by the time they are admitted.
+    Lines another describe task has claimed are left to it unless ``take_over``.
+    """
+    lines = (
+        GenerationLine.objects.select_for_update(skip_locked=True)
+        .filter(description__isnull=True)
+        .exclude(status__in=GenerationLine.TERMINAL_STATUSES)
+    )
+    with transaction.atomic():
+        admitted = lines if take_over else lines.exclude(status='describing')
+        claimed = dict(admitted.filter(pk__in=line_ids).values_list('index', 'id'))
+        ahead = settings.SCENE_DESCRIPTION_BATCH_SIZE - len(claimed)
+        if settings.GENERATION_SCHEDULER == 'fair' and claimed and ahead > 0:
+            claimed.update(
+                lines.filter(job_id=job_id, status='queued').exclude(pk__in=line_ids)
+                .order_by('index').values_list('index', 'id')[:ahead]
+            )
+        if claimed:
+            _set_line_status(job_id, list(claimed.values()), 'describing')
+    return claimed
+
+
+@shared_task(
+    base=LineStageTask,
+    acks_late=True,
+    autoretry_for=(OperationalError,),
+    retry_backoff=True,
+    max_retries=5,
+)
+def describe_dialogue_lines(job_id, line_ids, waits=0):
+    """
+    Describe a chunk of lines in one Gemini call, checkpoint the results, then
+    enqueue the lines. Admitted lines that another batch claimed ahead are
+    enqueued once it has described them, so none is described twice.
+    """
+    from .providers import create_image_descriptions_for_dialogue
+
+    job = load_job(job_id)
+    pending = _claim_lines_to_describe(job_id, line_ids, take_over=waits >= settings.SCENE_DESCRIPTION_MAX_WAITS)
+    ahead = [line_id for line_id in pending.values() if line_id not in line_ids]
+    descriptions = {}
+    if pending:
+        try:
+            descriptions = create_image_descriptions_for_dialogue(
+                context=job.context,
+                dialogue=job.dialogue,
+                line_indices=sorted(pending),
+            )
+            for index, description in descriptions.items():
+                GenerationLine.objects.filter(pk=pending[index]).update(description=description)
+        finally:
+            # Lines claimed ahead that are still undescribed go back to the queue for their own admission.
+            undescribed = list(
+                GenerationLine.objects.filter(pk__in=ahead, status='describing', description__isnull=True)
+                .values_list('id', flat=True)
+            )
+            if undescribed:
+                _set_line_status(job_id, undescribed, 'queued')
+
+    held = set(
+        GenerationLine.objects.filter(pk__in=line_ids, status='describing', description__isnull=True)
+        .exclude(pk__in=pending.values())
+        .values_list('id', flat=True)
+    )
+    # Lines missing from the batch response are described individually by describe_line.
+    ready = [line_id for line_id in line_ids if line_id not in held]
+    if ready:
+        _enqueue_lines(job_id, ready)
+    if held:
+        # A batch that has not finished within the waits is presumed dead and its lines are taken over.
+        describe_dialogue_lines.apply_async(
+            kwargs={'job_id': job_id, 'line_ids': sorted(held), 'waits': waits + 1},
+            countdown=settings.SCENE_DESCRIPTION_WAIT_SECONDS * 2 ** waits,
+        )
+    return f"Described {len(descriptions)}/{len(pending)} lines"
+
+
+# Provider errors are retried inside call_provider, up to the stage's
+# PROVIDER_MAX_ATTEMPTS; a provider stage that raises has used them up and fails its line.
+@shared_task(base=LineStageTask, acks_late=True)
+def describe_line(job_id, line_id):
+    from .providers import create_image_description_from_dialogue
+
+    line = GenerationLine.objects.only('index', 'status', 'description').get(pk=line_id)
+    if line.status in GenerationLine.TERMINAL_STATUSES or line.description:
+        return "Skipped"
+
+    job = load_job(job_id)
+    _set_line_status(job_id, line_id, 'describing')
     image_data = create_image_description_from_dialogue(
-        context=context,
-        dialogue=dialogue,
-        target_line=target_line,
+        context=job.context,
+        dialogue=job.dialogue,
+        target_line=job.dialogue[line.index],
     )
     if not image_data:
-        return "Failed to get image description"
+        raise ProviderError("Failed to get image description")
+    GenerationLine.objects.filter(pk=line_id).update(description=image_data)
+    return "Described"
+
+
+@shared_task(base=LineStageTask, acks_late=True)
+def compose_line(job_id, line_id):
+    from .providers import compose_comic_panel
+
+    line = GenerationLine.objects.only('index', 'status', 'description', 'result_url').get(pk=line_id)
+    if line.status in GenerationLine.TERMINAL_STATUSES or line.result_url:
+        return "Skipped"
+
+    job = load_job(job_id)
+    _set_line_status(job_id, line_id, 'composing')
+    output_image = compose_comic_panel(
+        characters=job.characters,
+        background_image_path=job.background_image_path,
+        image_data=line.description,
+        target_line=job.dialogue[line.index],
+        staged_images=job.staged_images,
+    )
+    GenerationLine.objects.filter(pk=line_id).update(result_url=output_image)
+    return "Composed"
 
-    speaker = target_line.split(":")[0].strip() if ":" in target_line else "Unknown"
 
-    char_text = ", ".join([c['name'] for c in characters])
-    images_desc = ", ".join([f'{c["name"]}' for c in characters])
-    pr1 = f"You are given several images: {images_desc}, and one background image showing scene."
-    pr2 = f"Create a comic-style scene showing the moment when {speaker} says his line."
-    pr3 = f"Add an empty speech bubble above {speaker} (no text)."
-    pr4 = "Ensure characters appear natural in the scene and maintain their visual style."
-    scene_text = pr1 + "\n" + json.dumps(image_data, indent=2) + "\n" + pr2 + "\n" + pr3 + "\n" + pr4
+@shared_task(
+    base=LineStageTask,
+    acks_late=True,
+    autoretry_for=(OperationalError,),
+    retry_backoff=True,
+    max_retries=5,
+)
+def persist_line(job_id, line_id):
+    line_composed(job_id, line_id, load_job(job_id).user_id)
+    return "Flush requested"
 
-    message_content = []
-    for char in characters:
-        message_content.append({"image": char["path"]})
-    message_content.append({"image": background_image_path})
-    message_content.append({"text": scene_text})
 
+def line_composed(job_id, line_id, user_id):
+    """
+    The composed line is its own checkpoint: the job's next flush records it.
+    Its provider work is over, so its scheduler slot goes to the next line now.
+    """
+    request_panel_flush(job_id)
+    _release_lines(user_id, [line_id])
+
+
+def _flush_key(job_id):
+    return f"panel-flush:{job_id}"
+
+
+def request_panel_flush(job_id):
+    """
+    Have the job's composed lines recorded PANEL_FLUSH_SECONDS from now. Only
+    the first request in that window enqueues a flush; the lines of the
+    later ones are already committed when it runs, so it records them too.
+    """
     try:
-        response = MultiModalConversation.call(
-            api_key=settings.IMG_API_KEY,
-            model="qwen-image-edit",
-            messages=[{"role": "user", "content": message_content}],
-            stream=False,
-            watermark=False,
-            negative_prompt="low quality, distorted face, messy text"
+        first = cache.add(_flush_key(job_id), 1, timeout=settings.PANEL_FLUSH_SECONDS + 60)
+    except Exception as e:
+        print(f"Panel flush debounce unavailable: {e}")
+        first = True
+    if first:
+        persist_finished_lines.apply_async(kwargs={'job_id': job_id}, countdown=settings.PANEL_FLUSH_SECONDS)
+
+
+class PanelFlushTask(Task):
+    """
+    Once a flush has used up its retries, the composed lines it was to record
+    are failed and their tokens refunded, so the job still reaches an end.
+    """
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        job_id = kwargs['job_id']
+        unrecorded = (
+            GenerationLine.objects.filter(job_id=job_id)
+            .exclude(result_url='')
+            .exclude(status__in=GenerationLine.TERMINAL_STATUSES)
+            .values_list('id', flat=True)
         )
-        if response.status_code == 200:
-            output_image = response.output.choices[0].message.content[0]['image']
+        error = f"Could not record the panel: {str(exc) or exc.__class__.__name__}"
+        for line_id in list(unrecorded):
+            _fail_line(job_id, line_id, load_job(job_id).user_id, error)
+
+
+@shared_task(
+    base=PanelFlushTask,
+    acks_late=True,
+    autoretry_for=(OperationalError,),
+    retry_backoff=True,
+    max_retries=5,
+)
+def persist_finished_lines(job_id):
+    # Lines composed from here on request a flush of their own.
+    try:
+        cache.delete(_flush_key(job_id))
+    except Exception as e:
+        print(f"Panel flush debounce unavailable: {e}")
+    return f"Recorded {save_finished_lines(job_id)} panels"
+
 
-            GeneratedImage.objects.create(
-                user=user,
-                context=context,
-                dialogue=dialogue,
+def save_finished_lines(job_id):
+    """
+    Record every composed, unfinished line of a job as a panel in one
+    transaction: the images in one bulk INSERT, the lines in one bulk UPDATE,
+    and the reserved tokens charged and the job counted with one UPDATE each.
+    Rows another flush has locked are left to it. Returns the panels recorded.
+    """
+    with transaction.atomic():
+        lines = list(
+            GenerationLine.objects.select_for_update(skip_locked=True)
+            .filter(job_id=job_id)
+            .exclude(result_url='')
+            .exclude(status__in=GenerationLine.TERMINAL_STATUSES)
+        )
+        if not lines:
+            return 0
+        job = load_job(job_id)
+        # Panels share one copy of the script instead of each storing it.
+        script = Script.objects.for_content(job.context, job.dialogue)
+
+        images = []
+        for line in lines:
+            target_line = job.dialogue[line.index]
+            speaker = target_line.split(":")[0].strip() if ":" in target_line else "Unknown"
+            image_data = line.description or {}
+            images.append(GeneratedImage(
+                user_id=job.user_id,
+                script=script,
                 target_line=target_line,
                 speaker=speaker,
-                image_url=output_image,
+                image_url=line.result_url,
                 tokens_used=1,
                 subject_description=image_data.get('subject_description', ''),
                 setting_and_scene=image_data.get('setting_and_scene', ''),
                 action_or_expression=image_data.get('action_or_expression', ''),
                 camera_and_style=image_data.get('camera_and_style', ''),
                 full_image_prompt=image_data.get('full_image_prompt', '')
+            ))
+        with observe_stage('image_insert'):
+            GeneratedImage.objects.bulk_create(images)
+
+        now = timezone.now()
+        for line, image in zip(lines, images):
+            line.status = 'done'
+            line.generated_image = image
+            line.updated_at = now
+        GenerationLine.objects.bulk_update(lines, ['status', 'generated_image', 'updated_at'])
+
+        # The tokens were reserved when the job was submitted.
+        with observe_stage('token_update'):
+            UserProfile.record_images_generated(job.user_id, count=len(lines), job_id=job_id)
+        GenerationJob.record_line_results(job_id, completed=len(lines))
+
+        finished = list(zip(lines, images))
+        transaction.on_commit(lambda: _announce_lines_done(job_id, finished))
+    LINES_FINISHED.labels('done').inc(len(lines))
+    return len(lines)
+
+
+def _announce_lines_done(job_id, finished):
+    for line, generated_image in finished:
+        publish_job_event(job_id, 'line', {
+            'id': line.id, 'status': 'done', 'error': '', 'image_url': generated_image.image_url,
+        })
+    job = GenerationJob.objects.get(id=job_id)
+    publish_job_event(job_id, 'job', job.progress_snapshot())
+    for _, generated_image in finished:
+        persist_generated_image.delay(generated_image.id)
+
+
+@shared_task(bind=True, acks_late=True, max_retries=4)
+def generate_lines_async(self, job_id, line_ids):
+    """
+    Run the describe/compose/persist stages of several lines concurrently on
+    this process's provider engine. Lines hit by a database error are retried
+    with the whole task; checkpoints make the finished lines skip straight through.
+    """
+    from .engine import provider_engine, run_lines
+
+    job = load_job(job_id)
+    retryable = provider_engine.run(run_lines(job, line_ids))
+    if not retryable:
+        return f"Generated {len(line_ids)} lines"
+    if self.request.retries < self.max_retries:
+        raise self.retry(countdown=5 * 2 ** self.request.retries)
+    for line_id, error in retryable.items():
+        _fail_line(job_id, line_id, job.user_id, error)
+    return f"Generated {len(line_ids) - len(retryable)}/{len(line_ids)} lines"
+
+
+@shared_task
+def admit_scheduled_lines():
+    """Start lines whose slots came free without a release, e.g. when a dead worker's lease expired."""
+    return f"Admitted {admit_lines()} lines"
+
+
+@shared_task
+def cleanup_unreferenced_uploads():
+    """Delete stored uploads that no job has referenced for the grace period."""
+    from datetime import timedelta
+
+    cutoff = timezone.now() - timedelta(seconds=settings.UPLOAD_CLEANUP_GRACE_SECONDS)
+    candidates = UploadedAsset.objects.filter(ref_count__lte=0, last_used_at__lt=cutoff).values_list('id', flat=True)
+
+    deleted = 0
+    for asset_id in list(candidates):
+        with transaction.atomic():
+            # Holding the row lock makes a concurrent store() of the same content wait,
+            # then recreate the blob, instead of reusing a file we are about to delete.
+            asset = (
+                UploadedAsset.objects.select_for_update(skip_locked=True)
+                .filter(id=asset_id, ref_count__lte=0)
+                .first()
             )
+            if asset is None:
+                continue
+            if asset.prepared_file:
+                asset.prepared_file.delete(save=False)
+            asset.file.delete(save=False)
+            asset.delete()
+            deleted += 1
+    return f"Deleted {deleted} unreferenced uploads"
 
-            user.profile.deduct_tokens(1)
-            user.profile.total_images_generated += 1
-            user.profile.save()
-            return "Success"
-        else:
-            return f"API failed with status {response.status_code}"
-    except Exception as e:
-        return str(e)
+
+@shared_task(
+    autoretry_for=(requests.RequestException,),
+    retry_backoff=True,
+    max_retries=5,
+)
+def persist_generated_image(image_id):
+    """Copy a finished panel from the provider's temporary URL into our storage, with thumbnails."""
+    from django.core.files.base import ContentFile
+    from .preprocessing import create_thumbnails
+
+    generated_image = GeneratedImage.objects.get(id=image_id)
+    if generated_image.image:
+        return "Already persisted"
+
+    response = requests.get(generated_image.image_url, timeout=60)
+    response.raise_for_status()
+
+    extension = os.path.splitext(urlparse(generated_image.image_url).path)[1].lower() or '.png'
+    base_name = f"panels/{generated_image.user_id}/{generated_image.id}"
+    with observe_stage('storage_save'):
+        generated_image.thumbnails = create_thumbnails(response.content, base_name)
+        generated_image.image.save(f"{base_name}{extension}", ContentFile(response.content), save=False)
+    generated_image.save(update_fields=['image', 'thumbnails'])
+    # Cached fragments still point at the provider's temporary URL.
+    invalidate_user_cache(generated_image.user_id)
+
+    line = GenerationLine.objects.filter(generated_image_id=image_id).values('id', 'job_id').first()
+    if line:
+        publish_job_event(line['job_id'], 'panel', {'id': line['id'], 'image_url': generated_image.thumbnail_url})
+    return "Persisted"
@@ -1,3 +1,1051 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from contextlib import contextmanager
+from unittest import mock
 
-# Create your tests here.
+import httpx
+import redis
+from PIL import Image
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import OperationalError, connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from accounts.models import UserProfile
+from comic_generator.query_profiling import assert_query_budget
+from tokens.models import TokenTransaction
+from .cache import DescriptionCache, description_cache
+from .clients import _async_hooks, connection_stats, provider_clients
+from .exceptions import ProviderError, ProviderThrottled, RetryableProviderError
+from .metrics import LIMITER_WAIT_SECONDS
+from .models import GeneratedImage, GenerationJob, GenerationLine, Script, UploadedAsset
+from .pagination import keyset_page
+from .preprocessing import create_thumbnails, prepare_reference_image
+from .ratelimit import ProviderRateLimiter
+from .scheduler import FairScheduler
+from .tasks import (
+    _claim_lines_to_describe,
+    _line_pipeline,
+    cleanup_unreferenced_uploads,
+    compose_line,
+    describe_dialogue_lines,
+    describe_line,
+    load_job,
+    persist_finished_lines,
+    persist_generated_image,
+    save_finished_lines,
+)
+
+# Loads what a gunicorn worker loads: the WSGI application and every view via the URLconf.
+WEB_BOOT = """
+from comic_generator.wsgi import application
+from django.urls import get_resolver
+get_resolver().url_patterns
+"""
+
+# Provider code is for Celery workers only; none of these may load in the web process.
+WORKER_ONLY_MODULES = (
+    'google.genai',
+    'dashscope',
+    'pydantic',
+    'generator.providers',
+    'generator.clients',
+)
+
+
+class WebImportTimeTests(SimpleTestCase):
+    """Import-time budget for the web process, measured with ``python -X importtime``."""
+
+    # Cumulative import time of the web boot path; generous so slow CI machines pass.
+    BUDGET_SECONDS = float(os.getenv('WEB_IMPORT_BUDGET_SECONDS', 3))
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get(
+            'DJANGO_SETTINGS_MODULE', 'comic_generator.settings'
+        ))
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', WEB_BOOT],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True, timeout=120,
+        )
+        if result.returncode:
+            raise AssertionError(f"Web boot failed:\n{result.stderr[-2000:]}")
+        # Lines look like "import time:  self [us] | cumulative | <indent>package";
+        # the indent after the second bar grows with the nesting depth.
+        cls.imports = []
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:') or 'imported package' in line:
+                continue
+            _, cumulative, name = line[len('import time:'):].split('|')
+            depth = (len(name) - len(name.lstrip())) // 2
+            cls.imports.append((name.strip(), depth, int(cumulative)))
+
+    def test_web_process_does_not_import_provider_sdks(self):
+        loaded = sorted(
+            name for name, _, _ in self.imports
+            if any(name == module or name.startswith(module + '.') for module in WORKER_ONLY_MODULES)
+        )
+        self.assertEqual(loaded, [], "the web process imported worker-only modules")
+
+    def test_web_process_import_time_budget(self):
+        total_us = sum(cumulative for _, depth, cumulative in self.imports if depth == 0)
+        self.assertLess(total_us / 1e6, self.BUDGET_SECONDS)
+
+
+# Templates resolve static files without a collectstatic manifest; the
+# per-user cache is local so budgets do not depend on a running Redis.
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+)
+class QueryBudgetTests(TestCase):
+    """Query budgets per view; a repeated query shape per row means an N+1 crept in."""
+
+    ROWS = 10
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        cls.user = User.objects.create_user('artist', password='password')
+        cls.job = GenerationJob.objects.create(
+            user=cls.user, context='c', dialogue=['A: hi'] * cls.ROWS, characters=[],
+            background_image_path='bg.png', total_lines=cls.ROWS,
+        )
+        script = Script.objects.for_content('c', ['A: hi'])
+        for index in range(cls.ROWS):
+            image = GeneratedImage.objects.create(
+                user=cls.user, script=script, target_line='A: hi',
+                image_url=f"https://example.com/{index}.png",
+            )
+            GenerationLine.objects.create(job=cls.job, index=index, text='A: hi', generated_image=image)
+
+    def setUp(self):
+        cache.clear()
+
+    def assertViewWithinBudget(self, user, url, max_queries, max_duplicates=1):
+        self.client.force_login(user)
+        with assert_query_budget(max_queries=max_queries, max_duplicates=max_duplicates):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_dashboard(self):
+        self.assertViewWithinBudget(self.user, reverse('generator:dashboard'), max_queries=5)
+
+    def test_gallery(self):
+        self.assertViewWithinBudget(self.user, reverse('generator:gallery'), max_queries=6)
+
+    def test_job_status(self):
+        self.assertViewWithinBudget(self.user, reverse('generator:job_status', args=[self.job.id]), max_queries=4)
+
+    def test_generated_image_admin_changelist(self):
+        # The changelist counts rows twice (filtered and total).
+        self.assertViewWithinBudget(
+            self.admin, reverse('admin:generator_generatedimage_changelist'), max_queries=6, max_duplicates=2,
+        )
+
+    def test_generation_job_admin_change_page(self):
+        self.assertViewWithinBudget(
+            self.admin, reverse('admin:generator_generationjob_change', args=[self.job.id]),
+            max_queries=10, max_duplicates=2,
+        )
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class PanelFlushTests(TestCase):
+    """Composed lines are recorded as panels in bulk, with one update per counter."""
+
+    def setUp(self):
+        # Ids are reused once a test's transaction rolls back.
+        load_job.cache_clear()
+        self.user = User.objects.create_user('artist', password='password')
+
+    def compose_job(self, composed, total):
+        job = GenerationJob.objects.create(
+            user=self.user, context='c', dialogue=[f"A: line {index}" for index in range(total)],
+            characters=[], background_image_path='bg.png', total_lines=total, tokens_reserved=total,
+        )
+        for index in range(total):
+            GenerationLine.objects.create(
+                job=job, index=index, text=f"A: line {index}", status='composing',
+                description={'full_image_prompt': f"prompt {index}"},
+                result_url=f"https://example.com/{index}.png" if index < composed else '',
+            )
+        return job
+
+    def test_flush_records_every_composed_line_at_once(self):
+        job = self.compose_job(composed=3, total=4)
+        self.assertEqual(save_finished_lines(job.id), 3)
+
+        lines = list(job.lines.select_related('generated_image'))
+        self.assertEqual([line.status for line in lines], ['done', 'done', 'done', 'composing'])
+        self.assertEqual(lines[2].generated_image.image_url, 'https://example.com/2.png')
+        self.assertEqual(lines[2].generated_image.full_image_prompt, 'prompt 2')
+        self.assertEqual(UserProfile.objects.get(user=self.user).total_images_generated, 3)
+        self.assertEqual(
+            list(TokenTransaction.objects.filter(job=job).values_list('kind', 'tokens')), [('charge', 3)],
+        )
+        job.refresh_from_db()
+        self.assertEqual((job.completed_lines, job.finished_at), (3, None))
+
+        # Nothing left to record until the last line is composed; then the job completes.
+        self.assertEqual(save_finished_lines(job.id), 0)
+        GenerationLine.objects.filter(job=job, index=3).update(result_url='https://example.com/3.png')
+        self.assertEqual(save_finished_lines(job.id), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.completed_lines), ('completed', 4))
+
+    def test_flush_writes_do_not_grow_with_the_number_of_panels(self):
+        small, large = self.compose_job(composed=2, total=2), self.compose_job(composed=20, total=20)
+        with assert_query_budget() as small_profile:
+            save_finished_lines(small.id)
+        with assert_query_budget() as large_profile:
+            save_finished_lines(large.id)
+        self.assertEqual(large_profile.count, small_profile.count)
+
+    def test_panels_share_one_copy_of_their_script(self):
+        first, again = self.compose_job(composed=3, total=3), self.compose_job(composed=2, total=3)
+        save_finished_lines(first.id)
+        save_finished_lines(again.id)
+
+        script = Script.objects.get()
+        self.assertEqual((script.context, script.dialogue), (first.context, first.dialogue))
+        self.assertEqual(script.panels.count(), 5)
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    DESCRIPTION_CACHE_STATS_INTERVAL=3600,
+)
+class DescriptionCacheTests(SimpleTestCase):
+    """Descriptions are served from the local LRU, then the shared cache; counters are flushed in batches."""
+
+    def setUp(self):
+        cache.clear()
+        self.cache = DescriptionCache(ttl=60, local_size=10, local_ttl=60)
+        self.key = DescriptionCache.make_key('c', ['A: hi'], 'A: hi', 'gemini-2.5-flash', 1)
+
+    def test_lookups_fall_through_both_levels(self):
+        self.assertIsNone(self.cache.get(self.key))
+        self.cache.set(self.key, {'full_image_prompt': 'p'})
+        self.assertEqual(self.cache.get(self.key), {'full_image_prompt': 'p'})
+
+        # Failed (empty) descriptions are never cached.
+        failed_key = DescriptionCache.make_key('c', ['A: hi'], 'A: yo', 'gemini-2.5-flash', 1)
+        self.cache.set(failed_key, {})
+        self.assertIsNone(cache.get(failed_key))
+
+        # Another process has an empty LRU and reads the shared cache, then keeps it locally.
+        other = DescriptionCache(ttl=60, local_size=10, local_ttl=60)
+        self.assertEqual(other.get(self.key), {'full_image_prompt': 'p'})
+        self.assertIn(self.key, other.local)
+
+        self.assertEqual(self.cache.stats()['process']['local_hits'], 1)
+        self.assertEqual(self.cache.stats()['process']['misses'], 1)
+        self.assertEqual(other.stats()['process']['redis_hits'], 1)
+
+    def test_counters_reach_the_cluster_only_when_flushed(self):
+        for _ in range(3):
+            self.cache.get(self.key)
+        self.assertIsNone(cache.get(f"{DescriptionCache.KEY_PREFIX}:stats:misses"))
+
+        self.cache.flush_stats()
+        self.cache.get(self.key)
+        self.assertEqual(self.cache.stats()['cluster']['misses'], 4)
+
+        self.cache.clear_stats()
+        self.assertEqual(self.cache.stats()['cluster'], {'local_hits': 0, 'redis_hits': 0, 'misses': 0})
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class LineStageTests(TestCase):
+    """Stages resume from the line's checkpoints, and a line whose provider call failed is failed and refunded."""
+
+    def setUp(self):
+        load_job.cache_clear()
+        self.user = User.objects.create_user('artist', password='password')
+        UserProfile.add_tokens_for_user(self.user.id, 2)
+        UserProfile.reserve_tokens(self.user.id, 2)
+        self.job = GenerationJob.objects.create(
+            user=self.user, context='c', dialogue=['A: hi', 'B: yo'], characters=[],
+            background_image_path='bg.png', total_lines=2, tokens_reserved=2,
+        )
+        self.line = GenerationLine.objects.create(
+            job=self.job, index=0, text='A: hi', status='composing', description={'full_image_prompt': 'p'},
+        )
+        self.ids = {'job_id': self.job.id, 'line_id': self.line.id}
+
+    def assertLineFailed(self, error):
+        self.line.refresh_from_db()
+        self.job.refresh_from_db()
+        self.assertEqual(self.line.status, 'failed')
+        self.assertIn(error, self.line.error)
+        self.assertEqual(self.job.failed_lines, 1)
+        self.assertEqual(UserProfile.objects.get(user=self.user).token_balance, 1)
+
+    @mock.patch('generator.providers.compose_comic_panel', return_value='https://example.com/0.png')
+    @mock.patch('generator.providers.create_image_description_from_dialogue')
+    def test_retried_stages_skip_completed_work(self, describe, compose):
+        self.assertEqual(describe_line.run(**self.ids), 'Skipped')
+        describe.assert_not_called()
+
+        self.assertEqual(compose_line.run(**self.ids), 'Composed')
+        self.assertEqual(compose.call_args.kwargs['image_data'], {'full_image_prompt': 'p'})
+        self.assertEqual(compose_line.run(**self.ids), 'Skipped')
+        self.assertEqual(compose.call_count, 1)
+
+    @override_settings(PROVIDER_MAX_ATTEMPTS={'gemini': 1, 'dashscope': 2}, PROVIDER_BACKOFF_MAX_SECONDS=0)
+    @mock.patch('generator.providers.get_rate_limiter')
+    @mock.patch.object(provider_clients, 'dashscope')
+    def test_only_network_errors_are_retried_by_the_provider_call(self, dashscope, get_rate_limiter):
+        generate = dashscope.return_value.multimodal_generation
+        generate.side_effect = httpx.ConnectError('connection refused')
+        compose_line.apply(kwargs=self.ids)
+        self.assertEqual(generate.call_count, 2)
+        self.assertLineFailed('connection refused')
+
+        # A local bug fails the line on the first attempt.
+        generate.reset_mock(side_effect=True)
+        generate.side_effect = FileNotFoundError('bg.png')
+        line = GenerationLine.objects.create(
+            job=self.job, index=1, text='B: yo', status='composing', description={'full_image_prompt': 'p'},
+        )
+        result = compose_line.apply(kwargs={'job_id': self.job.id, 'line_id': line.id})
+        self.assertIsInstance(result.result, FileNotFoundError)
+        self.assertEqual(generate.call_count, 1)
+
+    @mock.patch('generator.providers.compose_comic_panel', side_effect=ProviderThrottled('429'))
+    def test_provider_errors_are_not_retried_by_the_stage(self, compose):
+        result = compose_line.apply(kwargs=self.ids)
+        self.assertIsInstance(result.result, ProviderThrottled)
+        self.assertEqual(compose.call_count, 1)
+        self.assertLineFailed('429')
+
+    def test_failed_flush_fails_its_lines(self):
+        GenerationLine.objects.filter(pk=self.line.id).update(result_url='https://example.com/0.png')
+        persist_finished_lines.on_failure(
+            OperationalError('database is locked'), 'task', (), {'job_id': self.job.id}, None,
+        )
+        self.assertLineFailed('database is locked')
+
+
+def _image_upload(name, size, image_format='JPEG', **options):
+    """An upload of random pixels carrying an EXIF camera model and GPS position."""
+    rng = random.Random(name)
+    image = Image.frombytes('RGB', size, rng.randbytes(size[0] * size[1] * 3))
+    exif = Image.Exif()
+    exif[0x0110] = 'Test Camera'
+    exif[0x8825] = {1: 'N', 2: (52.0, 22.0, 1.0)}
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, exif=exif, **options)
+    return SimpleUploadedFile(name, buffer.getvalue())
+
+
+class UploadedMediaTests(TestCase):
+    """Uploads are stored once and right-sized without metadata; finished panels get WebP thumbnails."""
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        self.enterContext(self.settings(MEDIA_ROOT=media_root, REFERENCE_IMAGE_MAX_SIZE=256))
+
+    def assertMetadataFree(self, name):
+        with default_storage.open(name) as f:
+            image = Image.open(f)
+            self.assertEqual(image.format, 'WEBP')
+            self.assertEqual(dict(image.getexif()), {})
+            return image.size
+
+    def test_large_image_is_downscaled(self):
+        asset = prepare_reference_image(UploadedAsset.objects.store(_image_upload('photo.jpg', (600, 300))))
+        self.assertEqual(self.assertMetadataFree(asset.prepared_file.name), (256, 128))
+        self.assertLess(asset.prepared_file.size, asset.size)
+        self.assertEqual(asset.reference_path, asset.prepared_file.path)
+
+    @override_settings(UPLOAD_CLEANUP_GRACE_SECONDS=0)
+    def test_identical_uploads_share_one_file_until_unreferenced(self):
+        user = User.objects.create_user('artist', password='password')
+        first = UploadedAsset.objects.store(_image_upload('a.jpg', (32, 32)))
+        again = UploadedAsset.objects.store(_image_upload('a.jpg', (32, 32)), refs=2)
+        other = UploadedAsset.objects.store(_image_upload('b.jpg', (32, 32)))
+        self.assertEqual(first.pk, again.pk)
+        self.assertEqual(UploadedAsset.objects.get(pk=first.pk).ref_count, 3)
+        prepared = prepare_reference_image(first).prepared_file.name
+
+        # One image used for two characters and the background of a one-line job.
+        job = GenerationJob.objects.create(
+            user=user, context='c', dialogue=['A: hi'], characters=[], background_image_path='bg.png',
+            total_lines=1, asset_ids=[first.pk, first.pk, first.pk],
+        )
+        GenerationJob.record_line_results(job.id, completed=1)
+        self.assertEqual(UploadedAsset.objects.get(pk=first.pk).ref_count, 0)
+
+        cleanup_unreferenced_uploads()
+        self.assertEqual(list(UploadedAsset.objects.values_list('pk', flat=True)), [other.pk])
+        self.assertFalse(default_storage.exists(first.file.name))
+        self.assertFalse(default_storage.exists(prepared))
+        self.assertTrue(default_storage.exists(other.file.name))
+
+    @override_settings(
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        PANEL_THUMBNAIL_WIDTHS=[320, 640, 960],
+    )
+    def test_finished_panel_is_stored_with_thumbnails(self):
+        user = User.objects.create_user('artist', password='password')
+        panel = GeneratedImage.objects.create(
+            user=user, script=Script.objects.for_content('c', ['A: hi']), target_line='A: hi',
+            image_url='https://provider.example.com/result/panel.png?sig=1',
+        )
+        png = _image_upload('panel.png', (800, 400), image_format='PNG').read()
+        with mock.patch('generator.tasks.requests.get', return_value=mock.Mock(content=png)) as get:
+            self.assertEqual(persist_generated_image.run(panel.id), 'Persisted')
+            self.assertEqual(persist_generated_image.run(panel.id), 'Already persisted')
+        self.assertEqual(get.call_count, 1)
+
+        panel.refresh_from_db()
+        self.assertEqual(panel.image.name, f"panels/{user.id}/{panel.id}.png")
+        # Wider than the panel itself is skipped.
+        self.assertEqual(sorted(panel.thumbnails), ['320', '640'])
+        self.assertEqual(self.assertMetadataFree(panel.thumbnails['640']), (640, 320))
+        self.assertEqual(panel.thumbnail_url, default_storage.url(panel.thumbnails['320']))
+        self.assertIn(f"{default_storage.url(panel.thumbnails['640'])} 640w", panel.srcset)
+
+    def test_small_panel_gets_one_thumbnail_at_its_own_width(self):
+        png = _image_upload('tiny.png', (100, 50), image_format='PNG').read()
+        thumbnails = create_thumbnails(png, 'panels/tiny', widths=[320, 640])
+        self.assertEqual(list(thumbnails), ['100'])
+        self.assertEqual(self.assertMetadataFree(thumbnails['100']), (100, 50))
+
+    @override_settings(
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+    )
+    def test_generate_times_preprocessing_apart_from_storage(self):
+        from .preprocessing import prepare_reference_image as prepare
+
+        user = User.objects.create_user('artist', password='password')
+        UserProfile.add_tokens_for_user(user.id, 1)
+        self.client.force_login(user)
+        stages = []
+
+        @contextmanager
+        def observe(stage, model=''):
+            stages.append(stage)
+            yield
+            stages.append(f"/{stage}")
+
+        def prepare_in_stage(asset):
+            stages.append('prepare')
+            return prepare(asset)
+
+        with (
+            mock.patch('generator.views.observe_stage', observe),
+            mock.patch('generator.preprocessing.prepare_reference_image', prepare_in_stage),
+        ):
+            response = self.client.post(reverse('generator:generate'), {
+                'context': 'c', 'dialogue': 'A: hi', 'character_name_1': 'A',
+                'character_image_1': _image_upload('a.jpg', (32, 32)), 'background': _image_upload('bg.jpg', (64, 32)),
+            })
+        self.assertRedirects(response, reverse('generator:gallery'), fetch_redirect_response=False)
+        self.assertEqual(stages[:6], [
+            'storage_save', '/storage_save', 'image_preprocess', 'prepare', 'prepare', '/image_preprocess',
+        ])
+        job = GenerationJob.objects.get()
+        self.assertEqual(job.characters[0]['path'], UploadedAsset.objects.get(pk=job.asset_ids[0]).reference_path)
+        self.assertEqual(job.background_image_path, UploadedAsset.objects.get(pk=job.asset_ids[1]).reference_path)
+
+    def test_small_compact_image_still_loses_its_metadata(self):
+        upload = _image_upload('icon.jpg', (64, 64), quality=10)
+        asset = prepare_reference_image(UploadedAsset.objects.store(upload))
+        self.assertEqual(self.assertMetadataFree(asset.prepared_file.name), (64, 64))
+
+
+@override_settings(PROVIDER_CLIENT_STATS_INTERVAL=0)
+class ProviderClientTests(SimpleTestCase):
+    """Pooled clients are per process, and counting their requests never blocks the event loop."""
+
+    def setUp(self):
+        provider_clients.reset()
+        self.addCleanup(provider_clients.reset)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'needs os.fork')
+    def test_forked_child_builds_its_own_clients(self):
+        inherited = provider_clients.dashscope()
+        connection_stats.connection('dashscope')
+        self.assertIs(provider_clients.dashscope(), inherited)
+
+        pid = os.fork()
+        if pid == 0:
+            fresh = provider_clients._dashscope is None and not connection_stats.snapshot()
+            fresh = fresh and provider_clients.dashscope() is not inherited
+            os._exit(0 if fresh else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        self.assertIs(provider_clients.dashscope(), inherited)
+
+    def test_async_requests_publish_off_the_event_loop(self):
+        published_on = []
+        on_request = _async_hooks('gemini')['request'][0]
+
+        async def send():
+            request = mock.Mock(extensions={})
+            with mock.patch.object(connection_stats, 'publish', lambda: published_on.append(threading.get_ident())):
+                await on_request(request)
+            return threading.get_ident()
+
+        # asyncio.run() waits for the executor, so the publish has happened when it returns.
+        loop_thread = asyncio.run(send())
+        self.assertEqual(len(published_on), 1)
+        self.assertNotEqual(published_on[0], loop_thread)
+        self.assertEqual(connection_stats.snapshot()['gemini']['requests'], 1)
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    GENERATION_SCHEDULER='fifo',
+    SCENE_DESCRIPTION_BATCH_SIZE=10,
+)
+class BatchDescriptionTests(TestCase):
+    """A chunk of lines is described in one call; lines the model skipped fall back to the per-line call."""
+
+    def setUp(self):
+        cache.clear()
+        description_cache.local.clear()
+        load_job.cache_clear()
+        user = User.objects.create_user('artist', password='password')
+        self.job = GenerationJob.objects.create(
+            user=user, context='c', dialogue=['A: hi', 'B: yo', 'A: bye'], characters=[],
+            background_image_path='bg.png', total_lines=3,
+        )
+        self.line_ids = [
+            GenerationLine.objects.create(job=self.job, index=index, text=text).id
+            for index, text in enumerate(self.job.dialogue)
+        ]
+        self.enterContext(mock.patch.object(provider_clients, 'gemini'))
+
+    def batch_response(self, *indices):
+        panels = [{'line_index': index, 'full_image_prompt': f"prompt {index}"} for index in indices]
+        return mock.Mock(text=json.dumps({'panels': panels}))
+
+    @mock.patch('generator.tasks._enqueue_lines')
+    def test_skipped_lines_are_described_one_by_one(self, enqueue):
+        with mock.patch('generator.providers._generate_content', return_value=self.batch_response(0, 2)) as call:
+            describe_dialogue_lines.run(job_id=self.job.id, line_ids=self.line_ids)
+        self.assertEqual(call.call_count, 1)
+        enqueue.assert_called_once_with(self.job.id, self.line_ids)
+        self.assertEqual(
+            list(self.job.lines.values_list('description', flat=True)),
+            [{'full_image_prompt': 'prompt 0'}, None, {'full_image_prompt': 'prompt 2'}],
+        )
+
+        single = mock.Mock(text=json.dumps({'full_image_prompt': 'prompt 1'}))
+        with mock.patch('generator.providers._generate_content', return_value=single) as call:
+            for line_id in self.line_ids:
+                describe_line.run(job_id=self.job.id, line_id=line_id)
+        self.assertEqual(call.call_count, 1)
+        self.assertIn('"B: yo"', call.call_args.kwargs['contents'])
+        self.assertEqual(self.job.lines.get(index=1).description, {'full_image_prompt': 'prompt 1'})
+
+    def test_described_lines_come_from_the_cache(self):
+        from .providers import create_image_descriptions_for_dialogue
+
+        with mock.patch('generator.providers._generate_content', return_value=self.batch_response(0, 1, 2)) as call:
+            first = create_image_descriptions_for_dialogue('c', self.job.dialogue)
+            again = create_image_descriptions_for_dialogue('c', self.job.dialogue, line_indices=[2, 1])
+        self.assertEqual(call.call_count, 1)
+        self.assertEqual(again, {1: first[1], 2: first[2]})
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ProviderRequestTests(SimpleTestCase):
+    """The sync and async provider calls send the same requests and parse the responses the same way."""
+
+    def setUp(self):
+        cache.clear()
+        description_cache.local.clear()
+        self.enterContext(mock.patch.object(provider_clients, 'gemini'))
+
+    def test_descriptions(self):
+        from . import providers
+
+        single = mock.Mock(text=json.dumps({'full_image_prompt': 'p'}))
+        batch = mock.Mock(text=json.dumps({'panels': [{'line_index': 1, 'full_image_prompt': 'p1'}]}))
+        for describe, adescribe, response, kwargs in [
+            ('create_image_description_from_dialogue', 'acreate_image_description_from_dialogue', single,
+             {'target_line': 'A: hi'}),
+            ('create_image_descriptions_for_dialogue', 'acreate_image_descriptions_for_dialogue', batch,
+             {'line_indices': [1]}),
+        ]:
+            with mock.patch('generator.providers._generate_content', return_value=response) as call:
+                result = getattr(providers, describe)('c', ['A: hi', 'B: yo'], **kwargs)
+            description_cache.local.clear()
+            cache.clear()
+            with mock.patch('generator.providers._agenerate_content', return_value=response) as acall:
+                aresult = asyncio.run(getattr(providers, adescribe)('c', ['A: hi', 'B: yo'], **kwargs))
+            self.assertEqual(aresult, result)
+            self.assertEqual(acall.call_args.args[1:], call.call_args.args[1:])
+            self.assertEqual(acall.call_args.kwargs['contents'], call.call_args.kwargs['contents'])
+
+    @mock.patch('generator.providers.get_rate_limiter')
+    @mock.patch.object(provider_clients, 'dashscope')
+    def test_compose(self, dashscope, get_rate_limiter):
+        from .providers import acompose_comic_panel, compose_comic_panel
+
+        response = mock.Mock(status_code=200, output={'choices': [{'message': {'content': [{'image': 'u'}]}}]})
+        client = dashscope.return_value
+        client.multimodal_generation.return_value = response
+        client.amultimodal_generation = mock.AsyncMock(return_value=response)
+        get_rate_limiter.return_value.aacquire = mock.AsyncMock()
+        kwargs = {
+            'characters': [{'name': 'A', 'path': 'a.png'}], 'background_image_path': 'bg.png',
+            'image_data': {'full_image_prompt': 'p'}, 'target_line': 'A: hi',
+        }
+        self.assertEqual(compose_comic_panel(**kwargs), 'u')
+        self.assertEqual(asyncio.run(acompose_comic_panel(**kwargs)), 'u')
+        self.assertEqual(client.amultimodal_generation.call_args, client.multimodal_generation.call_args)
+
+
+class GalleryPaginationTests(TestCase):
+    """Keyset pages follow (-created_at, -id) without gaps or repeats, even when timestamps tie."""
+
+    def setUp(self):
+        self.user = User.objects.create_user('artist', password='password')
+        script = Script.objects.for_content('c', ['A: hi'])
+        self.images = [
+            GeneratedImage.objects.create(
+                user=self.user, script=script, target_line='A: hi', image_url=f"https://example.com/{index}.png",
+            )
+            for index in range(7)
+        ]
+        # Panels recorded by one flush share a timestamp; all but one of these do.
+        tied = self.images[0].created_at
+        GeneratedImage.objects.filter(pk__in=[image.pk for image in self.images[2:]]).update(created_at=tied)
+
+    def test_pages_cover_tied_timestamps_exactly_once(self):
+        queryset = GeneratedImage.objects.filter(user=self.user)
+        seen, cursor = [], None
+        for _ in range(4):
+            page, cursor = keyset_page(queryset, cursor=cursor, page_size=2)
+            seen.extend(image.pk for image in page)
+            if cursor is None:
+                break
+        expected = list(queryset.order_by('-created_at', '-id').values_list('pk', flat=True))
+        self.assertEqual(seen, expected)
+        self.assertEqual(len(set(seen)), 7)
+
+    def test_malformed_cursor_starts_from_the_top(self):
+        page, cursor = keyset_page(GeneratedImage.objects.filter(user=self.user), cursor='not-a-cursor', page_size=3)
+        self.assertEqual(len(page), 3)
+        self.assertIsNotNone(cursor)
+
+
+class LineTaskPayloadTests(TestCase):
+    """Line tasks carry ids only; workers read the job's shared data once per process."""
+
+    def setUp(self):
+        load_job.cache_clear()
+        self.user = User.objects.create_user('artist', password='password')
+
+    def test_line_stages_carry_only_ids(self):
+        for task in _line_pipeline(7, 12345).tasks:
+            self.assertEqual(task.kwargs, {'job_id': 7, 'line_id': 12345})
+
+    def test_job_data_is_loaded_once_per_process(self):
+        job = GenerationJob.objects.create(
+            user=self.user, context='c', dialogue=['A: hi'], characters=[], background_image_path='bg.png',
+            staged_images={'bg.png': 'oss://bg'},
+        )
+        with self.assertNumQueries(1):
+            load_job(job.id)
+            cached = load_job(job.id)
+        self.assertEqual(cached.staged_images, {'bg.png': 'oss://bg'})
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+)
+class JobProgressTests(TestCase):
+    """Job progress for the gallery: job_status is polled; event streams are only offered under ASGI."""
+
+    def setUp(self):
+        self.user = User.objects.create_user('artist', password='password')
+        self.job = GenerationJob.objects.create(
+            user=self.user, context='c', dialogue=['A: hi', 'B: yo'], characters=[],
+            background_image_path='bg.png', total_lines=2,
+        )
+        self.client.force_login(self.user)
+
+    def test_status_reports_counters_and_each_line(self):
+        panel = GeneratedImage.objects.create(
+            user=self.user, script=Script.objects.for_content('c', self.job.dialogue), target_line='A: hi',
+            image_url='https://example.com/0.png',
+        )
+        GenerationLine.objects.create(job=self.job, index=0, text='A: hi', status='done', generated_image=panel)
+        failed = GenerationLine.objects.create(job=self.job, index=1, text='B: yo', status='failed', error='429')
+        GenerationJob.record_line_results(self.job.id, completed=1, failed=1)
+
+        response = self.client.get(reverse('generator:job_status', args=[self.job.id]))
+        self.assertEqual(response.json(), {
+            'id': self.job.id, 'status': 'completed', 'total_lines': 2, 'completed_lines': 1, 'failed_lines': 1,
+            'progress': 100, 'finished': True,
+            'lines': [
+                {'id': panel.generation_line.id, 'index': 0, 'status': 'done', 'error': '',
+                 'image_url': 'https://example.com/0.png'},
+                {'id': failed.id, 'index': 1, 'status': 'failed', 'error': '429', 'image_url': None},
+            ],
+        })
+
+    def test_status_of_another_users_job_is_not_found(self):
+        GenerationLine.objects.create(job=self.job, index=0, text='A: hi')
+        self.client.force_login(User.objects.create_user('someone', password='password'))
+        response = self.client.get(reverse('generator:job_status', args=[self.job.id]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_event_stream_is_not_served_under_wsgi(self):
+        response = self.client.get(reverse('generator:job_events', args=[self.job.id]))
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(response.streaming)
+
+    def test_gallery_polls_under_wsgi(self):
+        response = self.client.get(reverse('generator:gallery'))
+        self.assertContains(response, reverse('generator:job_status', args=[self.job.id]))
+        self.assertNotContains(response, 'data-events-url')
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    GENERATION_SCHEDULER='fair',
+    SCENE_DESCRIPTION_BATCH_SIZE=3,
+)
+class DescribeAdmissionTests(TestCase):
+    """Admitted lines are described together with the job's next queued lines, each line once."""
+
+    def setUp(self):
+        load_job.cache_clear()
+        user = User.objects.create_user('artist', password='password')
+        self.job = GenerationJob.objects.create(
+            user=user, context='c', dialogue=['A: hi'] * 5, characters=[], background_image_path='bg.png',
+            total_lines=5,
+        )
+        self.line_ids = [
+            GenerationLine.objects.create(job=self.job, index=index, text='A: hi').id for index in range(5)
+        ]
+
+    def test_admitted_lines_claim_a_full_batch(self):
+        first, second, third, fourth, fifth = self.line_ids
+        self.assertEqual(_claim_lines_to_describe(self.job.id, [first]), {0: first, 1: second, 2: third})
+        # The lines claimed ahead are not described again once they are admitted.
+        self.assertEqual(_claim_lines_to_describe(self.job.id, [second, fourth]), {3: fourth, 4: fifth})
+        self.assertEqual(_claim_lines_to_describe(self.job.id, [fifth]), {})
+        self.assertEqual(set(self.job.lines.values_list('status', flat=True)), {'describing'})
+
+    def test_admitted_lines_fail_when_their_describe_task_gives_up(self):
+        describe_dialogue_lines.on_failure(
+            OperationalError('database is locked'), 'task', (), {'job_id': self.job.id, 'line_ids': self.line_ids[:2]},
+            None,
+        )
+        self.assertEqual(list(self.job.lines.values_list('status', flat=True)), ['failed'] * 2 + ['queued'] * 3)
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.failed_lines, 2)
+
+    @override_settings(GENERATION_SCHEDULER='fifo')
+    def test_fifo_chunks_describe_only_their_own_lines(self):
+        self.assertEqual(_claim_lines_to_describe(self.job.id, self.line_ids[:1]), {0: self.line_ids[0]})
+
+    def describe(self, line_ids, descriptions=None, waits=0):
+        """Run describe_dialogue_lines inline; returns its batch call, enqueue and recheck mocks."""
+        with (
+            mock.patch(
+                'generator.providers.create_image_descriptions_for_dialogue', return_value=descriptions or {},
+            ) as describe_batch,
+            mock.patch('generator.tasks._enqueue_lines') as enqueue,
+            mock.patch.object(describe_dialogue_lines, 'apply_async') as recheck,
+        ):
+            describe_dialogue_lines(job_id=self.job.id, line_ids=line_ids, waits=waits)
+        return describe_batch, enqueue, recheck
+
+    def test_line_admitted_during_the_batch_waits_for_it(self):
+        first, second, third = self.line_ids[:3]
+        _claim_lines_to_describe(self.job.id, [first])
+
+        describe_batch, enqueue, recheck = self.describe([second])
+        describe_batch.assert_not_called()
+        enqueue.assert_not_called()
+        self.assertEqual(recheck.call_args.kwargs['kwargs'], {'job_id': self.job.id, 'line_ids': [second], 'waits': 1})
+
+        # Once the batch has described it, the recheck hands the line on without a Gemini call.
+        GenerationLine.objects.filter(pk=second).update(description={'full_image_prompt': 'p1'})
+        describe_batch, enqueue, recheck = self.describe([second], waits=1)
+        describe_batch.assert_not_called()
+        enqueue.assert_called_once_with(self.job.id, [second])
+        recheck.assert_not_called()
+
+    @override_settings(SCENE_DESCRIPTION_MAX_WAITS=2)
+    def test_line_of_a_dead_batch_is_taken_over(self):
+        first, second = self.line_ids[:2]
+        _claim_lines_to_describe(self.job.id, [first])
+
+        describe_batch, enqueue, recheck = self.describe([second], {1: {'full_image_prompt': 'p1'}}, waits=2)
+        self.assertEqual(describe_batch.call_args.kwargs['line_indices'], [1, 3, 4])
+        enqueue.assert_called_once_with(self.job.id, [second])
+        recheck.assert_not_called()
+
+    def test_batch_requeues_the_lines_it_left_undescribed(self):
+        first, second, third = self.line_ids[:3]
+        descriptions = {0: {'full_image_prompt': 'p0'}, 1: {'full_image_prompt': 'p1'}}
+        describe_batch, enqueue, _ = self.describe([first], descriptions)
+
+        self.assertEqual(describe_batch.call_args.kwargs['line_indices'], [0, 1, 2])
+        enqueue.assert_called_once_with(self.job.id, [first])
+        statuses = list(self.job.lines.values_list('status', flat=True))
+        self.assertEqual(statuses, ['describing', 'describing', 'queued', 'queued', 'queued'])
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    GENERATION_SCHEDULER='fifo',
+    SCENE_DESCRIPTION_BATCH_SIZE=10,
+)
+class AsyncEngineTests(TransactionTestCase):
+    """The async engine runs a chunk's lines concurrently to a terminal state or a flush."""
+
+    def setUp(self):
+        from .engine import ProviderEngine
+
+        # One line at a time: sqlite locks whole tables, so concurrent lines would collide on writes.
+        self.engine = ProviderEngine(concurrency=1)
+        self.enterContext(mock.patch('generator.engine.provider_engine', self.engine))
+        self.addCleanup(lambda: self.engine.loop and self.engine.loop.call_soon_threadsafe(self.engine.loop.stop))
+        load_job.cache_clear()
+        self.user = User.objects.create_user('artist', password='password')
+        UserProfile.add_tokens_for_user(self.user.id, 3)
+        UserProfile.reserve_tokens(self.user.id, 3)
+        self.job = GenerationJob.objects.create(
+            user=self.user, context='c', dialogue=['A: hi', 'B: yo', 'A: bye'], characters=[],
+            background_image_path='bg.png', total_lines=3, tokens_reserved=3,
+        )
+        self.line_ids = [
+            GenerationLine.objects.create(job=self.job, index=index, text=text).id
+            for index, text in enumerate(self.job.dialogue)
+        ]
+
+    @mock.patch('generator.tasks.request_panel_flush')
+    def test_chunk_runs_to_completion(self, request_panel_flush):
+        from .engine import run_lines
+
+        async def compose(target_line, **kwargs):
+            if target_line == 'B: yo':
+                raise ProviderError('API failed with status 400')
+            return f"https://example.com/{target_line[-3:]}.png"
+
+        # The batch response skips the last line, which is then described on its own.
+        batch = {0: {'full_image_prompt': 'p0'}, 1: {'full_image_prompt': 'p1'}}
+        self.enterContext(mock.patch('generator.engine.acreate_image_descriptions_for_dialogue', return_value=batch))
+        describe_one = self.enterContext(mock.patch(
+            'generator.engine.acreate_image_description_from_dialogue', return_value={'full_image_prompt': 'p2'},
+        ))
+        self.enterContext(mock.patch('generator.engine.acompose_comic_panel', side_effect=compose))
+        retryable = self.engine.run(run_lines(load_job(self.job.id), self.line_ids))
+
+        self.assertEqual(retryable, {})
+        self.assertEqual(describe_one.call_args.kwargs['target_line'], 'A: bye')
+        self.assertEqual(request_panel_flush.call_count, 2)
+        self.assertEqual(save_finished_lines(self.job.id), 2)
+
+        self.job.refresh_from_db()
+        self.assertEqual((self.job.status, self.job.completed_lines, self.job.failed_lines), ('completed', 2, 1))
+        self.assertEqual(
+            list(self.job.lines.values_list('status', 'error')),
+            [('done', ''), ('failed', 'API failed with status 400'), ('done', '')],
+        )
+        self.assertEqual(UserProfile.objects.get(user=self.user).token_balance, 1)
+
+
+class ScriptMigrationTests(TransactionTestCase):
+    """Migrating moves each distinct context and dialogue out of the panels into one Script row."""
+
+    before = [('generator', '0009_script')]
+    after = [('generator', '0011_generatedimage_drop_script_copies')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+    def test_existing_panels_are_deduplicated_by_content(self):
+        apps = self.migrate(self.before)
+        User = apps.get_model('auth', 'User')
+        GeneratedImage = apps.get_model('generator', 'GeneratedImage')
+        user = User.objects.create(username='artist')
+        for context, dialogue in [('c', ['A: hi', 'B: yo']), ('c', ['A: hi', 'B: yo']), ('c', ['A: hi'])]:
+            GeneratedImage.objects.create(
+                user=user, context=context, dialogue=dialogue, target_line=dialogue[0], speaker='A',
+                image_url='https://example.com/panel.png',
+            )
+
+        apps = self.migrate(self.after)
+        Script = apps.get_model('generator', 'Script')
+        panels = apps.get_model('generator', 'GeneratedImage').objects.order_by('id')
+        self.assertEqual(Script.objects.count(), 2)
+        self.assertEqual(
+            [panel.script.dialogue for panel in panels], [['A: hi', 'B: yo'], ['A: hi', 'B: yo'], ['A: hi']],
+        )
+
+        apps = self.migrate(self.before)
+        panels = apps.get_model('generator', 'GeneratedImage').objects.order_by('id')
+        self.assertEqual([panel.dialogue for panel in panels], [['A: hi', 'B: yo'], ['A: hi', 'B: yo'], ['A: hi']])
+
+
+def _redis_available():
+    try:
+        return redis.Redis.from_url(settings.REDIS_URL).ping()
+    except redis.RedisError:
+        return False
+
+
+@unittest.skipUnless(_redis_available(), 'needs the Redis server at REDIS_URL')
+@override_settings(
+    SCHEDULER_USER_MAX_IN_FLIGHT=2,
+    SCHEDULER_PRIORITY_USER_MAX_IN_FLIGHT=2,
+    SCHEDULER_MAX_IN_FLIGHT=0,
+    SCHEDULER_PRIORITY_WEIGHT=3,
+    SCHEDULER_LEASE_SECONDS=600,
+)
+class FairSchedulerTests(SimpleTestCase):
+    """Lines start round-robin across users and jobs, within each user's in-flight limit."""
+
+    def setUp(self):
+        self.scheduler = FairScheduler(key_prefix='test-scheduler')
+        self.scheduler.clear()
+        self.addCleanup(self.scheduler.clear)
+
+    def admit(self):
+        started = []
+        while (batch := self.scheduler.next_batch()) is not None:
+            user_id, job_id, line_ids = batch
+            started.extend((user_id, job_id, line_id) for line_id in line_ids)
+        return started
+
+    def test_small_job_is_not_queued_behind_a_long_script(self):
+        self.scheduler.submit(job_id=1, user_id=10, line_ids=list(range(100, 300)))
+        self.scheduler.submit(job_id=2, user_id=20, line_ids=[900])
+
+        self.assertEqual(self.scheduler.next_batch(), (10, 1, [100]))
+        self.assertEqual(self.scheduler.next_batch(), (20, 2, [900]))
+        self.assertEqual(self.admit(), [(10, 1, 101)])
+
+        # Only a finished line of user 10 makes room for their next one.
+        self.assertTrue(self.scheduler.release(10, 100))
+        self.assertFalse(self.scheduler.release(10, 100))
+        self.assertEqual(self.admit(), [(10, 1, 102)])
+        self.assertEqual(self.scheduler.waiting(1), 197)
+
+    def test_jobs_of_one_user_take_turns(self):
+        self.scheduler.submit(job_id=1, user_id=10, line_ids=[100, 101])
+        self.scheduler.submit(job_id=2, user_id=10, line_ids=[200, 201])
+        self.assertEqual(self.admit(), [(10, 1, 100), (10, 2, 200)])
+
+    @override_settings(SCHEDULER_MAX_IN_FLIGHT=4)
+    def test_priority_lane_is_served_first_without_starving_the_rest(self):
+        for user_id in (10, 20, 30):
+            self.scheduler.submit(job_id=user_id, user_id=user_id, line_ids=[user_id * 10, user_id * 10 + 1])
+        self.scheduler.submit(job_id=40, user_id=40, line_ids=[400, 401], priority=True)
+
+        self.assertEqual([user_id for user_id, _, _ in self.admit()], [40, 40, 10, 20])
+
+    @override_settings(SCHEDULER_LEASE_SECONDS=0)
+    def test_expired_leases_free_their_slots(self):
+        self.scheduler.submit(job_id=1, user_id=10, line_ids=[100, 101, 102, 103])
+        self.assertEqual(len(self.admit()), 4)
+
+
+@unittest.skipUnless(_redis_available(), 'needs the Redis server at REDIS_URL')
+@override_settings(PROVIDER_THROTTLE_BLOCK_SECONDS=30)
+class RateLimiterTests(SimpleTestCase):
+    """Requests wait for a token from the shared bucket and give up with a retryable error."""
+
+    def setUp(self):
+        # 10 requests a second, one at a time.
+        self.limiter = ProviderRateLimiter('gemini', 'test-model', requests_per_minute=600, burst=1)
+        self.addCleanup(redis.Redis.from_url(settings.REDIS_URL).delete, self.limiter.key)
+        self.addCleanup(self.limiter.clear_stats)
+
+    def waits_observed(self, outcome):
+        return LIMITER_WAIT_SECONDS.labels('gemini', 'test-model', outcome)._sum.get()
+
+    def test_waits_for_the_bucket_to_refill(self):
+        self.assertEqual(self.limiter.acquire(timeout=5), 0)
+        waited = self.limiter.acquire(timeout=5)
+        self.assertGreater(waited, 0)
+        self.assertLess(waited, 1)
+
+        stats = self.limiter.stats()
+        self.assertEqual(stats['process']['acquired'], 2)
+        self.assertEqual(stats['cluster']['waited'], 1)
+        self.assertAlmostEqual(self.waits_observed('ok'), waited, delta=0.01)
+
+    def test_gives_up_while_throttled(self):
+        self.limiter.throttled()
+        with self.assertRaises(RetryableProviderError):
+            self.limiter.acquire(timeout=0.2)
+        with self.assertRaises(RetryableProviderError):
+            asyncio.run(self.limiter.aacquire(timeout=0.2))
+
+        stats = self.limiter.stats()['cluster']
+        self.assertEqual((stats['acquired'], stats['timed_out'], stats['throttled']), (0, 2, 1))
+        self.assertAlmostEqual(self.waits_observed('timeout'), 0.4, delta=0.05)
+
+
+@override_settings(METRICS_TOKEN='scrape-token')
+class MetricsEndpointTests(TestCase):
+    """/metrics exposes the pipeline's metrics in the Prometheus text format, only to holders of the token."""
+
+    def test_scrape_requires_the_bearer_token(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 401)
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong')
+        self.assertEqual(response.status_code, 401)
+
+    @override_settings(METRICS_TOKEN=None, DEBUG=False)
+    def test_not_served_without_a_token(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
+
+    @unittest.skipUnless(_redis_available(), 'needs the Redis server at REDIS_URL')
+    def test_scrape_lists_the_pipeline_metrics(self):
+        limiter = ProviderRateLimiter('gemini', 'metrics-model', requests_per_minute=600, burst=1)
+        self.addCleanup(redis.Redis.from_url(settings.REDIS_URL).delete, limiter.key)
+        self.addCleanup(limiter.clear_stats)
+        limiter.acquire(timeout=5)
+
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer scrape-token')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        body = response.content.decode()
+        for name in (
+            'comic_stage_duration_seconds', 'comic_provider_attempts_total', 'comic_lines_finished_total',
+            'comic_task_queue_wait_seconds',
+        ):
+            self.assertIn(f"# TYPE {name.removesuffix('_total')}", body)
+        self.assertIn(
+            'comic_rate_limiter_wait_seconds_count{model="metrics-model",outcome="ok",provider="gemini"} 1.0', body,
+        )
@@ -7,4 +7,6 @@ urlpatterns = [
     path('', views.dashboard_view, name='dashboard'),
     path('generate/', views.generate_view, name='generate'),
     path('gallery/', views.image_gallery, name='gallery'),
+    path('jobs/<int:job_id>/status/', views.job_status, name='job_status'),
+    path('jobs/<int:job_id>/events/', views.job_events, name='job_events'),
 ]
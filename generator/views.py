@@ -2,74 +2,51 @@ from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.conf import settings
-from django.http import JsonResponse
-from .models import GeneratedImage
-import os
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
+from .models import GeneratedImage, GenerationJob, GenerationLine
+from .pagination import keyset_page
+from .events import format_sse, job_event_hub
+from .metrics import observe_stage, registry
+import asyncio
+import hmac
 import json
-from pydantic import BaseModel, Field
-import dashscope
-from dashscope import MultiModalConversation
-from google import genai
-from google.genai import types
-from dotenv import load_dotenv
-from .tasks import generate_image_for_line
-from .image_utils import create_image_description_from_dialogue
+from asgiref.sync import sync_to_async
+from .tasks import dispatch_generation
 from django.contrib.auth.models import User
-load_dotenv()
+from accounts.cache import profile_summary
+from accounts.models import UserProfile
 
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-IMG_API_KEY = os.getenv('IMG_API_KEY')
-
-# Read key
-
-dashscope.base_http_api_url = settings.DASHSCOPE_BASE_URL
-
-
-
-
-class ImagePrompt(BaseModel):
-    subject_description: str = Field(
-        ...,
-        description="Detailed description of the character speaking the line, including mood, attire, and physical posture."
-    )
-    setting_and_scene: str = Field(
-        ...,
-        description="The environment, lighting, time of day, and general atmosphere surrounding the character and the dialogue."
-    )
-    action_or_expression: str = Field(
-        ...,
-        description="The specific action, facial expression, or emotional intensity captured in the moment the line is delivered."
-    )
-    camera_and_style: str = Field(
-        ...,
-        description="Recommended artistic style (e.g., cinematic, watercolor), camera angle (e.g., close-up, wide shot), and general visual mood."
-    )
-    full_image_prompt: str = Field(
-        ...,
-        description="A single, cohesive, highly detailed prompt combining all elements, optimized for image generation."
-    )
 
+class InsufficientTokens(Exception):
+    pass
 
 
+def _serves_event_streams(request):
+    # Under WSGI Django drains an async stream before sending any of it, holding a
+    # worker until the job finishes; only an ASGI server can stream progress.
+    return isinstance(request, ASGIRequest)
 
 
 @login_required
 def dashboard_view(request):
-    recent_images = GeneratedImage.objects.filter(user=request.user)[:10]
+    # Lazy: only evaluated when the template's cached fragment has to be rebuilt.
+    recent_images = (
+        GeneratedImage.objects.filter(user=request.user)
+        .only(*GeneratedImage.CARD_FIELDS)
+        .order_by('-created_at', '-id')[:10]
+    )
     return render(request, 'generator/dashboard.html', {
         'recent_images': recent_images,
-        'user': request.user
+        'user': request.user,
+        'user_cache_ttl': settings.USER_CACHE_TTL,
     })
 
 
 @login_required
 def generate_view(request):
     if request.method == 'POST':
-        # --- Check token balance ---
-        if request.user.profile.token_balance < 1:
-            messages.error(request, 'Insufficient tokens. Please purchase more tokens.')
-            return redirect('tokens:packages')
-
         # --- Read text fields ---
         context = request.POST.get('context', '')
         dialogue_text = request.POST.get('dialogue', '')
@@ -81,6 +58,12 @@ def generate_view(request):
             messages.error(request, 'Invalid dialogue or empty input.')
             return redirect('generator:generate')
 
+        # --- Check token balance: every line costs one token ---
+        # A quick check against the cached balance; reserve_tokens() below is authoritative.
+        if profile_summary(request.user.id)['token_balance'] < len(dialogue_lines):
+            messages.error(request, f'Insufficient tokens: this script needs {len(dialogue_lines)}. Please purchase more tokens.')
+            return redirect('tokens:packages')
+
         # --- Dynamically collect characters ---
         characters = []
         i = 1
@@ -106,42 +89,168 @@ def generate_view(request):
             messages.error(request, 'Please upload a background image.')
             return redirect('generator:generate')
 
-        # --- Save all uploaded files temporarily ---
-        from django.core.files.storage import default_storage
-        saved_files = []
+        # --- Store uploads by content; the job holds one reference to each ---
+        from .models import UploadedAsset
+        from .preprocessing import prepare_reference_image
+        stored_assets = []
         try:
-            for char in characters:
-                path = default_storage.save(f"temp/{char['image'].name}", char["image"])
-                char["path"] = os.path.join(settings.MEDIA_ROOT, path)
-                saved_files.append(path)
-
-            bg_path = default_storage.save(f'temp/{background_image.name}', background_image)
-            background_full = os.path.join(settings.MEDIA_ROOT, bg_path)
-            saved_files.append(bg_path)
-
-            # --- Loop through all dialogue lines ---
-            all_results = []
-            for i, line in enumerate(dialogue_lines):
-                generate_image_for_line.delay(
-                    user_id=request.user.id,
+            assets = []
+            with observe_stage('storage_save'):
+                for image in [char.pop("image") for char in characters] + [background_image]:
+                    asset = UploadedAsset.objects.store(image)
+                    stored_assets.append(asset.id)
+                    assets.append(asset)
+
+            # Re-encoding and thumbnailing are timed apart from the storage writes.
+            with observe_stage('image_preprocess'):
+                paths = [prepare_reference_image(asset).reference_path for asset in assets]
+            for char, path in zip(characters, paths):
+                char["path"] = path
+            background_full = paths[-1]
+
+            with transaction.atomic():
+                job = GenerationJob.objects.create(
+                    user=request.user,
                     context=context,
                     dialogue=dialogue_lines,
-                    target_line=line,
                     characters=characters,
                     background_image_path=background_full,
+                    asset_ids=stored_assets,
+                    total_lines=len(dialogue_lines),
+                    tokens_reserved=len(dialogue_lines),
                 )
-    
+                # Reserve the whole job's tokens up front; failed lines give theirs back.
+                with observe_stage('token_update'):
+                    reserved = UserProfile.reserve_tokens(request.user.id, len(dialogue_lines), job_id=job.id)
+                if not reserved:
+                    raise InsufficientTokens()
+                GenerationLine.objects.bulk_create(
+                    GenerationLine(job=job, index=i, text=line[:500])
+                    for i, line in enumerate(dialogue_lines)
+                )
+                # --- Stage reference images once, then fan out one task per line ---
+                transaction.on_commit(lambda: dispatch_generation.delay(job.id))
+
             messages.success(request, "Your request is being processed. Check back later in your gallery.")
-            return redirect('generator:image_gallery') 
+            return redirect('generator:gallery')
+        except InsufficientTokens:
+            messages.error(request, f'Insufficient tokens: this script needs {len(dialogue_lines)}. Please purchase more tokens.')
+            UploadedAsset.objects.release(stored_assets)
+            return redirect('tokens:packages')
         except Exception as e:
             # handle the error, clean up or show message
             messages.error(request, f"An error occurred: {e}")
-            # optionally clean up saved files here or re-raise
-            for path in saved_files:
-                default_storage.delete(path)
+            # No job will release these references; unreferenced blobs are cleaned up periodically.
+            UploadedAsset.objects.release(stored_assets)
             return redirect('generator:generate')
     return render(request, 'generator/generate.html')
+
+
 @login_required
 def image_gallery(request):
-    images = GeneratedImage.objects.filter(user=request.user)
-    return render(request, 'generator/gallery.html', {'images': images})
+    images, next_cursor = keyset_page(
+        GeneratedImage.objects.filter(user=request.user).only(*GeneratedImage.CARD_FIELDS),
+        cursor=request.GET.get('cursor'),
+        page_size=settings.GALLERY_PAGE_SIZE,
+    )
+    context = {'images': images, 'next_cursor': next_cursor}
+    if request.headers.get('x-requested-with') == 'XMLHttpRequest':
+        # Infinite scroll asks for the next page of cards only.
+        return render(request, 'generator/_gallery_page.html', context)
+    context['active_jobs'] = (
+        GenerationJob.objects.filter(user=request.user, finished_at__isnull=True)
+        .only('id', 'status', 'total_lines', 'completed_lines', 'failed_lines', 'created_at')[:5]
+    )
+    context['live_events'] = _serves_event_streams(request)
+    return render(request, 'generator/gallery.html', context)
+
+
+@login_required
+def job_status(request, job_id):
+    """Progress of one job: counters plus per-line state, read in a single query."""
+    lines = list(
+        GenerationLine.objects.filter(job_id=job_id, job__user=request.user)
+        .select_related('job', 'generated_image')
+        .only(
+            'index', 'status', 'error',
+            'job__id', 'job__status', 'job__total_lines', 'job__completed_lines', 'job__failed_lines', 'job__finished_at',
+            'generated_image__image', 'generated_image__image_url', 'generated_image__thumbnails',
+        )
+    )
+    if not lines:
+        raise Http404('Job not found')
+
+    job = lines[0].job
+    return JsonResponse({
+        **job.progress_snapshot(),
+        'lines': [
+            {
+                'id': line.id,
+                'index': line.index,
+                'status': line.status,
+                'error': line.error,
+                'image_url': line.generated_image.thumbnail_url if line.generated_image else None,
+            }
+            for line in lines
+        ],
+    })
+
+
+async def job_events(request, job_id):
+    """
+    Server-Sent Events stream of one job's progress. Only served over ASGI:
+    each open stream is a coroutine waiting on an in-memory queue, so one
+    worker can hold thousands of them. Under WSGI it answers 204, which makes
+    EventSource stop reconnecting; clients poll job_status instead.
+    """
+    if not _serves_event_streams(request):
+        return HttpResponse(status=204)
+    user = await sync_to_async(lambda: request.user if request.user.is_authenticated else None)()
+    if user is None:
+        return HttpResponse(status=401)
+    if not await GenerationJob.objects.filter(id=job_id, user=user).aexists():
+        raise Http404('Job not found')
+
+    async def stream():
+        queue = await job_event_hub.subscribe(job_id)
+        try:
+            # Send the current state after subscribing, so no event falls in between.
+            job = await GenerationJob.objects.aget(id=job_id)
+            snapshot = job.progress_snapshot()
+            yield format_sse('job', snapshot)
+            if snapshot['finished']:
+                return
+
+            while True:
+                try:
+                    raw = await asyncio.wait_for(queue.get(), timeout=settings.SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                message = json.loads(raw)
+                yield format_sse(message['event'], message['data'])
+                if message['event'] == 'job' and message['data'].get('finished'):
+                    return
+        finally:
+            job_event_hub.unsubscribe(job_id, queue)
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def metrics(request):
+    """
+    Prometheus scrape endpoint. Scrapers must send METRICS_TOKEN as a bearer
+    token; without one configured it is only served when DEBUG is on.
+    """
+    from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+    if settings.METRICS_TOKEN:
+        expected = f"Bearer {settings.METRICS_TOKEN}"
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), expected):
+            return HttpResponse(status=401)
+    elif not settings.DEBUG:
+        raise Http404
+    return HttpResponse(generate_latest(registry()), content_type=CONTENT_TYPE_LATEST)
@@ -1,11 +1,11 @@
 from django.contrib import admin
-from .models import TokenPackage, TokenPurchase
+from .models import StripeEvent, TokenPackage, TokenPurchase, TokenTransaction
 
 
 @admin.register(TokenPackage)
 class TokenPackageAdmin(admin.ModelAdmin):
-    list_display = ['name', 'token_amount', 'price', 'is_active', 'created_at']
-    list_filter = ['is_active', 'created_at']
+    list_display = ['name', 'token_amount', 'price', 'is_active', 'priority', 'created_at']
+    list_filter = ['is_active', 'priority', 'created_at']
     search_fields = ['name']
     list_editable = ['is_active']
 
@@ -13,6 +13,31 @@ class TokenPackageAdmin(admin.ModelAdmin):
 @admin.register(TokenPurchase)
 class TokenPurchaseAdmin(admin.ModelAdmin):
     list_display = ['user', 'token_amount', 'price_paid', 'status', 'created_at', 'completed_at']
+    list_select_related = ['user']
     list_filter = ['status', 'created_at']
     search_fields = ['user__username', 'stripe_payment_intent_id']
     readonly_fields = ['created_at', 'completed_at']
+
+
+@admin.register(TokenTransaction)
+class TokenTransactionAdmin(admin.ModelAdmin):
+    list_display = ['user', 'kind', 'amount', 'tokens', 'job', 'purchase', 'created_at']
+    # job and purchase are nullable, so the admin would not join them itself; both render their user.
+    list_select_related = ['user', 'job__user', 'purchase__user']
+    list_filter = ['kind', 'created_at']
+    search_fields = ['user__username', 'note']
+    readonly_fields = ['user', 'kind', 'amount', 'tokens', 'job', 'purchase', 'note', 'created_at']
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(StripeEvent)
+class StripeEventAdmin(admin.ModelAdmin):
+    list_display = ['event_id', 'type', 'status', 'attempts', 'received_at', 'processed_at']
+    list_filter = ['status', 'type', 'received_at']
+    search_fields = ['event_id']
+    readonly_fields = ['event_id', 'type', 'payload', 'attempts', 'error', 'received_at', 'processed_at']
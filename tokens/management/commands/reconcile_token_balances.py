@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F, IntegerField, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from accounts.models import UserProfile
+from tokens.models import TokenTransaction
+
+
+def ledger_total(expression, **filters):
+    """Per-user sum over the ledger, as a correlated subquery on the profile's user."""
+    totals = (
+        TokenTransaction.objects.filter(user_id=OuterRef('user_id'), **filters)
+        .order_by()
+        .values('user_id')
+        .annotate(total=Sum(expression))
+        .values('total')
+    )
+    return Coalesce(Subquery(totals, output_field=IntegerField()), Value(0))
+
+
+class Command(BaseCommand):
+    help = 'Recompute token balances and usage counters from the token ledger in one set-based pass'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help='Only report profiles that disagree with the ledger')
+
+    def handle(self, *args, **options):
+        expected = {
+            'token_balance': ledger_total('amount'),
+            'total_tokens_purchased': ledger_total('tokens', kind='purchase'),
+            'total_images_generated': ledger_total('tokens', kind='charge'),
+        }
+
+        mismatched = (
+            UserProfile.objects.annotate(**{f'ledger_{field}': value for field, value in expected.items()})
+            .filter(
+                ~Q(token_balance=F('ledger_token_balance'))
+                | ~Q(total_tokens_purchased=F('ledger_total_tokens_purchased'))
+                | ~Q(total_images_generated=F('ledger_total_images_generated'))
+            )
+        )
+        count = mismatched.count()
+        self.stdout.write(f'{count} profile(s) disagree with the ledger.')
+
+        if options['check'] or not count:
+            return
+
+        with transaction.atomic():
+            updated = UserProfile.objects.filter(pk__in=mismatched.values('pk')).update(**expected)
+        self.stdout.write(self.style.SUCCESS(f'Reconciled {updated} profile(s) from the ledger.'))
@@ -0,0 +1,38 @@
+# Generated by Django 4.2 on 2026-10-18 01:28
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('generator', '0007_generationjob_tokens_reserved'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('tokens', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TokenTransaction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('purchase', 'Purchase'), ('reservation', 'Reservation'), ('charge', 'Charge'), ('refund', 'Refund'), ('adjustment', 'Adjustment')], max_length=20)),
+                ('amount', models.IntegerField()),
+                ('tokens', models.IntegerField(default=0)),
+                ('note', models.CharField(blank=True, max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('job', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='generator.generationjob')),
+                ('purchase', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='tokens.tokenpurchase')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='token_transactions', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='tokentransaction',
+            index=models.Index(fields=['user', '-created_at'], name='tokens_txn_user_created'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+from django.db import migrations
+
+
+def seed_ledger(apps, schema_editor):
+    """
+    Open the ledger with the counters each profile already has, so that
+    reconciling from the ledger reproduces today's balances.
+    """
+    UserProfile = apps.get_model('accounts', 'UserProfile')
+    TokenTransaction = apps.get_model('tokens', 'TokenTransaction')
+
+    batch = []
+    profiles = UserProfile.objects.values_list(
+        'user_id', 'token_balance', 'total_tokens_purchased', 'total_images_generated'
+    )
+    for user_id, balance, purchased, generated in profiles.iterator():
+        if purchased:
+            batch.append(TokenTransaction(
+                user_id=user_id, kind='purchase', amount=purchased, tokens=purchased, note='Opening balance'
+            ))
+        if generated:
+            batch.append(TokenTransaction(
+                user_id=user_id, kind='charge', amount=0, tokens=generated, note='Opening balance'
+            ))
+        if balance != purchased:
+            batch.append(TokenTransaction(
+                user_id=user_id, kind='adjustment', amount=balance - purchased,
+                tokens=abs(balance - purchased), note='Opening balance'
+            ))
+        if len(batch) >= 1000:
+            TokenTransaction.objects.bulk_create(batch)
+            batch = []
+    TokenTransaction.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+        ('tokens', '0002_tokentransaction'),
+    ]
+
+    operations = [
+        migrations.RunPython(seed_ledger, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 02:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tokens', '0004_stripe_events'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tokenpackage',
+            name='priority',
+            field=models.BooleanField(default=False, help_text="Buyers' panels are generated in the priority lane, with more lines in flight."),
+        ),
+    ]
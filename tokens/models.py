@@ -8,6 +8,10 @@ class TokenPackage(models.Model):
     price = models.DecimalField(max_digits=10, decimal_places=2)
     description = models.TextField(blank=True)
     is_active = models.BooleanField(default=True)
+    priority = models.BooleanField(
+        default=False,
+        help_text="Buyers' panels are generated in the priority lane, with more lines in flight.",
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -31,8 +35,8 @@ class TokenPurchase(models.Model):
     token_amount = models.IntegerField()
     price_paid = models.DecimalField(max_digits=10, decimal_places=2)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
-    stripe_payment_intent_id = models.CharField(max_length=255, blank=True, null=True)
-    stripe_session_id = models.CharField(max_length=255, blank=True, null=True)
+    stripe_payment_intent_id = models.CharField(max_length=255, blank=True, null=True, db_index=True)
+    stripe_session_id = models.CharField(max_length=255, blank=True, null=True, db_index=True)
     created_at = models.DateTimeField(auto_now_add=True)
     completed_at = models.DateTimeField(null=True, blank=True)
 
@@ -42,10 +46,119 @@ class TokenPurchase(models.Model):
     def __str__(self):
         return f"{self.user.username} - {self.token_amount} tokens - {self.status}"
 
+    @classmethod
+    def has_priority_lane(cls, user_id):
+        """Whether the user has bought a package that puts their jobs in the priority lane."""
+        return cls.objects.filter(user_id=user_id, status='completed', package__priority=True).exists()
+
     def complete_purchase(self):
+        from django.db import transaction
+        from django.utils import timezone
+        from accounts.models import UserProfile
+
+        with transaction.atomic():
+            # Flip the status conditionally so a purchase is credited only once,
+            # even if the webhook and the success page race.
+            completed_at = timezone.now()
+            updated = TokenPurchase.objects.filter(pk=self.pk, status='pending').update(
+                status='completed',
+                completed_at=completed_at,
+            )
+            if not updated:
+                return False
+            UserProfile.add_tokens_for_user(self.user_id, self.token_amount, purchase=self)
+
+        self.status = 'completed'
+        self.completed_at = completed_at
+        return True
+
+    def fail_purchase(self):
+        """Mark a still-pending purchase failed, e.g. when its checkout session expired."""
+        updated = TokenPurchase.objects.filter(pk=self.pk, status='pending').update(status='failed')
+        if updated:
+            self.status = 'failed'
+        return bool(updated)
+
+
+class TokenTransaction(models.Model):
+    """
+    Append-only ledger of token movements. ``amount`` is the change to the
+    user's balance; ``tokens`` is how many tokens the entry concerns, so a
+    charge (a reserved token spent on a finished panel) has amount 0.
+    UserProfile.token_balance is the materialized sum of ``amount``.
+    """
+
+    KIND_CHOICES = [
+        ('purchase', 'Purchase'),
+        ('reservation', 'Reservation'),
+        ('charge', 'Charge'),
+        ('refund', 'Refund'),
+        ('adjustment', 'Adjustment'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='token_transactions')
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    amount = models.IntegerField()
+    tokens = models.IntegerField(default=0)
+    purchase = models.ForeignKey(TokenPurchase, on_delete=models.SET_NULL, null=True, blank=True)
+    job = models.ForeignKey('generator.GenerationJob', on_delete=models.SET_NULL, null=True, blank=True)
+    note = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', '-created_at'], name='tokens_txn_user_created'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} {self.kind} {self.amount:+d}"
+
+    def save(self, *args, **kwargs):
+        if self.pk is not None:
+            raise ValueError('Token transactions are append-only.')
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise ValueError('Token transactions are append-only.')
+
+
+class StripeEvent(models.Model):
+    """
+    A verified Stripe webhook event. The unique event id makes delivery
+    idempotent: Stripe's retries and duplicates are acknowledged without
+    being processed again. Processing happens in process_stripe_event.
+    """
+
+    STATUS_CHOICES = [
+        ('received', 'Received'),
+        ('processed', 'Processed'),
+        ('ignored', 'Ignored'),
+        ('failed', 'Failed'),
+    ]
+
+    event_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=100)
+    payload = models.JSONField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='received')
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-received_at']
+        indexes = [
+            models.Index(fields=['status', 'received_at'], name='tokens_event_status_received'),
+        ]
+
+    def __str__(self):
+        return f"{self.event_id} {self.type} - {self.status}"
+
+    @classmethod
+    def finish(cls, pk, status, error=''):
+        """Move a received event to a terminal status; returns False if another worker already did."""
         from django.utils import timezone
-        if self.status == 'pending':
-            self.status = 'completed'
-            self.completed_at = timezone.now()
-            self.user.profile.add_tokens(self.token_amount)
-            self.save()
+        return bool(cls.objects.filter(pk=pk, status='received').update(
+            status=status, error=error, processed_at=timezone.now(),
+        ))
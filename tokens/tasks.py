@@ -0,0 +1,80 @@
+from datetime import timedelta
+
+from celery import shared_task
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from .models import StripeEvent, TokenPurchase
+
+
+def _checkout_purchase(session):
+    purchase = TokenPurchase.objects.filter(stripe_session_id=session['id']).first()
+    if purchase and session.get('payment_intent') and not purchase.stripe_payment_intent_id:
+        TokenPurchase.objects.filter(pk=purchase.pk).update(stripe_payment_intent_id=session['payment_intent'])
+    return purchase
+
+
+def _checkout_completed(session):
+    # Delayed payment methods complete the session unpaid and succeed later.
+    if session.get('payment_status') == 'unpaid':
+        return 'ignored'
+    purchase = _checkout_purchase(session)
+    if purchase is None:
+        return 'ignored'
+    purchase.complete_purchase()
+    return 'processed'
+
+
+def _checkout_failed(session):
+    purchase = _checkout_purchase(session)
+    if purchase is None:
+        return 'ignored'
+    purchase.fail_purchase()
+    return 'processed'
+
+
+EVENT_HANDLERS = {
+    'checkout.session.completed': _checkout_completed,
+    'checkout.session.async_payment_succeeded': _checkout_completed,
+    'checkout.session.async_payment_failed': _checkout_failed,
+    'checkout.session.expired': _checkout_failed,
+}
+
+
+@shared_task(bind=True, acks_late=True, max_retries=5)
+def process_stripe_event(self, event_pk):
+    """
+    Apply one recorded Stripe event. Handlers are idempotent (purchases only
+    leave 'pending' once), so a redelivered or requeued task is harmless.
+    """
+    event = StripeEvent.objects.filter(pk=event_pk, status='received').first()
+    if event is None:
+        return "Already handled"
+    StripeEvent.objects.filter(pk=event_pk).update(attempts=F('attempts') + 1)
+
+    handler = EVENT_HANDLERS.get(event.type)
+    if handler is None:
+        StripeEvent.finish(event_pk, 'ignored')
+        return "Ignored"
+    try:
+        status = handler(event.payload['data']['object'])
+    except Exception as e:
+        if self.request.retries >= self.max_retries:
+            StripeEvent.finish(event_pk, 'failed', error=str(e))
+            raise
+        raise self.retry(exc=e, countdown=10 * 2 ** self.request.retries)
+    StripeEvent.finish(event_pk, status)
+    return status.capitalize()
+
+
+@shared_task
+def requeue_stripe_events():
+    """Re-enqueue events still unprocessed after STRIPE_EVENT_REQUEUE_SECONDS, e.g. if the broker was down."""
+    cutoff = timezone.now() - timedelta(seconds=settings.STRIPE_EVENT_REQUEUE_SECONDS)
+    event_ids = list(
+        StripeEvent.objects.filter(status='received', received_at__lt=cutoff).values_list('id', flat=True)[:500]
+    )
+    for event_id in event_ids:
+        process_stripe_event.delay(event_id)
+    return f"Requeued {len(event_ids)} events"
@@ -1,3 +1,181 @@
-from django.test import TestCase
+import hashlib
+import hmac
+import json
+import time
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from accounts.models import UserProfile
+from comic_generator.query_profiling import assert_query_budget
+from generator.models import GenerationJob
+from .models import StripeEvent, TokenPackage, TokenPurchase, TokenTransaction
+from .tasks import process_stripe_event
+
+
+# Templates resolve static files without a collectstatic manifest; the
+# per-user cache is local so budgets do not depend on a running Redis.
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+)
+class QueryBudgetTests(TestCase):
+    """Query budgets per view; a repeated query shape per row means an N+1 crept in."""
+
+    ROWS = 10
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        package = TokenPackage.objects.create(name='Starter', token_amount=10, price=5)
+        for index in range(cls.ROWS):
+            user = User.objects.create_user(f"buyer{index}", password='password')
+            purchase = TokenPurchase.objects.create(user=user, package=package, token_amount=10, price_paid=5)
+            purchase.complete_purchase()
+            job = GenerationJob.objects.create(
+                user=user, context='c', dialogue=['A: hi'], characters=[],
+                background_image_path='bg.png', total_lines=1,
+            )
+            UserProfile.reserve_tokens(user.id, 1, job_id=job.id)
+        cls.buyer = user
+
+    def setUp(self):
+        cache.clear()
+
+    def assertViewWithinBudget(self, user, url, max_queries, max_duplicates=1):
+        self.client.force_login(user)
+        with assert_query_budget(max_queries=max_queries, max_duplicates=max_duplicates):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_purchase_history(self):
+        self.assertViewWithinBudget(self.buyer, reverse('tokens:history'), max_queries=5)
+
+    def test_token_transaction_admin_changelist(self):
+        # The changelist counts rows twice (filtered and total).
+        self.assertViewWithinBudget(
+            self.admin, reverse('admin:tokens_tokentransaction_changelist'), max_queries=6, max_duplicates=2,
+        )
+
+    def test_token_purchase_admin_changelist(self):
+        self.assertViewWithinBudget(
+            self.admin, reverse('admin:tokens_tokenpurchase_changelist'), max_queries=6, max_duplicates=2,
+        )
+
+
+@override_settings(STRIPE_WEBHOOK_SECRET='whsec_test')
+class StripeWebhookTests(TestCase):
+    """Webhooks are verified, recorded once per event id and applied by a worker."""
+
+    def setUp(self):
+        self.user = User.objects.create_user('buyer', password='password')
+        package = TokenPackage.objects.create(name='Starter', token_amount=10, price=5)
+        self.purchase = TokenPurchase.objects.create(
+            user=self.user, package=package, token_amount=10, price_paid=5, stripe_session_id='cs_test_1',
+        )
+
+    def post_event(self, event_id, event_type='checkout.session.completed', payment_status='paid'):
+        payload = json.dumps({
+            'id': event_id,
+            'object': 'event',
+            'type': event_type,
+            'data': {'object': {
+                'id': 'cs_test_1', 'object': 'checkout.session',
+                'payment_status': payment_status, 'payment_intent': 'pi_test_1',
+            }},
+        })
+        timestamp = int(time.time())
+        signature = hmac.new(b'whsec_test', f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+        return self.client.post(
+            reverse('tokens:webhook'), payload, content_type='application/json',
+            HTTP_STRIPE_SIGNATURE=f"t={timestamp},v1={signature}",
+        )
+
+    def test_rejects_bad_signature(self):
+        response = self.client.post(
+            reverse('tokens:webhook'), '{}', content_type='application/json', HTTP_STRIPE_SIGNATURE='t=1,v1=bad',
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(StripeEvent.objects.exists())
+
+    @mock.patch('tokens.views.process_stripe_event.delay')
+    def test_duplicate_deliveries_are_recorded_and_enqueued_once(self, delay):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = self.post_event('evt_1')
+            second = self.post_event('evt_1')
+        self.assertEqual((first.status_code, second.status_code), (200, 200))
+        event = StripeEvent.objects.get()
+        delay.assert_called_once_with(event.pk)
+        # Acknowledged, not applied: the purchase is still pending.
+        self.purchase.refresh_from_db()
+        self.assertEqual(self.purchase.status, 'pending')
+
+    @mock.patch('tokens.views.process_stripe_event.delay')
+    def test_processing_credits_the_purchase_once(self, delay):
+        self.post_event('evt_1')
+        event = StripeEvent.objects.get()
+        process_stripe_event(event.pk)
+        process_stripe_event(event.pk)
+
+        event.refresh_from_db()
+        self.purchase.refresh_from_db()
+        self.assertEqual((event.status, event.attempts), ('processed', 1))
+        self.assertEqual(self.purchase.status, 'completed')
+        self.assertEqual(self.purchase.stripe_payment_intent_id, 'pi_test_1')
+        self.assertEqual(UserProfile.objects.get(user=self.user).token_balance, 10)
+
+    @mock.patch('tokens.views.process_stripe_event.delay')
+    def test_expired_session_fails_the_purchase(self, delay):
+        self.post_event('evt_2', event_type='checkout.session.expired', payment_status='unpaid')
+        process_stripe_event(StripeEvent.objects.get().pk)
+        self.purchase.refresh_from_db()
+        self.assertEqual(self.purchase.status, 'failed')
+
+    @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_success_page_reads_local_state(self):
+        self.client.force_login(self.user)
+        with mock.patch('stripe.checkout.Session.retrieve') as retrieve:
+            response = self.client.get(reverse('tokens:success'), {'session_id': 'cs_test_1'}, follow=True)
+        retrieve.assert_not_called()
+        self.assertContains(response, 'will be added to your account in a moment')
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ReconcileTokenBalancesTests(TestCase):
+    """Profiles that drifted from the ledger are recomputed from it in one pass."""
+
+    def setUp(self):
+        self.user = User.objects.create_user('artist', password='password')
+        UserProfile.add_tokens_for_user(self.user.id, 10)
+        UserProfile.reserve_tokens(self.user.id, 3)
+        UserProfile.record_images_generated(self.user.id, count=2)
+        UserProfile.release_tokens(self.user.id, 1)
+        self.in_step = User.objects.create_user('other', password='password')
+        UserProfile.add_tokens_for_user(self.in_step.id, 4)
+
+    def reconcile(self, *args):
+        out = StringIO()
+        call_command('reconcile_token_balances', *args, stdout=out)
+        return out.getvalue()
+
+    def counters(self, user):
+        return UserProfile.objects.filter(user=user).values_list(
+            'token_balance', 'total_tokens_purchased', 'total_images_generated',
+        ).get()
+
+    def test_drifted_profiles_are_recomputed(self):
+        UserProfile.objects.filter(user=self.user).update(token_balance=99, total_images_generated=0)
+
+        self.assertIn('1 profile(s) disagree', self.reconcile('--check'))
+        self.assertEqual(self.counters(self.user), (99, 10, 0))
+
+        self.assertIn('Reconciled 1 profile(s)', self.reconcile())
+        self.assertEqual(self.counters(self.user), (8, 10, 2))
+        self.assertEqual(self.counters(self.in_step), (4, 4, 0))
+        self.assertIn('0 profile(s) disagree', self.reconcile())
+        self.assertEqual(TokenTransaction.objects.filter(user=self.user).count(), 4)
@@ -5,7 +5,9 @@ from django.conf import settings
 from django.http import JsonResponse, HttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
-from .models import TokenPackage, TokenPurchase
+from django.db import transaction
+from .models import StripeEvent, TokenPackage, TokenPurchase
+from .tasks import process_stripe_event
 import stripe
 import json
 
@@ -73,25 +75,29 @@ def create_checkout_session(request):
 
 @login_required
 def purchase_success(request):
+    # Tokens are credited by the webhook; this page only reports the purchase's local state.
     session_id = request.GET.get('session_id')
     if session_id:
-        try:
-            session = stripe.checkout.Session.retrieve(session_id)
-            if session.payment_status == 'paid':
-                purchase = TokenPurchase.objects.filter(
-                    stripe_session_id=session_id,
-                    user=request.user
-                ).first()
-                
-                if purchase and purchase.status == 'pending':
-                    purchase.complete_purchase()
-                    messages.success(
-                        request,
-                        f'Payment successful! {purchase.token_amount} tokens have been added to your account.'
-                    )
-        except Exception as e:
+        purchase = TokenPurchase.objects.filter(
+            stripe_session_id=session_id,
+            user=request.user
+        ).only('status', 'token_amount').first()
+
+        if purchase is None:
             messages.error(request, 'Error processing payment. Please contact support.')
-    
+        elif purchase.status == 'completed':
+            messages.success(
+                request,
+                f'Payment successful! {purchase.token_amount} tokens have been added to your account.'
+            )
+        elif purchase.status == 'pending':
+            messages.info(
+                request,
+                f'Payment received! {purchase.token_amount} tokens will be added to your account in a moment.'
+            )
+        else:
+            messages.error(request, 'The payment did not go through. Please try again.')
+
     return redirect('generator:dashboard')
 
 
@@ -110,19 +116,19 @@ def stripe_webhook(request):
         )
     except ValueError:
         return HttpResponse(status=400)
-    except stripe.error.SignatureVerificationError:
+    except stripe.SignatureVerificationError:
         return HttpResponse(status=400)
-    
-    if event['type'] == 'checkout.session.completed':
-        session = event['data']['object']
-        
-        try:
-            purchase = TokenPurchase.objects.get(stripe_session_id=session['id'])
-            if purchase.status == 'pending':
-                purchase.complete_purchase()
-        except TokenPurchase.DoesNotExist:
-            pass
-    
+
+    # Record and acknowledge; the purchase is updated by a worker. A redelivered
+    # event finds its row already there and is not processed again.
+    with transaction.atomic():
+        stripe_event, created = StripeEvent.objects.get_or_create(
+            event_id=event['id'],
+            defaults={'type': event['type'], 'payload': json.loads(payload)},
+        )
+        if created:
+            transaction.on_commit(lambda: process_stripe_event.delay(stripe_event.pk))
+
     return HttpResponse(status=200)
 
 